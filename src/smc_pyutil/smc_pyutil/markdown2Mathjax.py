@@ -175,6 +175,80 @@ def reconstructMath(processedString,
     return outString
 
 
+#All the math delimiters understood by MathJax in CoCalc, as (left, right) pairs.
+MATH_DELIMS = [('$$', '$$'), ('$', '$'), ('\\(', '\\)'), ('\\[', '\\]'),
+               ('\\begin{equation}', '\\end{equation}'),
+               ('\\begin{equation*}', '\\end{equation*}'),
+               ('\\begin{align}', '\\end{align}'),
+               ('\\begin{align*}', '\\end{align*}'),
+               ('\\begin{eqnarray}', '\\end{eqnarray}'),
+               ('\\begin{eqnarray*}', '\\end{eqnarray*}'),
+               ('\\begin{math}', '\\end{math}'),
+               ('\\begin{displaymath}', '\\end{displaymath}')]
+
+_safe_placeholders = {}
+_scanners = {}
+
+
+def _scanner(delims, placeholder):
+    """The regular expressions used by sanitizeAll, compiled once for each set of delimiters."""
+    key = (tuple(delims), placeholder)
+    if key not in _scanners:
+        #Longest delimiters first, so e.g. $$ takes precedence over $; existing placeholders before all.
+        lefts = sorted(set(d[0] for d in delims), key=len, reverse=True)
+        left_re = re.compile("(?<!\\\\)(?:" + "|".join(
+            re.escape(x) for x in [placeholder] + lefts) + ")")
+        rights = {}
+        for left, right in delims:
+            rights.setdefault(
+                left, re.compile("(?<!\\\\)" + re.escape(right)))
+        _scanners[key] = (left_re, rights)
+    return _scanners[key]
+
+
+def sanitizeAll(string, delims=MATH_DELIMS, placeholder="$0$"):
+    """Like sanitizeInput, but strips out the math for all the given (left, right) delimiter pairs in a single pass over the string, instead of one pass per pair.  Each math block is replaced by the placeholder, and the returned list of codeblocks contains the blocks including their delimiters, so reconstructAll can put them back in one pass too.
+
+    Pre-existing instances of the placeholder are kept, with themselves as codeblock.  A left delimiter without a matching right delimiter is left alone as ordinary text."""
+    if placeholder not in _safe_placeholders:
+        _safe_placeholders[placeholder] = markdown_safe(placeholder)
+    if not _safe_placeholders[placeholder]:
+        raise ValueError("Placeholder %s altered by markdown processing." %
+                         placeholder)
+    left_re, rights = _scanner(delims, placeholder)
+    pieces = []
+    codeblocks = []
+    post = 0
+    pos = 0
+    while True:
+        left = left_re.search(string, pos)
+        if left is None:
+            break
+        if left.group() == placeholder:
+            end = left.end()
+        else:
+            right = rights[left.group()].search(string, left.end())
+            if right is None:
+                #Unterminated, so not math; carry on right after it.
+                pos = left.end()
+                continue
+            end = right.end()
+        pieces.append(string[post:left.start()])
+        pieces.append(placeholder)
+        codeblocks.append(string[left.start():end])
+        post = pos = end
+    pieces.append(string[post:])
+    return ("".join(pieces), codeblocks)
+
+
+def reconstructAll(processedString, codeblocks, placeholder="$0$"):
+    """The inverse of sanitizeAll: replace the placeholders in processedString (usually the output of markdown) by the codeblocks, in order and in a single pass.  Extra placeholders are left alone."""
+    placeholder_re = re.compile("(?<!\\\\)" + re.escape(placeholder))
+    blocks = iter(codeblocks)
+    return placeholder_re.sub(lambda m: next(blocks, m.group()),
+                              processedString)
+
+
 def findBoundaries(string):
     """A depricated function.  Finds the location of string boundaries in a stupid way."""
     last = ''
@@ -380,33 +380,14 @@ class Parser(HTMLParser):
 
 
 def sanitize_math_input(s):
-    from .markdown2Mathjax import sanitizeInput
-    # it's critical that $$ be first!
-    delims = [('$$', '$$'), ('\\(', '\\)'), ('\\[', '\\]'),
-              ('\\begin{equation}', '\\end{equation}'),
-              ('\\begin{equation*}', '\\end{equation*}'),
-              ('\\begin{align}', '\\end{align}'),
-              ('\\begin{align*}', '\\end{align*}'),
-              ('\\begin{eqnarray}', '\\end{eqnarray}'),
-              ('\\begin{eqnarray*}', '\\end{eqnarray*}'),
-              ('\\begin{math}', '\\end{math}'),
-              ('\\begin{displaymath}', '\\end{displaymath}')]
-
-    tmp = [((s, None), None)]
-    for d in delims:
-        tmp.append((sanitizeInput(tmp[-1][0][0], equation_delims=d), d))
-
-    return tmp
+    from .markdown2Mathjax import sanitizeAll
+    # all math delimiters in one pass; $$ takes precedence over $
+    return sanitizeAll(s)
 
 
 def reconstruct_math(s, tmp):
-    print("s ='%r'" % s)
-    print("tmp = '%r'" % tmp)
-    from .markdown2Mathjax import reconstructMath
-    while len(tmp) > 1:
-        s = reconstructMath(s, tmp[-1][0][1], equation_delims=tmp[-1][1])
-        del tmp[-1]
-    return s
+    from .markdown2Mathjax import reconstructAll
+    return reconstructAll(s, tmp[1])
 
 
 def texifyHTML(s):
@@ -432,11 +413,23 @@ def html2tex(doc, cmds):
     # number is assumed to indicate that we're outside of math and thus need to
     # escape.
     parser.dollars_found = 0
-    parser.feed(tmp[-1][0][0])
+    parser.feed(tmp[0])
     return reconstruct_math(parser.result, tmp)
 
 
+_md2html_cache = None
+
+
 def md2html(s):
+    # documents often repeat the same markdown, e.g., in %md cells that are
+    # evaluated several times, so remember the most recent results.
+    global _md2html_cache
+    if _md2html_cache is None:
+        from smc_sagews.sage_parsing import LRUCache
+        _md2html_cache = LRUCache(256)
+    html = _md2html_cache.get(s)
+    if html is not None:
+        return html
     from markdown2 import markdown
     extras = [
         'code-friendly', 'footnotes', 'smarty-pants', 'wiki-tables',
@@ -444,8 +437,10 @@ def md2html(s):
     ]
 
     tmp = sanitize_math_input(s)
-    markedDownText = markdown(tmp[-1][0][0], extras=extras)
-    return reconstruct_math(markedDownText, tmp)
+    markedDownText = markdown(tmp[0], extras=extras)
+    html = reconstruct_math(markedDownText, tmp)
+    _md2html_cache[s] = html
+    return html
 
 
 def md2tex(doc, cmds):
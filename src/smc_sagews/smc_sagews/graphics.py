@@ -21,7 +21,8 @@
 
 from __future__ import absolute_import
 
-import json, math
+import itertools, json, math, struct, zlib
+import numpy
 from . import sage_salvus
 
 from uuid import uuid4
@@ -61,8 +62,225 @@ def jsonable(x):
     return x
 
 
-def graphics3d_to_jsonable(p):
+def transform_matrix(T):
+    """
+    Return the 4x4 matrix of the Transformation ``T`` as a numpy array,
+    so it can be applied to all vertices of a surface at once.
+    """
+    return numpy.array(T.get_matrix().list(), dtype=float).reshape(4, 4)
+
+
+def vertex_array(p, T=None):
+    """
+    Return the vertices of the IndexFaceSet ``p`` as an (n,3) float array,
+    transformed by ``T`` if it is given.
+    """
+    v = numpy.array(p.vertex_list(), dtype=float).reshape(-1, 3)
+    if T is not None:
+        M = transform_matrix(T)
+        v = v.dot(M[:3, :3].T) + M[:3, 3]
+    return v
+
+
+def triangle_array(faces):
+    """
+    Return the polygonal ``faces`` (lists of 0-based vertex indices, as
+    returned by ``IndexFaceSet.index_faces()``) as an (m,3) array of
+    triangles.  A face with k vertices is split into a fan of k-2 triangles,
+    exactly as the browser client does it.
+    """
+    lens = numpy.fromiter((len(f) for f in faces), dtype=numpy.int64,
+                          count=len(faces))
+    if len(lens) == 0:
+        return numpy.zeros((0, 3), dtype=numpy.uint32)
+    flat = numpy.fromiter(itertools.chain.from_iterable(faces),
+                          dtype=numpy.uint32,
+                          count=int(lens.sum()))
+    starts = numpy.cumsum(lens) - lens
+    triangles = []
+    for k in numpy.unique(lens):
+        if k < 3:
+            continue
+        s = starts[lens == k]
+        # fan: (v0, v_i, v_{i+1}) for i = 1, ..., k-2
+        i = numpy.arange(1, k - 1)
+        tri = numpy.empty((len(s), k - 2, 3), dtype=numpy.uint32)
+        tri[:, :, 0] = flat[s][:, None]
+        tri[:, :, 1] = flat[s[:, None] + i]
+        tri[:, :, 2] = flat[s[:, None] + i + 1]
+        triangles.append(tri.reshape(-1, 3))
+    if not triangles:
+        return numpy.zeros((0, 3), dtype=numpy.uint32)
+    return numpy.concatenate(triangles)
+
+
+def decimate(vertices, triangles, max_faces):
+    """
+    Reduce the mesh given by the (n,3) float array ``vertices`` and the
+    (m,3) array ``triangles`` to at most ``max_faces`` triangles by vertex
+    clustering: all vertices in the same cell of a uniform grid over the
+    bounding box are merged into their mean, and triangles that become
+    degenerate or duplicated are dropped.  The grid is refined or coarsened
+    until the result fits.  Returns the new (vertices, triangles).
+    """
+    max_faces = int(max_faces)
+    if len(triangles) <= max_faces:
+        return vertices, triangles
+    if max_faces <= 0:
+        return vertices[:0], triangles[:0]
+    v = numpy.array(vertices, dtype=float)
+    v[~numpy.isfinite(v)] = 0
+    lo = v.min(axis=0)
+    extent = v.max(axis=0) - lo
+    extent[extent == 0] = 1
+    # a surface cut by an r x r x r grid has on the order of 2*r^2 triangles
+    r = max(1, int(math.sqrt(max_faces / 2.0)))
+    best = None
+    for _ in range(8):
+        cell = numpy.minimum((v - lo) / extent * r, r - 1).astype(numpy.int64)
+        key = (cell[:, 0] * r + cell[:, 1]) * r + cell[:, 2]
+        keys, cluster = numpy.unique(key, return_inverse=True)
+        cluster = cluster.reshape(-1)
+        t = cluster[triangles]
+        t = t[(t[:, 0] != t[:, 1]) & (t[:, 1] != t[:, 2]) &
+              (t[:, 0] != t[:, 2])]
+        # the same triangle can arise from many cells; keep one, in its
+        # original orientation
+        s = numpy.sort(t, axis=1).astype(numpy.int64)
+        n = len(keys)
+        i = numpy.unique((s[:, 0] * n + s[:, 1]) * n + s[:, 2],
+                         return_index=True)[1]
+        t = t[numpy.sort(i)]
+        if len(t) <= max_faces:
+            best = (cluster, n, t)
+            if len(t) > .8 * max_faces or r == 1:
+                break
+            r = max(r + 1, int(r * math.sqrt(max_faces / float(len(t)))))
+        elif r == 1:
+            break
+        else:
+            r = min(r - 1, int(r * math.sqrt(max_faces / float(len(t)))))
+            r = max(r, 1)
+    if best is None:
+        return vertices[:0], triangles[:0]
+    cluster, n, t = best
+    count = numpy.bincount(cluster, minlength=n).astype(float)
+    w = numpy.empty((n, 3))
+    for j in range(3):
+        w[:, j] = numpy.bincount(cluster, weights=v[:, j], minlength=n) / count
+    return w, t.astype(triangles.dtype)
+
+
+def encode_array(a, dtype, buffers):
+    """
+    Append the little-endian bytes of the numpy array ``a`` as ``dtype``
+    ('float32' or 'uint32') to the list ``buffers``, for use in a binary
+    sage3d container (see :func:`sage3d_container`), and return a JSON-able
+    description of the typed array that refers to it by index.  Non-finite
+    floats become 0.
+    """
+    a = numpy.array(a, dtype='<f4' if dtype == 'float32' else '<u4')
+    if dtype == 'float32':
+        a[~numpy.isfinite(a)] = 0
+    desc = {'dtype': dtype, 'length': int(a.size), 'buffer': len(buffers)}
+    buffers.append(a.tobytes())
+    return desc
+
+
+def vertex_list(v):
+    """
+    Return the (n,3) float array ``v`` as a flat list of floats, with None
+    for non-finite values, as in the JSON text format.
+    """
+    v = numpy.asarray(v, dtype=float).astype(object)
+    v[~numpy.isfinite(v.astype(float))] = None
+    return v.ravel().tolist()
+
+
+SAGE3D_MAGIC = b'SAGE3D01'
+
+
+def sage3d_container(scene, buffers, compress=True):
+    """
+    Pack a 3d ``scene`` whose typed arrays were collected into ``buffers``
+    (by ``graphics3d_to_jsonable(g, buffers=buffers)``) into the binary
+    .sage3d format, and return it as bytes.  The layout is:
+
+    - the 8 bytes ``SAGE3D01``
+    - the length of the header, as a little-endian uint32
+    - the header: JSON ``{"scene":..., "buffers":[{"offset":..,
+      "length":..}, ...], "compression":"zlib" or null}``, padded with
+      spaces to a multiple of 4 bytes
+    - the body: all buffers, each starting at a multiple of 4 bytes, and
+      zlib compressed as a whole if compression is set; offsets are
+      relative to the uncompressed body.
+
+    A JSON scene always starts with ``{``, so clients can tell both
+    formats apart from the first byte.
+    """
+    body = []
+    index = []
+    offset = 0
+    for b in buffers:
+        pad = -len(b) % 4
+        index.append({'offset': offset, 'length': len(b)})
+        body.append(b)
+        if pad:
+            body.append(b'\0' * pad)
+        offset += len(b) + pad
+    body = b''.join(body)
+    if compress:
+        body = zlib.compress(body)
+    header = json.dumps(
+        {
+            'scene': scene,
+            'buffers': index,
+            'compression': 'zlib' if compress else None
+        },
+        separators=(',', ':')).encode('utf8')
+    header += b' ' * (-len(header) % 4)
+    return b''.join(
+        [SAGE3D_MAGIC,
+         struct.pack('<I', len(header)), header, body])
+
+
+# surfaces are never decimated to fewer triangles than this
+MIN_FACES = 200
+
+
+def face_budgets(sizes, max_faces, min_faces=MIN_FACES):
+    """
+    Return the number of triangles each of the meshes with the given
+    numbers of triangles may keep, so that there are about ``max_faces``
+    in total.  Meshes smaller than their fair share keep all of theirs;
+    the rest of the budget is split evenly among the others, each
+    keeping at least ``min_faces``.
+    """
+    budgets = list(sizes)
+    remaining = max_faces
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    for k, i in enumerate(order):
+        share = remaining // (len(order) - k)
+        if sizes[i] > share:
+            budgets[i] = min(sizes[i], max(share, min_faces))
+        remaining = max(0, remaining - budgets[i])
+    return budgets
+
+
+def graphics3d_to_jsonable(p, buffers=None, max_faces=None):
+    """
+    Convert the Sage 3d graphics object ``p`` to a list of JSON-able objects
+    for the browser client.  If ``buffers`` is a list, the vertex and face
+    arrays of surfaces are appended to it, for packing into a binary
+    container with :func:`sage3d_container`.  Otherwise they are lists of
+    floats and of 1-based vertex indices, as old clients expect.
+
+    If ``max_faces`` is given, surfaces are decimated with :func:`decimate`
+    so that the scene has at most about that many triangles; small
+    surfaces are left alone (see :func:`face_budgets`).
+    """
     obj_list = []
+    meshes = []  # (myobj, vertices, triangles, faces), encoded at the end
 
     def parse_obj(obj):
         material_name = ''
@@ -218,16 +436,30 @@ def graphics3d_to_jsonable(p):
     # Conversion functions
     #####################################
 
+    def add_extra_kwds(p, myobj):
+        for e in ['wireframe', 'mesh']:
+            if p._extra_kwds is not None:
+                v = p._extra_kwds.get(e, None)
+                if v is not None:
+                    myobj[e] = jsonable(v)
+
     def convert_index_face_set(p, T, extra_kwds):
+        if isinstance(p, sage.plot.plot3d.index_face_set.IndexFaceSet):
+            if hasattr(p, 'triangulate'):
+                # parametric surfaces only compute their faces on demand
+                p.triangulate()
+            if hasattr(p, 'has_local_colors') and p.has_local_colors():
+                convert_index_face_set_with_colors(p, T, extra_kwds)
+            else:
+                convert_index_face_set_arrays(p, T, extra_kwds)
+            return
+        # Some other primitive; go through its Wavefront obj representation.
         if T is not None:
             p = p.transform(T=T)
-        face_geometry = parse_obj(p.obj())
-        if hasattr(p, 'has_local_colors') and p.has_local_colors():
-            convert_index_face_set_with_colors(p, T, extra_kwds)
-            return
+        obj = p.obj()
+        face_geometry = parse_obj(obj)
         material = parse_mtl(p)
         vertex_geometry = []
-        obj = p.obj()
         for item in obj.split("\n"):
             if "v" in item:
                 tmp = str(item.strip())
@@ -243,12 +475,24 @@ def graphics3d_to_jsonable(p):
             "material": material,
             "has_local_colors": 0
         }
-        for e in ['wireframe', 'mesh']:
-            if p._extra_kwds is not None:
-                v = p._extra_kwds.get(e, None)
-                if v is not None:
-                    myobj[e] = jsonable(v)
+        add_extra_kwds(p, myobj)
+        obj_list.append(myobj)
+
+    def convert_index_face_set_arrays(p, T, extra_kwds):
+        # Vertices and faces are pulled straight out of the IndexFaceSet and
+        # shipped as flat typed arrays, rather than going through p.obj().
+        myobj = {
+            "face_geometry": [{
+                "material_name": p.texture.id
+            }],
+            "type": 'index_face_set',
+            "material": parse_mtl(p),
+            "has_local_colors": 0
+        }
+        add_extra_kwds(p, myobj)
         obj_list.append(myobj)
+        faces = p.index_faces()
+        meshes.append((myobj, vertex_array(p, T), triangle_array(faces), faces))
 
     def convert_index_face_set_with_colors(p, T, extra_kwds):
         face_geometry = [{
@@ -258,19 +502,14 @@ def graphics3d_to_jsonable(p):
                       for f in p.index_faces_with_colors()]
         }]
         material = parse_mtl(p)
-        vertex_geometry = [json_float(t) for v in p.vertices() for t in v]
         myobj = {
             "face_geometry": face_geometry,
             "type": 'index_face_set',
-            "vertex_geometry": vertex_geometry,
+            "vertex_geometry": vertex_list(vertex_array(p, T)),
             "material": material,
             "has_local_colors": 1
         }
-        for e in ['wireframe', 'mesh']:
-            if p._extra_kwds is not None:
-                v = p._extra_kwds.get(e, None)
-                if v is not None:
-                    myobj[e] = jsonable(v)
+        add_extra_kwds(p, myobj)
         obj_list.append(myobj)
 
     def convert_text3d(p, T, extra_kwds):
@@ -352,6 +591,23 @@ def graphics3d_to_jsonable(p):
     # start it going -- this modifies obj_list
     handler(p)(p, None, None)
 
+    sizes = [len(t) for _, _, t, _ in meshes]
+    budgets = sizes
+    if max_faces is not None and sum(sizes) > max_faces:
+        budgets = face_budgets(sizes, max_faces)
+    for (myobj, v, t, faces), budget in zip(meshes, budgets):
+        if budget < len(t):
+            v, t = decimate(v, t, budget)
+            faces = t.tolist()
+        if buffers is None:
+            myobj["vertex_geometry"] = vertex_list(v)
+            myobj["face_geometry"][0]["faces"] = [[int(i) + 1 for i in f]
+                                                  for f in faces]
+        else:
+            myobj["vertex_geometry"] = encode_array(v, 'float32', buffers)
+            myobj["face_geometry"][0]["triangles"] = encode_array(
+                t, 'uint32', buffers)
+
     # now obj_list is full of the objects
     return obj_list
 
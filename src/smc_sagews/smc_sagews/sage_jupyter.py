@@ -18,13 +18,34 @@ AUTHORS:
 #########################################################################################
 
 from __future__ import absolute_import
+import collections
+import json
 import os
 import string
 import textwrap
+import time
 import six
 
 salvus = None  # set externally
 
+# set externally, in a worksheet session: function that asks the server
+# process for one of its spare kernels; see sage_server.take_spare_kernel
+take_spare_kernel = None
+
+
+def preload():
+    """
+    Import the modules that _jkmagic needs.  The server process calls this
+    before forking off worksheet sessions, so that they don't have to.
+    Returns False if Jupyter is not installed.
+    """
+    try:
+        import jupyter_client.manager, jupyter_client.blocking
+        import ansi2html
+    except ImportError:
+        return False
+    return True
+
 # jupyter kernel
 
 
@@ -94,6 +115,302 @@ class JUPYTER(object):
 jupyter = JUPYTER()
 
 
+class KernelBroker(object):
+    """
+    Keep warm spare Jupyter kernels in the server process, for the
+    kernelspecs that worksheets used recently.
+
+    A worksheet session asks the server for a kernel when it runs, e.g.,
+    jupyter("python3"); if there is a spare one, the session connects to
+    it instead of starting its own, which takes a few seconds.  Either
+    way, a spare kernel of that kernelspec is started for the next
+    session that asks.  Spare kernels are started in the working directory
+    of the server; a session only gets one if its own working directory is
+    the same, or the kernel's language is in CHDIR.
+
+    The sessions are forked from the server process, so the broker just
+    launches the kernel processes (see _LocalKernel), without the zmq
+    contexts, threads and asyncio event loop of a KernelManager.
+
+    INPUT:
+
+    - ``spares`` -- number of spare kernels to keep for each kernelspec
+    - ``max_kernelspecs`` -- only keep spares for this many of the most
+      recently used kernelspecs
+    - ``max_idle`` -- stop keeping spares for a kernelspec when no session
+      asked for it in this many seconds
+    - ``log`` -- (default: None) function to log messages with
+    """
+
+    # code that changes the working directory of a kernel, by language
+    CHDIR = {
+        'python': 'import os as _os; _os.chdir(%s); del _os',
+        'R': 'setwd(%s)',
+        'julia': 'cd(%s)',
+    }
+
+    def __init__(self, spares=1, max_kernelspecs=2, max_idle=1800, log=None):
+        self.spares = spares
+        self.max_kernelspecs = max_kernelspecs
+        self.max_idle = max_idle
+        self._log = log if log is not None else (lambda *args: None)
+        self._recent = collections.OrderedDict()  # kernel name -> last asked
+        self._spares = {}  # kernel name -> [(_LocalKernel, cwd)]
+        self._taken = {}  # session pid -> [_LocalKernel]
+
+    def take(self, kernel_name, pid, cwd):
+        """
+        Hand a spare kernel of the given kernelspec to the session with the
+        given pid, whose working directory is cwd.  Return its connection
+        info, with some more details about the kernel, or None if there is
+        no suitable spare kernel.
+        """
+        self._recent.pop(kernel_name, None)
+        self._recent[kernel_name] = time.time()
+        while len(self._recent) > self.max_kernelspecs:
+            self._recent.popitem(last=False)
+        spares = self._spares.get(kernel_name, [])
+        for i, (km, km_cwd) in enumerate(spares):
+            try:
+                if not km.is_alive():
+                    continue
+                language = km.kernel_spec.language
+                chdir = None
+                if cwd != km_cwd:
+                    if language not in self.CHDIR:
+                        continue
+                    chdir = self.CHDIR[language] % json.dumps(cwd)
+                info = dict(km.connection_info)
+                if isinstance(info['key'], bytes):
+                    info['key'] = info['key'].decode('ascii')
+                info.update(pid=km.pid,
+                            language=language,
+                            interrupt_mode=km.kernel_spec.interrupt_mode,
+                            chdir=chdir)
+            except Exception as err:
+                self._log("unable to hand out spare %s kernel -- %s" %
+                          (kernel_name, err))
+                continue
+            del spares[i]
+            self._taken.setdefault(pid, []).append(km)
+            self._log("handed spare %s kernel %s to %s" %
+                      (kernel_name, info['pid'], pid))
+            return info
+        return None
+
+    def refill(self):
+        """
+        Start spare kernels for the recently used kernelspecs, shut down
+        those nobody needs anymore, and reap the kernels that exited.
+        """
+        now = time.time()
+        for name, asked in list(self._recent.items()):
+            if now - asked > self.max_idle:
+                del self._recent[name]
+        for name in list(self._spares.keys()):
+            if name not in self._recent:
+                for km, cwd in self._spares.pop(name):
+                    self._shutdown(km)
+        for name in list(self._recent.keys()):
+            spares = []
+            for km, cwd in self._spares.get(name, []):
+                if km.is_alive():
+                    spares.append((km, cwd))
+                else:
+                    self._shutdown(km)
+            while len(spares) < self.spares:
+                km = self._start(name)
+                if km is None:
+                    # don't try again until a session asks for it
+                    del self._recent[name]
+                    break
+                spares.append((km, os.getcwd()))
+            self._spares[name] = spares
+        for pid, kms in list(self._taken.items()):
+            alive = []
+            for km in kms:
+                # is_alive also reaps the kernels that exited
+                if km.is_alive():
+                    alive.append(km)
+                else:
+                    # removes its connection file
+                    self._shutdown(km)
+            if alive:
+                self._taken[pid] = alive
+            else:
+                del self._taken[pid]
+
+    def session_exited(self, pid):
+        """
+        Shut down the kernels handed to the session with given pid, which
+        exited without doing so itself, e.g., since it was killed.
+        """
+        for km in self._taken.pop(pid, []):
+            self._shutdown(km)
+
+    def close_in_child(self):
+        """
+        Forget about all kernels in a freshly forked child; they belong to
+        the server process.
+        """
+        self._spares = {}
+        self._taken = {}
+
+    def close(self):
+        """
+        Shut down all kernels, including those handed to sessions.
+        """
+        for spares in self._spares.values():
+            for km, cwd in spares:
+                self._shutdown(km)
+        for kms in self._taken.values():
+            for km in kms:
+                self._shutdown(km)
+        self.close_in_child()
+
+    def _start(self, kernel_name):
+        try:
+            km = _LocalKernel(kernel_name)
+        except Exception as err:
+            self._log("unable to start spare %s kernel -- %s" %
+                      (kernel_name, err))
+            return None
+        self._log("started spare %s kernel %s" % (kernel_name, km.pid))
+        return km
+
+    def _shutdown(self, km):
+        try:
+            km.shutdown_kernel()
+        except Exception as err:
+            self._log("error shutting down kernel -- %s" % err)
+
+
+class _LocalKernel(object):
+    """
+    A kernel process with the given kernelspec, started like a
+    KernelManager would, but only using a connection file and a
+    subprocess.  The kernel is in a new session, so it is not interrupted
+    along with the server, and exits when the server does.
+    """
+    def __init__(self, kernel_name):
+        import re, sys, uuid
+        import jupyter_client.connect, jupyter_client.kernelspec
+        import jupyter_client.launcher
+        from jupyter_core.paths import jupyter_runtime_dir
+        spec = jupyter_client.kernelspec.get_kernel_spec(kernel_name)
+        self.kernel_spec = spec
+        runtime_dir = jupyter_runtime_dir()
+        if not os.path.isdir(runtime_dir):
+            os.makedirs(runtime_dir)
+        fname = os.path.join(runtime_dir, 'kernel-%s.json' % uuid.uuid4())
+        # the ports are found with plain sockets, not zmq
+        self.connection_file, self.connection_info = \
+            jupyter_client.connect.write_connection_file(
+                fname, kernel_name=kernel_name)
+        ns = {
+            'connection_file': self.connection_file,
+            'prefix': sys.prefix,
+            'resource_dir': spec.resource_dir
+        }
+        cmd = [
+            re.sub(r'\{([A-Za-z0-9_]+)\}',
+                   lambda m: ns.get(m.group(1), m.group(0)), arg)
+            for arg in spec.argv
+        ]
+        if cmd and cmd[0] in ('python', 'python%s' % sys.version_info[0],
+                              'python%s.%s' % sys.version_info[:2]):
+            cmd[0] = sys.executable
+        env = os.environ.copy()
+        env.update(spec.env or {})
+        try:
+            self._proc = jupyter_client.launcher.launch_kernel(cmd, env=env)
+        except Exception:
+            self._remove_connection_file()
+            raise
+        self.pid = self._proc.pid
+
+    def is_alive(self):
+        return self._proc.poll() is None
+
+    def shutdown_kernel(self):
+        import signal
+        if self.is_alive():
+            try:
+                # the kernel leads its own process group; kill its children
+                os.killpg(self.pid, signal.SIGKILL)
+            except OSError:
+                self._proc.kill()
+            self._proc.wait()
+        self._remove_connection_file()
+
+    def _remove_connection_file(self):
+        try:
+            os.unlink(self.connection_file)
+        except OSError:
+            pass
+
+
+class _SpareKernel(object):
+    """
+    Stand-in for the KernelManager of a kernel taken from the spares of the
+    server process, which started the kernel and reaps it.
+    """
+    def __init__(self, kc, info):
+        self._kc = kc
+        self._pid = info['pid']
+        self._interrupt_mode = info.get('interrupt_mode', 'signal')
+
+    def is_alive(self):
+        return self._kc.is_alive()
+
+    def interrupt_kernel(self):
+        if self._interrupt_mode == 'signal':
+            import signal
+            os.kill(self._pid, signal.SIGINT)
+        else:
+            msg = self._kc.session.msg('interrupt_request', content={})
+            self._kc.control_channel.send(msg)
+
+    def shutdown_kernel(self, now=False, restart=False):
+        self._kc.shutdown()
+        if now:
+            import signal
+            try:
+                os.kill(self._pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+def _connect_spare_kernel(kernel_name):
+    """
+    Return (km, kc) for a spare kernel of the server process, or None if
+    there is none.
+    """
+    if take_spare_kernel is None:
+        return None
+    info = take_spare_kernel(kernel_name)
+    if info is None:
+        return None
+    import jupyter_client.blocking
+    kc = jupyter_client.blocking.BlockingKernelClient()
+    kc.load_connection_info(info)
+    kc.start_channels()
+    try:
+        kc.wait_for_ready(timeout=30)
+        if info.get('chdir'):
+            msg_id = kc.execute(info['chdir'],
+                                silent=True,
+                                store_history=False)
+            while kc.get_shell_msg(timeout=30)['parent_header'].get(
+                    'msg_id') != msg_id:
+                pass
+    except Exception:
+        # e.g., it died; the server shuts it down when we exit
+        kc.stop_channels()
+        return None
+    return _SpareKernel(kc, info), kc
+
+
 def _jkmagic(kernel_name, **kwargs):
     r"""
     Called when user issues `my_kernel = jupyter("kernel_name")` from a cell.
@@ -118,8 +435,12 @@ def _jkmagic(kernel_name, **kwargs):
     import sage.misc.latex
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", DeprecationWarning)
-        km, kc = jupyter_client.manager.start_new_kernel(
-            kernel_name=kernel_name)
+        spare = _connect_spare_kernel(kernel_name)
+        if spare is not None:
+            km, kc = spare
+        else:
+            km, kc = jupyter_client.manager.start_new_kernel(
+                kernel_name=kernel_name)
         import atexit
         atexit.register(km.shutdown_kernel)
         atexit.register(kc.hb_channel.close)
@@ -192,202 +513,265 @@ def _jkmagic(kernel_name, **kwargs):
         # until shell execute_reply message is received with status 'ok' or 'error'
         capture_mode = not hasattr(sys.stdout._f, 'im_func')
 
-        # handle iopub messages
-        while True:
-            try:
-                msg = iopub.get_msg()
-                msg_type = msg['msg_type']
-                content = msg['content']
-
-            except Empty:
-                # shouldn't happen
-                p("iopub channel empty")
-                break
-
-            p('iopub', msg_type, str(content)[:300])
-
-            if msg['parent_header'].get('msg_id') != msg_id:
-                p('*** non-matching parent header')
-                continue
-
-            if msg_type == 'status' and content['execution_state'] == 'idle':
-                break
+        def display_mime(msg_data):
+            '''
+            jupyter server does send data dictionaries, that do contain mime-type:data mappings
+            depending on the type, handle them in the salvus API
+            '''
+            # sometimes output is sent in several formats
+            # 1. if there is an image format, prefer that
+            # 2. elif default text or image mode is available, prefer that
+            # 3. else choose first matching format in modes list
+            from smc_sagews.sage_salvus import show
+
+            def show_plot(data, suffix):
+                r"""
+                If an html style is defined for this kernel, use it.
+                Otherwise use salvus.file().
+                """
+                suffix = '.' + suffix
+                fname = tempfile.mkstemp(suffix=suffix)[1]
+                fmode = 'wb' if six.PY3 else 'w'
+                with open(fname, fmode) as fo:
+                    fo.write(data)
+
+                if run_code.smc_image_scaling is None:
+                    salvus.file(fname)
+                else:
+                    img_src = salvus.file(fname, show=False)
+                    # The max-width is because this smc-image-scaling is very difficult
+                    # to deal with when using React to render this on the share server,
+                    # and not scaling down is really ugly.  When the width gets set
+                    # as normal in a notebook, this won't impact anything, but when
+                    # it is displayed on share server (where width is not set) at least
+                    # it won't look like total crap.  See https://github.com/sagemathinc/cocalc/issues/4421
+                    htms = '<img src="{0}" smc-image-scaling="{1}" style="max-width:840px"/>'.format(
+                        img_src, run_code.smc_image_scaling)
+                    salvus.html(htms)
+                os.unlink(fname)
+
+            mkeys = list(msg_data.keys())
+            imgmodes = ['image/svg+xml', 'image/png', 'image/jpeg']
+            txtmodes = [
+                'text/html', 'text/plain', 'text/latex', 'text/markdown'
+            ]
+            if any('image' in k for k in mkeys):
+                dfim = run_code.default_image_fmt
+                #print('default_image_fmt %s'%dfim)
+                dispmode = next((m for m in mkeys if dfim in m), None)
+                if dispmode is None:
+                    dispmode = next(m for m in imgmodes if m in mkeys)
+                #print('dispmode is %s'%dispmode)
+                # https://en.wikipedia.org/wiki/Data_scheme#Examples
+                # <img src="data:image/png;base64,iVBORw0KGgoAAAANSUhEU
+                # <img src='data:image/svg+xml;utf8,<svg ... > ... </svg>'>
+                if dispmode == 'image/svg+xml':
+                    data = msg_data[dispmode]
+                    show_plot(data, 'svg')
+                elif dispmode == 'image/png':
+                    data = base64.standard_b64decode(msg_data[dispmode])
+                    show_plot(data, 'png')
+                elif dispmode == 'image/jpeg':
+                    data = base64.standard_b64decode(msg_data[dispmode])
+                    show_plot(data, 'jpg')
+                return
+            elif any('text' in k for k in mkeys):
+                dftm = run_code.default_text_fmt
+                if capture_mode:
+                    dftm = 'plain'
+                dispmode = next((m for m in mkeys if dftm in m), None)
+                if dispmode is None:
+                    dispmode = next(m for m in txtmodes if m in mkeys)
+                if dispmode == 'text/plain':
+                    p('text/plain', msg_data[dispmode])
+                    # override if plain text is object marker for latex output
+                    if re.match(r'<IPython.core.display.\w+ object>',
+                                msg_data[dispmode]):
+                        p("overriding plain -> latex")
+                        show(msg_data['text/latex'])
+                    else:
+                        txt = re.sub(r"^\[\d+\] ", "", msg_data[dispmode])
+                        hout(txt)
+                elif dispmode == 'text/html':
+                    salvus.html(msg_data[dispmode])
+                elif dispmode == 'text/latex':
+                    p('text/latex', msg_data[dispmode])
+                    sage.misc.latex.latex.eval(msg_data[dispmode])
+                elif dispmode == 'text/markdown':
+                    salvus.md(msg_data[dispmode])
+                return
+
+        def iopub_messages():
+            """
+            Yield the iopub messages in reply to our request, except for
+            stream output: consecutive chunks of it are merged and written
+            at most every run_code.flush_interval seconds, so a kernel that
+            prints many lines doesn't produce an output message for each.
+            """
+            # chunks are merged while they go to the same stream, and either
+            # all or none of them need to be converted from ANSI to HTML
+            stream = {'kind': None, 'chunks': [], 'flushed': time.time()}
+
+            def flush():
+                if stream['chunks']:
+                    s = ''.join(stream['chunks'])
+                    del stream['chunks'][:]
+                    # bash kernel uses stream messages with output in 'text' field
+                    # might be ANSI color-coded
+                    if stream['kind'][0] == 'stderr':
+                        hout(s, error=True)
+                    else:
+                        hout(s, block=False)
+                stream['flushed'] = time.time()
 
-            def display_mime(msg_data):
-                '''
-                jupyter server does send data dictionaries, that do contain mime-type:data mappings
-                depending on the type, handle them in the salvus API
-                '''
-                # sometimes output is sent in several formats
-                # 1. if there is an image format, prefer that
-                # 2. elif default text or image mode is available, prefer that
-                # 3. else choose first matching format in modes list
-                from smc_sagews.sage_salvus import show
-
-                def show_plot(data, suffix):
-                    r"""
-                    If an html style is defined for this kernel, use it.
-                    Otherwise use salvus.file().
-                    """
-                    suffix = '.' + suffix
-                    fname = tempfile.mkstemp(suffix=suffix)[1]
-                    fmode = 'wb' if six.PY3 else 'w'
-                    with open(fname, fmode) as fo:
-                        fo.write(data)
-
-                    if run_code.smc_image_scaling is None:
-                        salvus.file(fname)
+            try:
+                while True:
+                    if stream['chunks']:
+                        timeout = max(
+                            0, stream['flushed'] + run_code.flush_interval -
+                            time.time())
                     else:
-                        img_src = salvus.file(fname, show=False)
-                        # The max-width is because this smc-image-scaling is very difficult
-                        # to deal with when using React to render this on the share server,
-                        # and not scaling down is really ugly.  When the width gets set
-                        # as normal in a notebook, this won't impact anything, but when
-                        # it is displayed on share server (where width is not set) at least
-                        # it won't look like total crap.  See https://github.com/sagemathinc/cocalc/issues/4421
-                        htms = '<img src="{0}" smc-image-scaling="{1}" style="max-width:840px"/>'.format(
-                            img_src, run_code.smc_image_scaling)
-                        salvus.html(htms)
-                    os.unlink(fname)
-
-                mkeys = list(msg_data.keys())
-                imgmodes = ['image/svg+xml', 'image/png', 'image/jpeg']
-                txtmodes = [
-                    'text/html', 'text/plain', 'text/latex', 'text/markdown'
-                ]
-                if any('image' in k for k in mkeys):
-                    dfim = run_code.default_image_fmt
-                    #print('default_image_fmt %s'%dfim)
-                    dispmode = next((m for m in mkeys if dfim in m), None)
-                    if dispmode is None:
-                        dispmode = next(m for m in imgmodes if m in mkeys)
-                    #print('dispmode is %s'%dispmode)
-                    # https://en.wikipedia.org/wiki/Data_scheme#Examples
-                    # <img src="data:image/png;base64,iVBORw0KGgoAAAANSUhEU
-                    # <img src='data:image/svg+xml;utf8,<svg ... > ... </svg>'>
-                    if dispmode == 'image/svg+xml':
-                        data = msg_data[dispmode]
-                        show_plot(data, 'svg')
-                    elif dispmode == 'image/png':
-                        data = base64.standard_b64decode(msg_data[dispmode])
-                        show_plot(data, 'png')
-                    elif dispmode == 'image/jpeg':
-                        data = base64.standard_b64decode(msg_data[dispmode])
-                        show_plot(data, 'jpg')
-                    return
-                elif any('text' in k for k in mkeys):
-                    dftm = run_code.default_text_fmt
-                    if capture_mode:
-                        dftm = 'plain'
-                    dispmode = next((m for m in mkeys if dftm in m), None)
-                    if dispmode is None:
-                        dispmode = next(m for m in txtmodes if m in mkeys)
-                    if dispmode == 'text/plain':
-                        p('text/plain', msg_data[dispmode])
-                        # override if plain text is object marker for latex output
-                        if re.match(r'<IPython.core.display.\w+ object>',
-                                    msg_data[dispmode]):
-                            p("overriding plain -> latex")
-                            show(msg_data['text/latex'])
+                        # wake up now and then, so interrupts are noticed
+                        timeout = 0.5
+                    try:
+                        batch = [iopub.get_msg(timeout=timeout)]
+                    except Empty:
+                        flush()
+                        continue
+                    while iopub.msg_ready():
+                        batch.append(iopub.get_msg())
+                    for msg in batch:
+                        p('iopub', msg['msg_type'], str(msg['content'])[:300])
+                        if msg['parent_header'].get('msg_id') != msg_id:
+                            p('*** non-matching parent header')
+                            continue
+                        content = msg['content']
+                        if msg['msg_type'] == 'stream' and 'text' in content:
+                            kind = (content.get('name'), "\x1b[" in content['text'])
+                            if kind != stream['kind']:
+                                flush()
+                                stream['kind'] = kind
+                            stream['chunks'].append(content['text'])
                         else:
-                            txt = re.sub(r"^\[\d+\] ", "", msg_data[dispmode])
-                            hout(txt)
-                    elif dispmode == 'text/html':
-                        salvus.html(msg_data[dispmode])
-                    elif dispmode == 'text/latex':
-                        p('text/latex', msg_data[dispmode])
-                        sage.misc.latex.latex.eval(msg_data[dispmode])
-                    elif dispmode == 'text/markdown':
-                        salvus.md(msg_data[dispmode])
-                    return
-
-            # reminder of iopub loop is switch on value of msg_type
-
-            if msg_type == 'execute_input':
-                # the following is a cheat to avoid forking a separate thread to listen on stdin channel
-                # most of the time, ignore "execute_input" message type
-                # but if code calls python3 input(), wait for message on stdin channel
-                if 'code' in content:
-                    ccode = content['code']
-                    if kernel_name.startswith(
-                        ('python', 'anaconda', 'octave')) and re.match(
-                            r'^[^#]*\W?input\(', ccode):
-                        # FIXME input() will be ignored if it's aliased to another name
-                        p('iopub input call: ', ccode)
-                        try:
-                            # do nothing if no messsage on stdin channel within 0.5 sec
-                            imsg = stdinj.get_msg(timeout=0.5)
-                            imsg_type = imsg['msg_type']
-                            icontent = imsg['content']
-                            p('stdin', imsg_type, str(icontent)[:300])
-                            # kernel is now blocked waiting for input
-                            if imsg_type == 'input_request':
-                                prompt = '' if icontent[
-                                    'password'] else icontent['prompt']
-                                value = salvus.raw_input(prompt=prompt)
-                                xcontent = dict(value=value)
-                                xmsg = kc.session.msg('input_reply', xcontent)
-                                p('sending input_reply', xcontent)
-                                stdinj.send(xmsg)
-                        except:
-                            pass
-                    elif kernel_name == 'octave' and re.search(
-                            r"\s*pause\s*([#;\n].*)?$", ccode, re.M):
-                        # FIXME "1+2\npause\n3+4" pauses before executing any code
-                        # would need block parser here
-                        p('iopub octave pause: ', ccode)
-                        try:
-                            # do nothing if no messsage on stdin channel within 0.5 sec
-                            imsg = stdinj.get_msg(timeout=0.5)
-                            imsg_type = imsg['msg_type']
-                            icontent = imsg['content']
-                            p('stdin', imsg_type, str(icontent)[:300])
-                            # kernel is now blocked waiting for input
-                            if imsg_type == 'input_request':
-                                prompt = "Paused, enter any value to continue"
-                                value = salvus.raw_input(prompt=prompt)
-                                xcontent = dict(value=value)
-                                xmsg = kc.session.msg('input_reply', xcontent)
-                                p('sending input_reply', xcontent)
-                                stdinj.send(xmsg)
-                        except:
-                            pass
-            elif msg_type == 'execute_result':
-                if not 'data' in content:
-                    continue
-                p('execute_result data keys: ', list(content['data'].keys()))
-                display_mime(content['data'])
+                            # keep the output in order
+                            flush()
+                            yield msg
+                    if time.time() - stream['flushed'] >= run_code.flush_interval:
+                        flush()
+            finally:
+                flush()
+
+        def interrupt():
+            # stop the kernel too, not just waiting for it, and wait a bit
+            # until it is done, since it drops requests it gets while
+            # handling the error
+            try:
+                km.interrupt_kernel()
+                deadline = time.time() + 5
+                while True:
+                    msg = iopub.get_msg(timeout=max(0, deadline - time.time()))
+                    content = msg['content']
+                    if (msg['parent_header'].get('msg_id') == msg_id
+                            and msg['msg_type'] == 'status'
+                            and content['execution_state'] == 'idle'):
+                        break
+            except Exception as err:
+                p('unable to interrupt kernel', err)
 
-            elif msg_type == 'display_data':
-                if 'data' in content:
-                    display_mime(content['data'])
+        # handle iopub messages
+        messages = iopub_messages()
+        try:
+            for msg in messages:
+                msg_type = msg['msg_type']
+                content = msg['content']
 
-            elif msg_type == 'status':
-                if content['execution_state'] == 'idle':
-                    # when idle, kernel has executed all input
+                if msg_type == 'status' and content['execution_state'] == 'idle':
                     break
 
-            elif msg_type == 'clear_output':
-                salvus.clear()
+                # reminder of iopub loop is switch on value of msg_type
+
+                if msg_type == 'execute_input':
+                    # the following is a cheat to avoid forking a separate thread to listen on stdin channel
+                    # most of the time, ignore "execute_input" message type
+                    # but if code calls python3 input(), wait for message on stdin channel
+                    if 'code' in content:
+                        ccode = content['code']
+                        if kernel_name.startswith(
+                            ('python', 'anaconda', 'octave')) and re.match(
+                                r'^[^#]*\W?input\(', ccode):
+                            # FIXME input() will be ignored if it's aliased to another name
+                            p('iopub input call: ', ccode)
+                            try:
+                                # do nothing if no messsage on stdin channel within 0.5 sec
+                                imsg = stdinj.get_msg(timeout=0.5)
+                                imsg_type = imsg['msg_type']
+                                icontent = imsg['content']
+                                p('stdin', imsg_type, str(icontent)[:300])
+                                # kernel is now blocked waiting for input
+                                if imsg_type == 'input_request':
+                                    prompt = '' if icontent[
+                                        'password'] else icontent['prompt']
+                                    value = salvus.raw_input(prompt=prompt)
+                                    xcontent = dict(value=value)
+                                    xmsg = kc.session.msg('input_reply', xcontent)
+                                    p('sending input_reply', xcontent)
+                                    stdinj.send(xmsg)
+                            except:
+                                pass
+                        elif kernel_name == 'octave' and re.search(
+                                r"\s*pause\s*([#;\n].*)?$", ccode, re.M):
+                            # FIXME "1+2\npause\n3+4" pauses before executing any code
+                            # would need block parser here
+                            p('iopub octave pause: ', ccode)
+                            try:
+                                # do nothing if no messsage on stdin channel within 0.5 sec
+                                imsg = stdinj.get_msg(timeout=0.5)
+                                imsg_type = imsg['msg_type']
+                                icontent = imsg['content']
+                                p('stdin', imsg_type, str(icontent)[:300])
+                                # kernel is now blocked waiting for input
+                                if imsg_type == 'input_request':
+                                    prompt = "Paused, enter any value to continue"
+                                    value = salvus.raw_input(prompt=prompt)
+                                    xcontent = dict(value=value)
+                                    xmsg = kc.session.msg('input_reply', xcontent)
+                                    p('sending input_reply', xcontent)
+                                    stdinj.send(xmsg)
+                            except:
+                                pass
+                elif msg_type == 'execute_result':
+                    if not 'data' in content:
+                        continue
+                    p('execute_result data keys: ', list(content['data'].keys()))
+                    display_mime(content['data'])
 
-            elif msg_type == 'stream':
-                if 'text' in content:
-                    # bash kernel uses stream messages with output in 'text' field
-                    # might be ANSI color-coded
-                    if 'name' in content and content['name'] == 'stderr':
-                        hout(content['text'], error=True)
-                    else:
-                        hout(content['text'], block=False)
-
-            elif msg_type == 'error':
-                # XXX look for ename and evalue too?
-                if 'traceback' in content:
-                    tr = content['traceback']
-                    if isinstance(tr, list):
-                        for tr in content['traceback']:
-                            hout(tr + '\n', error=True)
-                    else:
-                        hout(tr, error=True)
+                elif msg_type == 'display_data':
+                    if 'data' in content:
+                        display_mime(content['data'])
+
+                elif msg_type == 'status':
+                    if content['execution_state'] == 'idle':
+                        # when idle, kernel has executed all input
+                        break
+
+                elif msg_type == 'clear_output':
+                    salvus.clear()
+
+                elif msg_type == 'error':
+                    # XXX look for ename and evalue too?
+                    if 'traceback' in content:
+                        tr = content['traceback']
+                        if isinstance(tr, list):
+                            for tr in content['traceback']:
+                                hout(tr + '\n', error=True)
+                        else:
+                            hout(tr, error=True)
+        except KeyboardInterrupt:
+            interrupt()
+            raise
+        finally:
+            # writes the stream output that is still buffered
+            messages.close()
 
         # handle shell messages
         while True:
@@ -429,6 +813,9 @@ def _jkmagic(kernel_name, **kwargs):
     # set True to record jupyter messages to sage_server log
     run_code.debug = False
 
+    # write stream output (stdout, stderr) at most this often, in seconds
+    run_code.flush_interval = 0.1
+
     # allow `anaconda.jupyter_kernel.kernel_name` etc.
     run_code.kernel_name = kernel_name
 
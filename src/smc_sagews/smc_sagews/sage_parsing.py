@@ -13,7 +13,9 @@ Code for parsing Sage code blocks sensibly.
 #########################################################################################
 
 from __future__ import absolute_import
+import collections
 import string
+import sys
 import traceback
 import __future__ as future
 import ast
@@ -92,9 +94,71 @@ def get_input(prompt):
 #    return code
 
 
+class LRUCache(object):
+    """
+    A dict-like cache that keeps at most size entries, dropping the least
+    recently used one first, and counts its hits and misses.
+
+    INPUT:
+
+    - ``size`` -- maximum number of entries
+    - ``on_evict`` -- (default: None) function called with each value that
+      is dropped from the cache
+    """
+
+    def __init__(self, size, on_evict=None):
+        self.size = size
+        self.on_evict = on_evict
+        self.hits = self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """
+        Return the value for key, or None if it is not cached.
+        """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            del self._data[key]
+        elif len(self._data) >= self.size:
+            old = self._data.popitem(last=False)[1]
+            if self.on_evict is not None:
+                self.on_evict(old)
+        self._data[key] = value
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+
+# Preparsing the same blocks over and over (interacts!) is a waste of
+# time.  The output only depends on the code and the implicit
+# multiplication level, but the preparse function is part of the key too,
+# in case it gets replaced.
+PREPARSE_CACHE_SIZE = 1024
+preparse_cache = LRUCache(PREPARSE_CACHE_SIZE)
+
+
 def preparse_code(code):
     import sage.all_cmdline
-    return sage.all_cmdline.preparse(code, ignore_prompts=True)
+    preparse = sage.all_cmdline.preparse
+    preparser = sys.modules.get('sage.repl.preparse')
+    key = (code, preparse, getattr(preparser, 'implicit_mul_level', None))
+    result = preparse_cache.get(key)
+    if result is None:
+        result = preparse(code, ignore_prompts=True)
+        preparse_cache[key] = result
+    return result
 
 
 def strip_string_literals(code, state=None):
@@ -189,17 +253,98 @@ def end_of_expr(s):
     return i
 
 
-# NOTE/TODO: The dec_args dict will leak memory over time.  However, it only
-# contains code that was entered, so it should never get big.  It
-# seems impossible to know for sure whether a bit of code will be
-# eventually needed later, so this leakiness seems necessary.
-dec_counter = 0
-dec_args = {}
+class DecoratorArgs(object):
+    """
+    The arguments of the salvus.execute_with_code_decorators calls that
+    divide_into_blocks puts in place of %decorator lines, by key.
+
+    Entries are reference counted.  The cache of divided cells holds a
+    reference for as long as it keeps the cell, and Salvus.execute holds one
+    while it runs the blocks (see hold_blocks).  An entry is deleted when its
+    last reference is released, so the store is bounded by the size of the
+    cache plus whatever is running right now.
+    """
+
+    def __init__(self):
+        self._args = {}
+        self._refs = {}
+        self._counter = 0
+
+    def __getitem__(self, key):
+        return self._args[key]
+
+    def __contains__(self, key):
+        return key in self._args
+
+    def __len__(self):
+        return len(self._args)
+
+    def add(self, args):
+        """
+        Store args and return its key; the entry starts without references.
+        """
+        key = self._counter
+        self._counter += 1
+        self._args[key] = args
+        self._refs[key] = 0
+        return key
+
+    def acquire(self, keys):
+        for key in keys:
+            self._refs[key] += 1
+
+    def release(self, keys):
+        for key in keys:
+            self._refs[key] -= 1
+            if self._refs[key] <= 0:
+                del self._refs[key]
+                del self._args[key]
+
+
+dec_args = DecoratorArgs()
 
 
 # Divide the input code (a string) into blocks of code.
+#
+# Cells are re-run unchanged all the time (e.g., every time an interact
+# control changes), so the result for the most recently divided cells is
+# cached, along with the keys of the dec_args entries their blocks use.
+DIVIDE_CACHE_SIZE = 256
+divide_cache = LRUCache(DIVIDE_CACHE_SIZE,
+                        on_evict=lambda entry: dec_args.release(entry[1]))
+
+
+def _divide_cached(code):
+    entry = divide_cache.get(code)
+    if entry is None:
+        blocks, keys = _divide_into_blocks(code)
+        entry = (tuple(tuple(block) for block in blocks), tuple(keys))
+        dec_args.acquire(entry[1])
+        divide_cache[code] = entry
+    return entry
+
+
 def divide_into_blocks(code):
-    global dec_counter
+    return [list(block) for block in _divide_cached(code)[0]]
+
+
+def hold_blocks(code):
+    """
+    Divide code into blocks like divide_into_blocks, and also take a
+    reference to the dec_args entries they use, so that the entries stay
+    around even if the cell drops out of the cache while it runs.
+
+    Returns the blocks and the keys, which must be passed to
+    dec_args.release once the blocks have been executed.
+    """
+    blocks, keys = _divide_cached(code)
+    dec_args.acquire(keys)
+    return [list(block) for block in blocks], keys
+
+
+def _divide_into_blocks(code):
+    # keys of the dec_args entries added for this code
+    keys = []
 
     # strip string literals from the input, so that we can parse it without having to worry about strings
     code, literals, state = strip_string_literals(code)
@@ -230,17 +375,14 @@ def divide_into_blocks(code):
                 # then code decorators impacts the rest of the code.
                 sexpr = expr.strip()
                 if i == 0 and (len(sexpr) == 0 or sexpr.startswith('#')):
-                    new_line = '%ssalvus.execute_with_code_decorators(*_salvus_parsing.dec_args[%s])' % (
-                        line[:i], dec_counter)
                     expr = ('\n'.join(code[len(v) + 1:])) % literals
                     done = True
-                else:
-                    # Expr is nonempty -- code decorator only impacts this line
-                    new_line = '%ssalvus.execute_with_code_decorators(*_salvus_parsing.dec_args[%s])' % (
-                        line[:i], dec_counter)
+                # Otherwise expr is nonempty -- code decorator only impacts this line
 
-                dec_args[dec_counter] = ([line[i + 2:j] % literals], expr)
-                dec_counter += 1
+                key = dec_args.add(([line[i + 2:j] % literals], expr))
+                keys.append(key)
+                new_line = '%ssalvus.execute_with_code_decorators(*_salvus_parsing.dec_args[%s])' % (
+                    line[:i], key)
             else:
                 new_line = line
             v.append(new_line)
@@ -267,70 +409,86 @@ def divide_into_blocks(code):
     # take only non-whitespace lines now for Python code (string literals have already been removed).
     code = [x for x in code if x.strip()]
 
-    # Compute the blocks
-    i = len(code) - 1
+    # Compute the blocks, working up from the last line.  A block starts at
+    # the nearest line above its last line that is not indented, such that
+    # no parenthesis, bracket or brace is closed in the block without being
+    # opened in it.  depth[k] holds the paren, bracket and brace depths
+    # after the first k lines, and prev_start[k] the index of the last
+    # unindented line among the first k+1 lines (or -1).
+    depth = [(0, 0, 0)]
+    prev_start = []
+    paren_depth = brack_depth = curly_depth = 0
+    start = -1
+    for k, line in enumerate(code):
+        paren_depth += line.count('(') - line.count(')')
+        brack_depth += line.count('[') - line.count(']')
+        curly_depth += line.count('{') - line.count('}')
+        depth.append((paren_depth, brack_depth, curly_depth))
+        if line[0] not in string.whitespace:
+            start = k
+        prev_start.append(start)
+
     blocks = []
-    while i >= 0:
-        stop = i
-        paren_depth = code[i].count('(') - code[i].count(')')
-        brack_depth = code[i].count('[') - code[i].count(']')
-        curly_depth = code[i].count('{') - code[i].count('}')
-        while i >= 0 and (
-            (len(code[i]) > 0 and (code[i][0] in string.whitespace))
-                or paren_depth < 0 or brack_depth < 0 or curly_depth < 0):
-            i -= 1
-            if i >= 0:
-                paren_depth += code[i].count('(') - code[i].count(')')
-                brack_depth += code[i].count('[') - code[i].count(']')
-                curly_depth += code[i].count('{') - code[i].count('}')
-        block = ('\n'.join(code[i:])) % literals
+    stop = len(code) - 1
+    while stop >= 0:
+        p, b, c = depth[stop + 1]
+        i = prev_start[stop]
+        while i >= 0 and not (depth[i][0] <= p and depth[i][1] <= b
+                              and depth[i][2] <= c):
+            i = prev_start[i - 1] if i > 0 else -1
+        if i == -1:
+            # No line can start this block, so the last line is a block
+            # on its own (which is what code[-1:] gave in earlier versions).
+            block = code[stop] % literals
+        else:
+            block = ('\n'.join(code[i:stop + 1])) % literals
         bs = block.strip()
         if bs:  # has to not be only whitespace
-            blocks.insert(0, [i, stop, bs])
-        code = code[:i]
-        i = len(code) - 1
-
-    # merge try/except/finally/decorator/else/elif blocks
-    i = 1
-
-    def merge():
-        "Merge block i-1 with block i."
-        blocks[i - 1][-1] += '\n' + blocks[i][-1]
-        blocks[i - 1][1] = blocks[i][1]
-        del blocks[i]
-
-    while i < len(blocks):
-        s = blocks[i][-1].lstrip()
-
-        # finally/except lines after a try
-        if (s.startswith('finally') or s.startswith('except')
-            ) and blocks[i - 1][-1].lstrip().startswith('try'):
-            merge()
-
-        # function definitions
-        elif (s.startswith('def') or s.startswith('@')) and blocks[
-                i - 1][-1].splitlines()[-1].lstrip().startswith('@'):
-            merge()
-
-        # lines starting with else conditions (if *and* for *and* while!)
-        elif s.startswith('else') and (
-                blocks[i - 1][-1].lstrip().startswith('if')
-                or blocks[i - 1][-1].lstrip().startswith('while')
-                or blocks[i - 1][-1].lstrip().startswith('for')
-                or blocks[i - 1][-1].lstrip().startswith('try')
-                or blocks[i - 1][-1].lstrip().startswith('elif')):
-            merge()
-
-        # lines starting with elif
-        elif s.startswith('elif') and blocks[i -
-                                             1][-1].lstrip().startswith('if'):
-            merge()
-
-        # do not merge blocks -- move on to next one
-        else:
-            i += 1
+            blocks.append([i, stop, bs])
+        stop = stop - 1 if i == -1 else i - 1
+    blocks.reverse()
+
+    # merge try/except/finally/decorator/else/elif blocks; merged blocks are
+    # collected as lists of pieces and joined at the end
+    merged = []
+    for block in blocks:
+        if merged:
+            prev = merged[-1][-1]
+            first = prev[0].lstrip()
+            s = block[-1].lstrip()
+            # finally/except lines after a try
+            if (s.startswith('finally')
+                    or s.startswith('except')) and first.startswith('try'):
+                merge = True
+
+            # function definitions
+            elif (s.startswith('def') or s.startswith('@')
+                  ) and prev[-1].splitlines()[-1].lstrip().startswith('@'):
+                merge = True
+
+            # lines starting with else conditions (if *and* for *and* while!)
+            elif s.startswith('else') and (
+                    first.startswith('if') or first.startswith('while')
+                    or first.startswith('for') or first.startswith('try')
+                    or first.startswith('elif')):
+                merge = True
+
+            # lines starting with elif
+            elif s.startswith('elif') and first.startswith('if'):
+                merge = True
+
+            # do not merge blocks -- move on to next one
+            else:
+                merge = False
+
+            if merge:
+                merged[-1][1] = block[1]
+                prev.append(block[-1])
+                continue
+        merged.append([block[0], block[1], [block[-1]]])
 
-    return blocks
+    return [[start, stop, '\n'.join(pieces)]
+            for start, stop, pieces in merged], keys
 
 
 ############################################
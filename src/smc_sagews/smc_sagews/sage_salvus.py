@@ -19,7 +19,7 @@ import six
 import matplotlib
 matplotlib.use('Agg')
 
-import copy, os, sys, types, re
+import copy, os, sys, threading, types, re
 
 import sage.all
 
@@ -96,7 +96,11 @@ class InteractCell(object):
                  update_args=None,
                  auto_update=True,
                  flicker=False,
-                 output=True):
+                 output=True,
+                 debounce=None,
+                 max_rate=None,
+                 cancel=False,
+                 cache=False):
         """
         Given a function f, create an object that describes an interact
         for working with f interactively.
@@ -114,9 +118,26 @@ class InteractCell(object):
           never shrinks; it can only grow, which aleviates flicker.
         - ``output`` -- (default: True) if False, do not automatically
           provide any area to display output.
+        - ``debounce`` -- (default: None) seconds the controls must be
+          unchanged before f is called.
+        - ``max_rate`` -- (default: None) call f at most this often per second.
+        - ``cancel`` -- (default: False) interrupt f when newer values arrive.
+        - ``cache`` -- (default: False) if True or a positive integer,
+          remember the output of f for the last 128 (or that many)
+          combinations of values and replay it when they recur.
         """
         self._flicker = flicker
         self._output = output
+        self._debounce = debounce
+        self._min_interval = 1.0 / max_rate if max_rate else None
+        self._cancel = cancel
+        self._last_call = 0
+        if cache:
+            from .sage_parsing import LRUCache
+            self._cache = LRUCache(128 if cache is True else int(cache))
+        else:
+            self._cache = None
+        self._cacheable = True
         self._uuid = uuid()
         # Prevent garbage collection until client specifically requests it,
         # since we want to be able to store state.
@@ -268,11 +289,117 @@ class InteractCell(object):
             if not do_it:
                 return
 
+        key = self._cache_key()
+        outputs = None
+        if key is not None:
+            outputs = self._cache.get(key)
+            if outputs is not None:
+                _replay_outputs(outputs)
+                return
+            outputs = []
+            salvus._output_recorders.append(outputs)
+            self._cacheable = True
+
+        from time import time
+        self._last_call = time()
+        watcher = _InteractWatcher(self._uuid) if self._cancel else None
+        completed = False
         interact_exec_stack.append(self)
         try:
-            self._f(**dict([(k, self._last_vals[k]) for k in self._args]))
+            try:
+                if watcher is not None:
+                    watcher.start()
+                self._f(**dict([(k, self._last_vals[k]) for k in self._args]))
+                if outputs is not None:
+                    # so file output (e.g., plots) is recorded too
+                    salvus._send_files(block=True)
+                completed = True
+            finally:
+                # the interrupt may land while stopping, so stop in here
+                if watcher is not None:
+                    watcher.stop()
+        except KeyboardInterrupt:
+            if watcher is None or not watcher.cancelled:
+                raise
+            # newer values arrived; they get evaluated next
         finally:
             interact_exec_stack.pop()
+            if outputs is not None:
+                salvus._output_recorders.remove(outputs)
+        if (outputs is not None and completed and self._cacheable
+                and _can_replay(outputs)):
+            self._cache[key] = outputs
+
+    def _cache_key(self):
+        """
+        Return the key of the current values of the controls in the cache
+        of outputs, or None if there is no cache or they can't be hashed.
+        """
+        if self._cache is None:
+            return None
+        key = tuple((k, self._last_vals[k]) for k in sorted(self._args))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+
+# The code the client runs when the controls of an interact change.
+INTERACT_UPDATE_CODE = 'salvus._execute_interact(salvus.data["id"], salvus.data["vals"])'
+
+
+def interact_update_id(mesg):
+    """
+    Return the id of the interact whose controls changed if mesg is an
+    execute_code message for that, and None otherwise.
+    """
+    if mesg.get('event') != 'execute_code' or mesg.get(
+            'code') != INTERACT_UPDATE_CODE:
+        return None
+    data = mesg.get('data')
+    return data.get('id') if isinstance(data, dict) else None
+
+
+class _InteractWatcher(object):
+    """
+    Watch for newer values of the interact with the given id while its
+    function is being evaluated, and interrupt the evaluation when they
+    arrive.
+    """
+    def __init__(self, id, interval=.05):
+        self._id = id
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.cancelled = False
+
+    def start(self):
+        mq = salvus.message_queue
+        if mq is None:
+            return
+        self._thread = threading.Thread(target=self._run, args=(mq, ))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, mq):
+        is_update = lambda mesg: interact_update_id(mesg) == self._id
+        while not self._stopped.is_set():
+            if mq.receive_available(self._interval) and mq.find(
+                    'execute_code', is_update) is not None:
+                with self._lock:
+                    if not self._stopped.is_set():
+                        self.cancelled = True
+                        import signal
+                        os.kill(os.getpid(), signal.SIGINT)
+                return
+
+    def stop(self):
+        with self._lock:
+            self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
 
 
 class InteractFunction(object):
@@ -379,6 +506,23 @@ class Interact(object):
       to the widths.   Use var_name='' to specify where the output
       goes, if you don't want it to last.  You may specify entries for
       controls that you will create later using interact.var_name = foo.
+    - ``debounce`` -- (default: None) number of seconds; only evaluate the
+      function once the controls have not changed for this long.
+    - ``max_rate`` -- (default: None) evaluate the function at most this
+      many times per second.
+    - ``cancel`` -- (default: False) interrupt an evaluation of the function
+      when the controls change before it has finished, and start over
+      with the new values.
+    - ``cache`` -- (default: False) if True, remember the output for the
+      last 128 combinations of values of the controls, and replay it
+      instead of evaluating the function when the controls return to
+      one of them, e.g., when moving a slider back and forth; give an
+      integer to remember that many instead.  Only use this if the
+      output depends on nothing but the values of the controls.
+
+    When controls change faster than the function can be evaluated (e.g.,
+    dragging a slider), the queued changes are merged and only the
+    latest values are used.
 
 
     NOTES: The flicker and layout options above are only in SALVUS.
@@ -506,10 +650,15 @@ class Interact(object):
                  update_args=None,
                  auto_update=True,
                  flicker=False,
-                 output=True):
+                 output=True,
+                 debounce=None,
+                 max_rate=None,
+                 cancel=False,
+                 cache=False):
         if f is None:
             return _interact_layout(layout, width, style, update_args,
-                                    auto_update, flicker)
+                                    auto_update, flicker, output, debounce,
+                                    max_rate, cancel, cache)
         else:
             return salvus.interact(f,
                                    layout=layout,
@@ -518,10 +667,16 @@ class Interact(object):
                                    update_args=update_args,
                                    auto_update=auto_update,
                                    flicker=flicker,
-                                   output=output)
+                                   output=output,
+                                   debounce=debounce,
+                                   max_rate=max_rate,
+                                   cancel=cancel,
+                                   cache=cache)
 
     def __setattr__(self, arg, value):
         I = interact_exec_stack[-1]
+        # replaying the output would not change the controls again
+        I._cacheable = False
         if arg in I._controls and not isinstance(value, control):
             # setting value of existing control
             v = I._controls[arg].convert_to_client(value)
@@ -1828,6 +1983,306 @@ class Capture:
 
 capture = Capture(stdout=None, stderr=None, append=False, echo=False)
 
+
+def _can_replay(outputs):
+    """
+    Return True if the output messages recorded from salvus._send_output
+    can be sent again in place of evaluating the code that produced them,
+    i.e., there are no errors, interacts or requests for input.
+    """
+    for args, kwds in outputs:
+        if kwds.get('stderr') or any(
+                k in kwds for k in ('interact', 'raw_input', 'events')):
+            return False
+    return True
+
+
+def _refers_to_blobs(outputs):
+    """
+    Return True if any of the recorded output messages refers to a blob
+    saved by the hub, e.g., a plot, which the hub only keeps for a while.
+    """
+    for args, kwds in outputs:
+        if 'file' in kwds:
+            return True
+        for v in kwds.values():
+            if isinstance(v, six.string_types) and '/blobs/' in v:
+                return True
+    return False
+
+
+def _replay_outputs(outputs):
+    """
+    Send the recorded output messages again, as output of the current cell.
+    """
+    for args, kwds in outputs:
+        kwds = dict(kwds)
+        if args:
+            args = (salvus._id, ) + tuple(args[1:])
+        else:
+            kwds['id'] = salvus._id
+        kwds['done'] = False
+        salvus._send_output(*args, **kwds)
+
+
+def _function_globals(f):
+    """
+    Return a dict of the global variables the function f uses, including
+    in nested functions, with their values.
+    """
+    names = set()
+    todo = [getattr(f, '__code__', None)]
+    while todo:
+        code = todo.pop()
+        if code is None:
+            continue
+        names.update(code.co_names)
+        todo.extend(c for c in code.co_consts if isinstance(c, types.CodeType))
+    g = getattr(f, '__globals__', {})
+    return dict((name, g[name]) for name in names if name in g)
+
+
+def _hash_value(h, val, seen):
+    """
+    Update the sha1 h with the value val.  Pickling a function only
+    records its name, so its code, defaults, closure and the globals it
+    uses are hashed instead.  The set seen holds the ids of the functions
+    already hashed.
+    """
+    import marshal
+    from six.moves import cPickle
+    if isinstance(val, types.FunctionType):
+        if id(val) in seen:
+            return
+        seen.add(id(val))
+        h.update(marshal.dumps(val.__code__))
+        _hash_value(h, val.__defaults__, seen)
+        _hash_value(h, getattr(val, '__kwdefaults__', None), seen)
+        for cell in val.__closure__ or ():
+            _hash_value(h, cell.cell_contents, seen)
+        for name, x in sorted(_function_globals(val).items()):
+            if default_namespace.get(name, None) is not x:
+                h.update(name.encode('utf8'))
+                _hash_value(h, x, seen)
+    elif isinstance(val, types.ModuleType):
+        h.update(val.__name__.encode('utf8'))
+    else:
+        h.update(cPickle.dumps(val, cPickle.HIGHEST_PROTOCOL))
+
+
+class Cache(object):
+    """
+    Cache the result of evaluating a cell (SALVUS only).
+
+    Put %cache at the top of a cell whose evaluation is expensive, e.g.,
+    a hard integral, a factorization or loading a big data file::
+
+        %cache
+        F = factor(2^512 - 1)
+        print(F)
+
+    The first time, the cell is evaluated as usual.  Its output and the
+    values of the variables it assigns are then stored on disk, keyed by
+    the code and the pickled values of all worksheet variables the code
+    reads.  When the cell is evaluated again with the same code and
+    inputs, even after a restart, the output is replayed and the
+    variables are set without evaluating anything.
+
+    Cells that produce errors (anything on stderr), interacts, files
+    (e.g., plots, since the hub does not keep their data forever) or ask
+    for input, or whose variables can't be pickled (e.g., functions and
+    classes defined in the cell), are not cached.  Only assignments and
+    imports are replayed, so changes a cell makes to existing objects,
+    e.g., v.append(x), are lost on a cache hit.
+
+    INPUT:
+
+    - ``path`` -- directory of the cache (default: $SMC/sagews-cache)
+    - ``max_size`` -- (default: 256MB) the least recently used entries
+      are removed when the cache gets bigger than this many bytes
+
+    Use cache.clear() to remove all entries, and cache.stats() to see
+    how well it works.
+    """
+    def __init__(self, path=None, max_size=2**28):
+        if path is None:
+            path = os.path.join(os.environ.get('SMC', '.'), 'sagews-cache')
+        self._path = path
+        self._max_size = max_size
+        self._hits = self._misses = 0
+
+    def __call__(self, code=None, path=None, max_size=None):
+        if code is None:
+            return Cache(path=self._path if path is None else path,
+                         max_size=self._max_size
+                         if max_size is None else max_size)
+        if salvus._prefix:
+            if not code.startswith("%"):
+                code = salvus._prefix + '\n' + code
+        key, assigned = self._key(code)
+        if key is None:
+            salvus.execute(code)
+            return
+        filename = os.path.join(self._path, key)
+        entry = self._load(filename)
+        if entry is not None:
+            self._hits += 1
+            self._replay(entry)
+            return
+        self._misses += 1
+        outputs = []
+        salvus._output_recorders.append(outputs)
+        try:
+            salvus.execute(code)
+            # so file output (e.g., plots) is recorded too, and the cell
+            # is not cached
+            salvus._send_files(block=True)
+        finally:
+            salvus._output_recorders.remove(outputs)
+        if not _can_replay(outputs) or _refers_to_blobs(outputs):
+            return
+        values = {}
+        modules = {}
+        for var in assigned:
+            if var in salvus.namespace:
+                val = salvus.namespace[var]
+                if isinstance(val, types.ModuleType):
+                    modules[var] = val.__name__
+                else:
+                    values[var] = val
+        self._save(filename, {
+            'outputs': outputs,
+            'values': values,
+            'modules': modules
+        })
+
+    def _key(self, code):
+        """
+        Return the key of code and the names of the variables it assigns,
+        or (None, None) if it can't be cached.
+        """
+        import ast, hashlib
+        from .sage_parsing import preparse_code
+        try:
+            tree = ast.parse(preparse_code(code))
+        except SyntaxError:
+            return None, None
+        loaded = set()
+        assigned = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.AugAssign) and isinstance(
+                    node.target, ast.Name):
+                loaded.add(node.target.id)
+            if isinstance(node, ast.Name):
+                if isinstance(node.ctx, ast.Load):
+                    loaded.add(node.id)
+                else:
+                    assigned.add(node.id)
+            elif isinstance(node, (ast.FunctionDef, ast.ClassDef)) or type(
+                    node).__name__ == 'AsyncFunctionDef':
+                assigned.add(node.name)
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                for alias in node.names:
+                    if alias.name == '*':
+                        return None, None
+                    assigned.add(alias.asname or alias.name.split('.')[0])
+        h = hashlib.sha1()
+        h.update(sys.version.encode('utf8'))
+        h.update(code.encode('utf8'))
+        seen = set()
+        for var in sorted(loaded):
+            if var not in salvus.namespace:
+                continue
+            val = salvus.namespace[var]
+            if default_namespace.get(var, None) is val:
+                continue
+            h.update(var.encode('utf8'))
+            try:
+                _hash_value(h, val, seen)
+            except Exception:
+                return None, None
+        return h.hexdigest(), assigned
+
+    def _load(self, filename):
+        import zlib
+        from six.moves import cPickle
+        try:
+            with open(filename, 'rb') as f:
+                entry = cPickle.loads(zlib.decompress(f.read()))
+        except Exception:
+            return None
+        os.utime(filename, None)  # most recently used
+        return entry
+
+    def _save(self, filename, entry):
+        import zlib
+        from six.moves import cPickle
+        try:
+            data = zlib.compress(cPickle.dumps(entry, cPickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return
+        if not os.path.exists(self._path):
+            os.makedirs(self._path)
+        tmp = filename + '.%s.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, filename)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self._path):
+            try:
+                st = os.stat(os.path.join(self._path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self._max_size:
+                break
+            try:
+                os.unlink(os.path.join(self._path, name))
+            except OSError:
+                pass
+            total -= size
+
+    def _replay(self, entry):
+        import importlib
+        for var, name in entry.get('modules', {}).items():
+            salvus.namespace[var] = importlib.import_module(name)
+        for var, val in entry['values'].items():
+            salvus.namespace[var] = val
+        _replay_outputs(entry['outputs'])
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        if os.path.exists(self._path):
+            import shutil
+            shutil.rmtree(self._path)
+
+    def stats(self):
+        """
+        Return the number of cache hits and misses in this session, and the
+        number of entries and bytes on disk.
+        """
+        n = size = 0
+        if os.path.exists(self._path):
+            for name in os.listdir(self._path):
+                n += 1
+                size += os.path.getsize(os.path.join(self._path, name))
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'entries': n,
+            'size': size
+        }
+
+
+cache = Cache()
+
 import sage.misc.cython
 
 
@@ -2470,48 +2925,167 @@ def prun(code):
 ##############################################################
 
 
-def _wait_in_thread(pid, callback, filename):
-    from sage.structure.sage_object import load
+def _write_all(fd, data):
+    data = memoryview(data).cast('B')
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _read_exactly(fd, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    while view:
+        data = os.read(fd, min(len(view), 1 << 20))
+        if not data:
+            raise EOFError("pipe closed")
+        view[:len(data)] = data
+        view = view[len(data):]
+    return buf
+
+
+def send_object(fd, obj):
+    """
+    Write obj to the file descriptor fd (e.g., a pipe) as a pickle.
+
+    With pickle protocol 5, large buffers such as numpy arrays are
+    written out of band, straight from their memory, instead of being
+    copied into the pickle.  The format is the number of buffers n, then
+    n+1 lengths (all little endian uint64), the pickle and the buffers.
+    """
+    import pickle, struct
+    buffers = []
+    if hasattr(pickle, 'PickleBuffer'):
+        data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        buffers = [b.raw() for b in buffers]
+    else:
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sizes = [len(data)] + [b.nbytes for b in buffers]
+    _write_all(fd, struct.pack('<%sQ' % (len(sizes) + 1), len(buffers),
+                               *sizes))
+    for b in [data] + buffers:
+        _write_all(fd, b)
+
+
+class _NullWriter(object):
+    def write(self, data):
+        pass
+
+
+def _picklable(obj):
+    """
+    Return whether obj can be pickled, without keeping the pickle or
+    copying large out of band buffers.
+    """
+    import pickle
+    try:
+        if hasattr(pickle, 'PickleBuffer'):
+            pickle.Pickler(_NullWriter(), protocol=5,
+                           buffer_callback=lambda b: None).dump(obj)
+        else:
+            pickle.Pickler(_NullWriter(),
+                           protocol=pickle.HIGHEST_PROTOCOL).dump(obj)
+        return True
+    except Exception:
+        return False
+
 
+def recv_object(fd):
+    """
+    Read an object written by send_object from the file descriptor fd.
+    Raises EOFError if the other end is closed first.
+    """
+    import pickle, struct
+    n, = struct.unpack('<Q', _read_exactly(fd, 8))
+    sizes = struct.unpack('<%sQ' % (n + 1), _read_exactly(fd, 8 * (n + 1)))
+    data = _read_exactly(fd, sizes[0])
+    buffers = [_read_exactly(fd, size) for size in sizes[1:]]
+    if buffers:
+        return pickle.loads(data, buffers=buffers)
+    return pickle.loads(data)
+
+
+def _wait_in_thread(pid, callback, fd):
     def wait():
         try:
+            try:
+                # read before waiting: the child blocks until its result
+                # is read from the pipe
+                result = recv_object(fd)
+            except EOFError:
+                result = RuntimeError("forked subprocess %s died" % pid)
+            except Exception as msg:
+                result = msg
             os.waitpid(pid, 0)
-            callback(load(filename))
-        except Exception as msg:
-            callback(msg)
+        finally:
+            os.close(fd)
+        callback(result)
 
     from threading import Thread
     t = Thread(target=wait, args=tuple([]))
+    t.daemon = True
     t.start()
 
 
+def _die_with_parent():
+    # Linux only: have the kernel kill this process when its parent dies.
+    try:
+        import ctypes, signal
+        PR_SET_PDEATHSIG = 1
+        ctypes.CDLL(None, use_errno=True).prctl(PR_SET_PDEATHSIG,
+                                                signal.SIGKILL)
+    except Exception:
+        pass
+
+
 def async_(f, args, kwds, callback):
     """
     Run f in a forked subprocess with given args and kwds, then call the
-    callback function when f terminates.
+    callback function with its result (or an exception) when f terminates.
+    The result is sent back through a pipe.
     """
-    from sage.misc.all import tmp_filename
-    filename = tmp_filename() + '.sobj'
+    r, w = os.pipe()
     sys.stdout.flush()
     sys.stderr.flush()
     pid = os.fork()
     if pid:
         # The parent master process
-        try:
-            _wait_in_thread(pid, callback, filename)
-            return pid
-        finally:
-            if os.path.exists(filename):
-                os.unlink(filename)
+        os.close(w)
+        _wait_in_thread(pid, callback, r)
+        return pid
     else:
         # The child process
         try:
-            result = f(*args, **kwds)
-        except Exception as msg:
-            result = str(msg)
-        from sage.structure.sage_object import save
-        save(result, filename)
-        os._exit(0)
+            os.close(r)
+            _die_with_parent()
+            try:
+                result = f(*args, **kwds)
+            except Exception as msg:
+                result = str(msg)
+            try:
+                send_object(w, result)
+            except Exception as msg:
+                send_object(w, RuntimeError(str(msg)))
+        finally:
+            os._exit(0)
+
+
+def _proc_status(pid):
+    """
+    Return the CPU time (in seconds) and resident memory (in bytes) of
+    process pid, read from /proc, or None for values that are unknown.
+    """
+    cpu = rss = None
+    try:
+        with open('/proc/%s/stat' % pid) as f:
+            # the command name in parentheses may contain spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / float(
+            os.sysconf('SC_CLK_TCK'))
+        with open('/proc/%s/statm' % pid) as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    return cpu, rss
 
 
 class Fork(object):
@@ -2528,26 +3102,41 @@ class Fork(object):
 
     All (picklelable) global variables that are set in the forked
     subprocess are set in the parent when the forked subprocess
-    terminates.  However, the forked subprocess has no other side
-    effects, except what it might do to file handles and the
-    filesystem.
+    terminates.  They are sent back through a pipe, with large buffers
+    (e.g., numpy arrays) sent out of band so they are not copied.
+    However, the forked subprocess has no other side effects, except
+    what it might do to file handles and the filesystem.
 
     To see currently running forked subprocesses, type
-    fork.children(), which returns a dictionary {pid:execute_uuid}.
-    To kill a given subprocess and stop the cell waiting for input,
-    type fork.kill(pid).  This is currently the only way to stop code
+    fork.children(), which returns a dictionary {pid:status}, where
+    status has the execute uuid 'id' of the cell, the 'cpu' time in
+    seconds, the resident memory 'rss' in bytes and the 'walltime'
+    in seconds since the subprocess started.  To kill a given
+    subprocess and stop the cell waiting for input, type
+    fork.kill(pid).  This is currently the only way to stop code
     running in %fork cells.
 
-    TODO/WARNING: The subprocesses spawned by fork are not killed
-    if the parent process is killed first!
+    The subprocesses are killed when the Sage session terminates.
 
     NOTE: All pexpect interfaces are reset in the child process.
     """
     def __init__(self):
-        self._children = {}
+        self._children = {}  # pid -> (execute uuid, start time)
+        self._killed = set()
 
     def children(self):
-        return dict(self._children)
+        from time import time
+        now = time()
+        status = {}
+        for pid, (id, start) in list(self._children.items()):
+            cpu, rss = _proc_status(pid)
+            status[pid] = {
+                'id': id,
+                'cpu': cpu,
+                'rss': rss,
+                'walltime': now - start
+            }
+        return status
 
     def __call__(self, s):
 
@@ -2582,50 +3171,301 @@ class Fork(object):
 
             salvus.namespace.on('change', None, change)
             salvus.execute(s)
-            result = {}
-            from sage.structure.sage_object import dumps
-            for var in changed_vars:
-                try:
-                    result[var] = dumps(salvus.namespace[var])
-                except:
-                    result[var] = 'unable to pickle %s' % var
-            return result
-
-        from sage.structure.sage_object import loads
+            values = dict((var, salvus.namespace[var])
+                          for var in changed_vars if var in salvus.namespace)
+            unpicklable = []
+            if not _picklable(values):
+                unpicklable = [
+                    var for var in values if not _picklable(values[var])
+                ]
+                for var in unpicklable:
+                    del values[var]
+            return {'values': values, 'unpicklable': unpicklable}
 
         def g(s):
+            if pid in self._killed:
+                # fork.kill already ended the cell
+                self._killed.discard(pid)
+                return
+            self._children.pop(pid, None)
             if isinstance(s, Exception):
                 sys.stderr.write(str(s))
                 sys.stderr.flush()
+            elif isinstance(s, dict):
+                for var in s['unpicklable']:
+                    print(("unable to pickle %s" % var))
+                for var, val in s['values'].items():
+                    salvus.namespace[var] = val
             else:
-                for var, val in s.items():
-                    try:
-                        salvus.namespace[var] = loads(val)
-                    except:
-                        print(("unable to unpickle %s" % var))
+                sys.stderr.write(str(s))
+                sys.stderr.flush()
             salvus._conn.send_json({'event': 'output', 'id': id, 'done': True})
-            if pid in self._children:
-                del self._children[pid]
 
+        from time import time
         pid = async_(f, tuple([]), {}, g)
         print(("Forked subprocess %s" % pid))
-        self._children[pid] = id
+        self._children[pid] = (id, time())
 
     def kill(self, pid):
         if pid in self._children:
             salvus._conn.send_json({
                 'event': 'output',
-                'id': self._children[pid],
+                'id': self._children[pid][0],
                 'done': True
             })
-            os.kill(pid, 9)
             del self._children[pid]
+            self._killed.add(pid)
+            try:
+                os.kill(pid, 9)
+            except OSError:
+                pass
         else:
             raise ValueError("Unknown pid = (%s)" % pid)
 
+    def kill_all(self):
+        """
+        Kill all forked subprocesses.
+        """
+        for pid in list(self._children):
+            self._killed.add(pid)
+            try:
+                os.kill(pid, 9)
+            except OSError:
+                pass
+        self._children.clear()
+
 
 fork = Fork()
 
+import atexit
+atexit.register(fork.kill_all)
+
+
+##############################################################
+# Parallel map over a pool of forked workers.
+##############################################################
+
+
+def cpu_quota():
+    """
+    Return the number of CPUs this project may use: the cgroup CPU quota
+    (v2 or v1) rounded up, but at most the number of CPUs we can run on.
+    """
+    import math, multiprocessing
+    try:
+        n = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n = multiprocessing.cpu_count()
+    quota = period = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+    except (IOError, OSError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                quota = f.read().strip()
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = f.read().strip()
+        except (IOError, OSError):
+            pass
+    try:
+        if quota is not None and quota != 'max' and int(quota) > 0:
+            n = min(n, int(math.ceil(float(quota) / float(period))))
+    except ValueError:
+        pass
+    return max(1, n)
+
+
+class ProcessPool(object):
+    """
+    A pool of worker processes forked from the Sage session, so they see
+    all worksheet variables and functions as they were at fork time.
+
+    The workers stay around between calls to map, and are only forked
+    again when the function, or a global variable it uses, has changed,
+    including changes made in place, e.g., v.append(x).  If they can't be
+    pickled to tell, the workers are forked for every call.
+    Work goes to the workers in batches through pipes.
+    """
+    def __init__(self):
+        self._workers = []  # [(pid, connection)]
+        self._func = None
+        self._digest = None  # digest of f and the globals it uses at fork time
+
+    def _fingerprint(self, f):
+        # the digest of f, its closure and the global variables it uses, or
+        # None if they can't be pickled
+        import hashlib
+        h = hashlib.sha1()
+        try:
+            _hash_value(h, f, set())
+        except Exception:
+            return None
+        return h.hexdigest()
+
+    def _is_current(self, f, ncpus, digest):
+        return (self._workers and self._func is f
+                and len(self._workers) == ncpus and digest is not None
+                and digest == self._digest)
+
+    def _fork(self, f, ncpus, digest):
+        import multiprocessing
+        self.close()
+        self._func = f
+        self._digest = digest
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for _ in range(ncpus):
+            parent, child = multiprocessing.Pipe()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    # so workers see EOF as soon as the session is gone
+                    parent.close()
+                    for _, conn in self._workers:
+                        conn.close()
+                    # nor the socket to the hub
+                    try:
+                        salvus._conn.close()
+                    except Exception:
+                        pass
+                    _pool_worker(child, f)
+                finally:
+                    os._exit(0)
+            child.close()
+            self._workers.append((pid, parent))
+
+    def close(self):
+        """
+        Stop all workers.
+        """
+        import signal
+        for pid, conn in self._workers:
+            conn.close()
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self._workers = []
+        self._func = None
+        self._digest = None
+
+    def workers(self):
+        """
+        Return the pids of the workers.
+        """
+        return [pid for pid, _ in self._workers]
+
+    def map(self, f, inputs, ncpus=None, batch_size=None, progress=True):
+        """
+        Return [f(x) for x in inputs], computed in parallel.
+
+        INPUT:
+
+        - ``ncpus`` -- number of workers (default: the CPU quota of the
+          project, see cpu_quota())
+        - ``batch_size`` -- number of inputs sent to a worker at once
+          (default: chosen so each worker gets about 4 batches)
+        - ``progress`` -- (default: True) print progress about once a second
+        """
+        from multiprocessing.connection import wait
+        import math
+        from time import time
+        inputs = list(inputs)
+        if not inputs:
+            return []
+        if ncpus is None:
+            ncpus = cpu_quota()
+        ncpus = max(1, int(ncpus))
+        if batch_size is None:
+            batch_size = int(math.ceil(len(inputs) / (4.0 * ncpus)))
+        batch_size = max(1, int(batch_size))
+        batches = [
+            inputs[i:i + batch_size]
+            for i in range(0, len(inputs), batch_size)
+        ]
+        digest = self._fingerprint(f)
+        if not self._is_current(f, ncpus, digest):
+            self._fork(f, ncpus, digest)
+        results = [None] * len(batches)
+        busy = {}  # connection -> number of batches it is working on
+        todo = iter(enumerate(batches))
+
+        def send(conn):
+            job = next(todo, None)
+            if job is not None:
+                conn.send(job)
+                busy[conn] += 1
+
+        done = 0
+        last = time()
+        try:
+            for _, conn in self._workers:
+                busy[conn] = 0
+                # two batches per worker, so it never waits for the next one
+                send(conn)
+                send(conn)
+            while done < len(batches):
+                for conn in wait([c for c in busy if busy[c]]):
+                    try:
+                        i, out, err = conn.recv()
+                    except EOFError:
+                        raise RuntimeError("pmap: a worker process died")
+                    if err is not None:
+                        raise RuntimeError("pmap: error in worker\n%s" % err)
+                    results[i] = out
+                    busy[conn] -= 1
+                    done += 1
+                    send(conn)
+                if progress and time() - last >= 1:
+                    last = time()
+                    print("pmap: %s/%s done" % (min(
+                        done * batch_size, len(inputs)), len(inputs)))
+                    sys.stdout.flush()
+        except BaseException:
+            # workers may be busy with batches nobody will read
+            self.close()
+            raise
+        return [y for out in results for y in out]
+
+
+def _pool_worker(conn, f):
+    import traceback
+    # Never write to the connection of the parent.
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    sage.interfaces.quit.invalidate_all()
+    while True:
+        try:
+            i, batch = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        try:
+            conn.send((i, [f(x) for x in batch], None))
+        except Exception:
+            conn.send((i, None, traceback.format_exc()))
+
+
+pool = ProcessPool()
+
+
+def pmap(f, inputs, **kwds):
+    """
+    Return [f(x) for x in inputs], computed in parallel by a pool of worker
+    processes forked from this session, so f may use all worksheet
+    variables and functions.  The number of workers follows the CPU quota
+    of the project.  For example::
+
+        def f(n):
+            return factor(2^n - 1)
+        v = pmap(f, [100..300])
+
+    """
+    return pool.map(f, inputs, **kwds)
+
+
+pmap.__doc__ += ProcessPool.map.__doc__
+
 ####################################################
 # Display of 2d/3d graphics objects
 ####################################################
@@ -2836,6 +3676,13 @@ def show(*objs, **kwds):
          background is 'transparent', otherwise default is computed for visibility based on canvas
          background.
 
+       - binary: (default: True); send 3d scenes in the compact binary .sage3d format; set to
+         False to send JSON text instead, e.g., for older clients.
+
+       - max_faces: (default: None); if given, 3d surfaces are simplified (by clustering nearby
+         vertices) so the scene has at most about this many triangles, which keeps huge
+         surfaces fast to send and render.
+
     ANIMATIONS:
 
        - animations are by default encoded and displayed using an efficiently web-friendly
@@ -3481,35 +4328,26 @@ def restore(vars=None):
 restore.__doc__ += sage.misc.reset.restore.__doc__
 
 
-# NOTE: this is not used anymore
+# the most recent results of md2html, by markdown source
+_md2html_cache = None
+
+
 def md2html(s):
-    from .markdown2Mathjax import sanitizeInput, reconstructMath
-    from markdown2 import markdown
-
-    delims = [('\\(', '\\)'), ('$$', '$$'), ('\\[', '\\]'),
-              ('\\begin{equation}', '\\end{equation}'),
-              ('\\begin{equation*}', '\\end{equation*}'),
-              ('\\begin{align}', '\\end{align}'),
-              ('\\begin{align*}', '\\end{align*}'),
-              ('\\begin{eqnarray}', '\\end{eqnarray}'),
-              ('\\begin{eqnarray*}', '\\end{eqnarray*}'),
-              ('\\begin{math}', '\\end{math}'),
-              ('\\begin{displaymath}', '\\end{displaymath}')]
-
-    tmp = [((s, None), None)]
-    for d in delims:
-        tmp.append((sanitizeInput(tmp[-1][0][0], equation_delims=d), d))
-
-    extras = ['code-friendly', 'footnotes', 'smarty-pants', 'wiki-tables']
-    markedDownText = markdown(tmp[-1][0][0], extras=extras)
-
-    while len(tmp) > 1:
-        markedDownText = reconstructMath(markedDownText,
-                                         tmp[-1][0][1],
-                                         equation_delims=tmp[-1][1])
-        del tmp[-1]
-
-    return markedDownText
+    global _md2html_cache
+    if _md2html_cache is None:
+        from .sage_parsing import LRUCache
+        _md2html_cache = LRUCache(256)
+    html = _md2html_cache.get(s)
+    if html is None:
+        from .markdown2Mathjax import sanitizeAll, reconstructAll
+        from markdown2 import markdown
+
+        # take out all math at once, so markdown leaves it alone
+        text, math = sanitizeAll(s)
+        extras = ['code-friendly', 'footnotes', 'smarty-pants', 'wiki-tables']
+        html = reconstructAll(markdown(text, extras=extras), math)
+        _md2html_cache[s] = html
+    return html
 
 
 # NOTE: this is not used anymore
@@ -57,25 +57,148 @@ def unicode8(s):
 
 LOGFILE = os.path.realpath(__file__)[:-3] + ".log"
 PID = os.getpid()
-from datetime import datetime
 
+import atexit, threading
 
-def log(*args):
-    try:
-        debug_log = open(LOGFILE, 'a')
-        from sys import version_info
-        if version_info >= (3, 12):
-            from datetime import UTC
-            d = datetime.now(UTC)
-        else:
-            d = datetime.utcnow()
-        d_txt = d.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-        args_str = ' '.join([unicode8(x) for x in args])
-        mesg = "%s (%s): %s\n" % (PID, d_txt, args_str)
-        debug_log.write(mesg)
-        debug_log.flush()
-    except Exception as err:
-        print(("an error writing a log message (ignoring) -- %s" % err, args))
+# Log levels, with the same values as in the standard logging module.
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LOG_LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR}
+
+
+class BufferedLog(object):
+    """
+    Log writer behind log().
+
+    Entries are queued in memory and written out in batches by a background
+    thread through one persistent file handle, so logging a message costs an
+    append instead of an open/write/flush/close.  Timestamps and the log line
+    are only formatted when a batch is written.
+
+    INPUT:
+
+    - ``flush_interval`` -- (default: 0.25) seconds between writes of the
+      queued entries
+    - ``max_pending`` -- (default: 1000) write out right away once this many
+      entries are queued
+    """
+
+    def __init__(self, flush_interval=0.25, max_pending=1000):
+        self.level = DEBUG
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._file = None
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(before=self.flush,
+                                after_in_child=self._after_fork)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = []
+        self._thread = None
+
+    def _after_fork(self):
+        # The parent flushed right before forking, so anything still queued
+        # here belongs to the parent and must not be written a second time.
+        # The writer thread did not survive the fork; start a new one on
+        # demand.
+        global PID
+        PID = os.getpid()
+        self._reset()
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def write(self, level, args):
+        if self._pid != os.getpid():  # forked without register_at_fork
+            self._after_fork()
+        with self._lock:
+            self._pending.append((time.time(), PID, args))
+            n = len(self._pending)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='sage_server log')
+            self._thread.daemon = True
+            self._thread.start()
+        if n >= self.max_pending or level >= ERROR:
+            self._wakeup.set()
+
+    def reopen(self, truncate=False):
+        """
+        Write everything queued so far, then continue in LOGFILE, which may
+        have been changed; if truncate is True, clear it first.
+        """
+        self.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(LOGFILE, 'w' if truncate else 'a')
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return
+            try:
+                if self._file is None:
+                    self._file = open(LOGFILE, 'a')
+                self._file.write(''.join(
+                    [_format_log_entry(*entry) for entry in pending]))
+                self._file.flush()
+            except Exception as err:
+                print(("an error writing %s log messages (ignoring) -- %s" %
+                       (len(pending), err)))
+
+
+def _format_log_entry(t, pid, args):
+    d_txt = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t))
+    return "%s (%s.%03d): %s\n" % (pid, d_txt, int(t % 1 * 1000), ' '.join(
+        [unicode8(x) for x in args]))
+
+
+_log = BufferedLog()
+atexit.register(_log.flush)
+
+
+def log(*args, **kwds):
+    """
+    Log the space separated args to LOGFILE.
+
+    Pass ``level=DEBUG`` (or WARNING, ERROR) to log at a level other than
+    INFO; messages below the level set with set_log_level are dropped.
+    Since the line is formatted later, do not pass objects that might be
+    mutated afterwards.
+    """
+    level = kwds.get('level', INFO)
+    if level >= _log.level:
+        _log.write(level, args)
+
+
+def set_log_level(level):
+    """
+    Set the minimum level of messages written to the log, either as a number
+    or one of the names in LOG_LEVELS.
+    """
+    if is_string(level):
+        level = LOG_LEVELS[level.upper()]
+    _log.level = level
+
+
+def set_logfile(path, truncate=False):
+    """
+    Log to path from now on, clearing it first if truncate is True.
+    """
+    global LOGFILE
+    LOGFILE = path
+    _log.reopen(truncate=truncate)
 
 
 # used for clearing pylab figure
@@ -92,17 +215,17 @@ MAX_STDOUT_SIZE = MAX_STDERR_SIZE = MAX_CODE_SIZE = MAX_HTML_SIZE = MAX_MD_SIZE
 MAX_OUTPUT = 150000
 
 # Standard imports.
-import json, resource, shutil, signal, socket, struct, \
-       tempfile, time, traceback, pwd, re
+import array, collections, json, resource, selectors, shutil, signal, socket, \
+       struct, tempfile, time, traceback, pwd, re
 
 # for "3x^2 + 4xy - 5(1+x) - 3 abc4ok", this pattern matches "3x", "5(" and "4xy" but not "abc4ok"
 # to understand it, see https://regex101.com/ or https://www.debuggex.com/
 RE_POSSIBLE_IMPLICIT_MUL = re.compile(r'(?:(?<=[^a-zA-Z])|^)(\d+[a-zA-Z\(]+)')
 
 try:
-    from . import sage_parsing, sage_salvus
+    from . import sage_jupyter, sage_parsing, sage_salvus
 except:
-    import sage_parsing, sage_salvus
+    import sage_jupyter, sage_parsing, sage_salvus
 
 uuid = sage_salvus.uuid
 
@@ -164,9 +287,34 @@ if 'base_url' not in INFO:
 import hashlib
 
 
+# files are hashed and sent in pieces of this many bytes
+FILE_CHUNK_SIZE = 1 << 20
+
+
 def uuidsha1(data):
     sha1sum = hashlib.sha1()
     sha1sum.update(data)
+    return _sha1_to_uuid(sha1sum)
+
+
+def uuidsha1_file(filename):
+    """
+    Return uuidsha1 of the content of the file, which is read in pieces of
+    FILE_CHUNK_SIZE bytes rather than all at once.
+    """
+    sha1sum = hashlib.sha1()
+    buf = bytearray(FILE_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(filename, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            sha1sum.update(view[:n])
+    return _sha1_to_uuid(sha1sum)
+
+
+def _sha1_to_uuid(sha1sum):
     s = sha1sum.hexdigest()
     t = 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'
     r = list(t)
@@ -182,97 +330,275 @@ def uuidsha1(data):
     return ''.join(r)
 
 
+# Optional faster serializer and compressors for JSON messages, which a client
+# can ask for in its start_session message; see negotiate_encoding.
+import zlib
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+SERIALIZERS = ['json'] if orjson is None else ['orjson', 'json']
+
+# name: (codec byte, compress, decompress)
+COMPRESSORS = {
+    'zlib': (b'z', lambda data: zlib.compress(data, 1), zlib.decompress)
+}
+if lz4_frame is not None:
+    COMPRESSORS['lz4'] = (b'4', lz4_frame.compress, lz4_frame.decompress)
+CODECS = dict((v[0], v[2]) for v in COMPRESSORS.values())
+
+
+def negotiate_encoding(requested):
+    """
+    Given the 'encoding' field of a start_session message, e.g.,
+    {'serializer': ['orjson', 'json'], 'compression': ['lz4', 'zlib'],
+    'threshold': 4096}, return the encoding that we will actually use, which
+    is sent back in the session description.  The first available choice is
+    taken; return None if nothing special was requested.
+    """
+    if not requested:
+        return None
+    enc = {'serializer': 'json', 'compression': None, 'threshold': 4096}
+    for key, available in [('serializer', SERIALIZERS),
+                           ('compression', COMPRESSORS)]:
+        choices = requested.get(key, [])
+        if is_string(choices):
+            choices = [choices]
+        for x in choices:
+            if x in available:
+                enc[key] = x
+                break
+    if 'threshold' in requested:
+        enc['threshold'] = int(requested['threshold'])
+    return enc
+
+
 # A tcp connection with support for sending various types of messages, especially JSON.
+#
+# Each message is a 4 byte big endian length header, followed by a one byte type
+# ('j' for JSON, 'b' for a blob, 'z' for compressed JSON), followed by the payload.
+# A blob payload is the 36 character uuidsha1 of the data, followed by the (binary)
+# data itself.  A compressed JSON payload is one byte naming the codec ('z' for zlib,
+# '4' for lz4), followed by the compressed JSON.  Compressed messages are only
+# sent to clients that asked for them; see negotiate_encoding.
 class ConnectionJSON(object):
 
+    # size of the reusable receive buffer; larger messages get their own buffer
+    RECV_BUFFER_SIZE = 65536
+
     def __init__(self, conn):
         # avoid common mistake -- conn is supposed to be from socket.socket...
         assert not isinstance(conn, ConnectionJSON)
         self._conn = conn
+        self._rbuf = bytearray(self.RECV_BUFFER_SIZE)
+        self._rstart = self._rend = 0  # buffered data is self._rbuf[self._rstart:self._rend]
+        # output is also sent from the OutputFlusher thread
+        self._send_lock = threading.Lock()
+        self.set_encoding()
+
+    def set_encoding(self, serializer='json', compression=None, threshold=4096):
+        """
+        Set how JSON messages are sent.
+
+        INPUT:
+
+        - ``serializer`` -- 'json' or 'orjson' (the output is JSON either way)
+        - ``compression`` -- None, 'zlib' or 'lz4'
+        - ``threshold`` -- only compress messages at least this many bytes long
+        """
+        self._orjson = serializer == 'orjson' and orjson is not None
+        self._compress = COMPRESSORS[compression][:2] if compression else None
+        self._threshold = threshold
 
     def close(self):
         self._conn.close()
 
-    def _send(self, s):
-        if six.PY3 and type(s) == str:
-            s = s.encode('utf8')
-        length_header = struct.pack(">L", len(s))
-        # py3: TypeError: can't concat str to bytes
-        self._conn.send(length_header + s)
+    def _sendall(self, buffers):
+        """
+        Send all the given buffers, in order, without concatenating them.
+        """
+        if not hasattr(self._conn, 'sendmsg'):
+            for buf in buffers:
+                self._conn.sendall(buf)
+            return
+        views = [memoryview(buf) for buf in buffers if len(buf)]
+        while views:
+            sent = self._conn.sendmsg(views)
+            # drop what was sent; sendmsg may stop in the middle of a buffer
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                del views[0]
+            if sent:
+                views[0] = views[0][sent:]
+
+    def _send(self, *parts):
+        if six.PY3:
+            parts = [
+                x.encode('utf8') if type(x) == str else x for x in parts
+            ]
+        length_header = struct.pack(">L", sum(len(x) for x in parts))
+        with self._send_lock:
+            self._sendall([length_header] + list(parts))
 
     def send_json(self, m):
-        m = json.dumps(m)
-        if '\\u0000' in m:
-            raise RuntimeError("NULL bytes not allowed")
-        log("sending message '", truncate_text(m, 256), "'")
-        self._send('j' + m)
+        if self._orjson:
+            try:
+                m = orjson.dumps(m, option=orjson.OPT_NON_STR_KEYS)
+            except TypeError:
+                # e.g., integers that do not fit in 64 bits
+                m = json.dumps(m).encode('utf8')
+            if b'\\u0000' in m:
+                raise RuntimeError("NULL bytes not allowed")
+            if _log.enabled(DEBUG):
+                log("sending message '",
+                    m[:256].decode('utf8', 'replace'),
+                    "'",
+                    level=DEBUG)
+        else:
+            m = json.dumps(m)
+            if '\\u0000' in m:
+                raise RuntimeError("NULL bytes not allowed")
+            if _log.enabled(DEBUG):
+                log("sending message '", truncate_text(m, 256), "'", level=DEBUG)
+        if self._compress is not None and len(m) >= self._threshold:
+            codec, compress = self._compress
+            z = compress(m.encode('utf8') if not self._orjson else m)
+            if len(z) < len(m):
+                self._send('z', codec, z)
+                return len(m)
+        self._send('j', m)
         return len(m)
 
-    def send_blob(self, blob):
+    def send_blob(self, blob, sha1=None):
+        """
+        Send blob, whose uuidsha1 is sha1 if known, and return its uuidsha1.
+        """
         if six.PY3 and type(blob) == str:
             # unicode objects must be encoded before hashing
             blob = blob.encode('utf8')
 
-        s = uuidsha1(blob)
-        if six.PY3 and type(blob) == bytes:
-            # we convert all to bytes first, to avoid unnecessary conversions
-            self._send(('b' + s).encode('utf8') + blob)
-        else:
-            # old sage py2 code
-            self._send('b' + s + blob)
+        s = uuidsha1(blob) if sha1 is None else sha1
+        self._send('b' + s, blob)
         return s
 
-    def send_file(self, filename):
+    def send_file(self, filename, sha1=None):
+        """
+        Send the content of filename as a blob, whose uuidsha1 is sha1 if
+        known, and return its uuidsha1.  The file is streamed in pieces of
+        FILE_CHUNK_SIZE bytes, so memory use does not depend on its size.
+        """
         log("sending file '%s'" % filename)
-        f = open(filename, 'rb')
-        data = f.read()
-        f.close()
-        return self.send_blob(data)
-
-    def _recv(self, n):
-        #print("_recv(%s)"%n)
+        if sha1 is None:
+            sha1 = uuidsha1_file(filename)
+        buf = bytearray(FILE_CHUNK_SIZE)
+        view = memoryview(buf)
+        with open(filename, 'rb') as f:
+            # the frame length is fixed by the size now; if the file changes
+            # while it is sent, the hub rejects the blob since its sha1 is
+            # wrong, but the frame must still have exactly this length
+            remaining = os.fstat(f.fileno()).st_size
+            with self._send_lock:
+                self._sendall([
+                    struct.pack(">L", 37 + remaining),
+                    ('b' + sha1).encode('utf8')
+                ])
+                while remaining:
+                    n = f.readinto(view[:min(remaining, len(buf))])
+                    if not n:  # the file got shorter
+                        n = min(remaining, len(buf))
+                        view[:n] = bytes(n)
+                    self._sendall([view[:n]])
+                    remaining -= n
+        return sha1
+
+    def _recv_into(self, view):
         # see http://stackoverflow.com/questions/3016369/catching-blocking-sigint-during-system-call
         for i in range(20):
             try:
-                #print "blocking recv (i = %s), pid=%s"%(i, os.getpid())
-                r = self._conn.recv(n)
-                #log("n=%s; received: '%s' of len %s"%(n,r, len(r)))
-                return r
+                return self._conn.recv_into(view)
             except OSError as e:
-                #print("socket.error, msg=%s"%msg)
                 if e.errno != 4:
                     raise
         raise EOFError
 
-    def recv(self):
-        n = self._recv(4)
-        if len(n) < 4:
-            raise EOFError
-        n = struct.unpack('>L', n)[0]  # big endian 32 bits
-        s = self._recv(n)
-        while len(s) < n:
-            t = self._recv(n - len(s))
-            if len(t) == 0:
+    def _read(self, n):
+        """
+        Return a memoryview of the next n bytes received.  It is only valid
+        until the next call to _read.
+        """
+        if self._rend - self._rstart >= n:
+            view = memoryview(self._rbuf)[self._rstart:self._rstart + n]
+            self._rstart += n
+            return view
+        if n > len(self._rbuf):
+            # too big for the buffer, so receive it directly into its own
+            buf = bytearray(n)
+            view = memoryview(buf)
+            k = self._rend - self._rstart
+            view[:k] = memoryview(self._rbuf)[self._rstart:self._rend]
+            self._rstart = self._rend = 0
+            while k < n:
+                r = self._recv_into(view[k:])
+                if r == 0:
+                    raise EOFError
+                k += r
+            return view
+        # move what we have to the front, then fill the rest of the buffer
+        if self._rstart:
+            k = self._rend - self._rstart
+            self._rbuf[:k] = self._rbuf[self._rstart:self._rend]
+            self._rstart, self._rend = 0, k
+        view = memoryview(self._rbuf)
+        while self._rend < n:
+            r = self._recv_into(view[self._rend:])
+            if r == 0:
                 raise EOFError
-            s += t
+            self._rend += r
+        self._rstart = n
+        return view[:n]
 
-        if six.PY3:
-            # bystream to string, in particular s[0] will be e.g. 'j' and not 106
-            #log("ConnectionJSON::recv s=%s... (type %s)" % (s[:5], type(s)))
-            # is s always of type bytes?
-            if type(s) == bytes:
-                s = s.decode('utf8')
+    def poll(self, timeout=0):
+        """
+        Return True if data for another message is available, waiting up
+        to timeout seconds for it to arrive.
+        """
+        if self._rend > self._rstart:
+            return True
+        import select
+        try:
+            return bool(select.select([self._conn], [], [], timeout)[0])
+        except (OSError, select.error, ValueError):
+            # closed or interrupted; let recv report what happened
+            return True
 
-        if s[0] == 'j':
+    def recv(self):
+        n = struct.unpack('>L', self._read(4))[0]  # big endian 32 bits
+        if n == 0:
+            raise ValueError("empty message")
+        s = self._read(n)
+        typ = s[0:1].tobytes()
+        if typ == b'j':
             try:
-                return 'json', json.loads(s[1:])
+                return 'json', json.loads(s[1:].tobytes().decode('utf8'))
             except Exception as msg:
-                log("Unable to parse JSON '%s'" % s[1:])
+                log("Unable to parse JSON '%s'" % s[1:].tobytes())
                 raise
 
-        elif s[0] == 'b':
-            return 'blob', s[1:]
-        raise ValueError("unknown message type '%s'" % s[0])
+        elif typ == b'b':
+            # blobs are binary; we do not decode them
+            return 'blob', s[1:].tobytes()
+
+        elif typ == b'z':
+            codec = s[1:2].tobytes()
+            if codec not in CODECS:
+                raise ValueError("unknown compression codec '%s'" % codec)
+            return 'json', json.loads(CODECS[codec](s[2:]).decode('utf8'))
+        raise ValueError("unknown message type '%s'" % typ)
 
 
 def truncate_text(s, max_size):
@@ -321,8 +647,11 @@ class Message(object):
     def start_session(self):
         return self._new('start_session')
 
-    def session_description(self, pid):
-        return self._new('session_description', {'pid': pid})
+    def session_description(self, pid, encoding=None):
+        m = self._new('session_description', {'pid': pid})
+        if encoding is not None:
+            m['encoding'] = encoding
+        return m
 
     def send_signal(self, pid, signal=signal.SIGINT):
         return self._new('send_signal', locals())
@@ -330,6 +659,16 @@ class Message(object):
     def terminate_session(self, done=True):
         return self._new('terminate_session', locals())
 
+    def status(self, pid=None, children=None, finished=None, error=None):
+        m = self._new('status')
+        if error is not None:
+            m['error'] = error
+        else:
+            m['pid'] = pid
+            m['children'] = children
+            m['finished'] = finished
+        return m
+
     def execute_code(self, id, code, preparse=True):
         return self._new('execute_code', locals())
 
@@ -370,14 +709,16 @@ class Message(object):
                                                    sage_server.MAX_CODE_SIZE,
                                                    'MAX_CODE_SIZE')
             m['code'] = code
-        if stderr is not None and len(stderr) > 0:
-            m['stderr'], did_truncate, tmsg = t(stderr,
-                                                sage_server.MAX_STDERR_SIZE,
-                                                'MAX_STDERR_SIZE')
+        # stdout comes first, since that is the order in which clients show
+        # a message with both
         if stdout is not None and len(stdout) > 0:
             m['stdout'], did_truncate, tmsg = t(stdout,
                                                 sage_server.MAX_STDOUT_SIZE,
                                                 'MAX_STDOUT_SIZE')
+        if stderr is not None and len(stderr) > 0:
+            m['stderr'], did_truncate, tmsg = t(stderr,
+                                                sage_server.MAX_STDERR_SIZE,
+                                                'MAX_STDERR_SIZE')
         if html is not None and len(html) > 0:
             m['html'], did_truncate, tmsg = t(html, sage_server.MAX_HTML_SIZE,
                                               'MAX_HTML_SIZE')
@@ -477,10 +818,19 @@ def client1(port, hostname):
 
 
 class BufferedOutputStream(object):
+    """
+    File-like object that collects what is written to it and passes it on
+    to f(output, done=...) once flush_size characters are pending, when
+    flush is called, or -- unless an OutputFlusher takes care of that --
+    when flush_interval seconds have passed since the last flush.
+    """
 
     def __init__(self, f, flush_size=4096, flush_interval=.1):
         self._f = f
-        self._buf = ''
+        self._chunks = []
+        self._size = 0
+        self._lock = threading.Lock()
+        self._flusher = None  # set by OutputFlusher
         self._flush_size = flush_size
         self._flush_interval = flush_interval
         self.reset()
@@ -497,66 +847,251 @@ class BufferedOutputStream(object):
         # is destined to be *rendered* in the browser.  This is only a partial
         # solution to a more general problem, but it is safe.
         try:
-            self._buf += output.replace('\x00', '')
+            output = output.replace('\x00', '')
         except UnicodeDecodeError:
-            self._buf += output.decode('utf-8').replace('\x00', '')
-        #self.flush()
-        t = time.time()
-        if ((len(self._buf) >= self._flush_size)
-                or (t - self._last_flush_time >= self._flush_interval)):
+            output = output.decode('utf-8').replace('\x00', '')
+        with self._lock:
+            self._chunks.append(output)
+            self._size += len(output)
+            size = self._size
+        if size >= self._flush_size or (
+                self._flusher is None
+                and time.time() - self._last_flush_time >= self._flush_interval):
             self.flush()
-            self._last_flush_time = t
+
+    def _take(self):
+        """
+        Remove and return everything written since the last flush.
+        """
+        with self._lock:
+            buf = ''.join(self._chunks)
+            self._chunks = []
+            self._size = 0
+            self._last_flush_time = time.time()
+        return buf
 
     def flush(self, done=False):
-        if not self._buf and not done:
+        if self._flusher is not None:
+            self._flusher.flush(done=done, streams=(self, ))
+        else:
+            self._flush(done=done)
+
+    def _flush(self, done=False):
+        buf = self._take()
+        if not buf and not done:
             # no point in sending an empty message
             return
         try:
-            self._f(self._buf, done=done)
+            self._f(buf, done=done)
         except UnicodeDecodeError:
             if six.PY2:  # str doesn't have errors option in python2!
-                self._f(unicode(self._buf, errors='replace'), done=done)
+                self._f(unicode(buf, errors='replace'), done=done)
             else:
-                self._f(str(self._buf, errors='replace'), done=done)
-        self._buf = ''
+                self._f(str(buf, errors='replace'), done=done)
 
     def isatty(self):
         return False
 
 
-# This will *have* to be re-done using Cython for speed.
+class OutputFlusher(object):
+    """
+    Flushes the BufferedOutputStreams stdout and stderr of a cell that is
+    being executed every interval seconds from a background thread, so
+    output from a long computation keeps arriving even when nothing more is
+    written.
+
+    As long as the streams go to the cell (i.e., salvus.stdout and
+    salvus.stderr, not redirected by %capture), pending stdout and stderr
+    are sent together in one output message.  Redirected streams are only
+    flushed from the main thread.
+
+    Forking while a flusher runs (e.g., %fork or pmap) is safe: see
+    _flusher_after_fork_in_child.
+    """
+
+    # the flusher that is running, if any
+    current = None
+
+    def __init__(self, salvus, stdout, stderr, interval=.1):
+        self._salvus = salvus
+        self._stdout = stdout
+        self._stderr = stderr
+        self.interval = interval
+        # held while taking and sending output, so that nothing sent by the
+        # main thread after a flush can overtake output taken before it
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        stdout._flusher = stderr._flusher = self
+
+    def start(self):
+        OutputFlusher.current = self
+        self._thread = threading.Thread(target=self._run,
+                                        name='sage_server output')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if OutputFlusher.current is self:
+            OutputFlusher.current = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush(background=True)
+            except KeyboardInterrupt:
+                # too much output -- stop the computation like a flush in
+                # the main thread would
+                six.moves._thread.interrupt_main()
+                return
+            except Exception as err:
+                log("error flushing output, no longer flushing in the background",
+                    err)
+                return
+
+    def _to_cell(self):
+        return (self._stdout._f == self._salvus.stdout
+                and self._stderr._f == self._salvus.stderr)
+
+    def flush(self, done=False, streams=None, background=False):
+        """
+        Flush both streams, or only those in streams, with done set on the
+        last message sent.
+        """
+        if self._salvus._pending_files:
+            # send the files whose blobs are saved by now
+            self._salvus._send_files()
+        with self._lock:
+            if self._to_cell():
+                stdout = self._stdout._take()
+                stderr = self._stderr._take()
+                if stdout or stderr or done:
+                    self._salvus._send_output(stdout=stdout,
+                                              stderr=stderr,
+                                              done=done,
+                                              id=self._salvus._id)
+            elif not background:
+                if streams is None:
+                    streams = (self._stdout, self._stderr)
+                if len(streams) == 2 and not self._stderr._chunks:
+                    streams = streams[:1]
+                for stream in streams[:-1]:
+                    stream._flush()
+                streams[-1]._flush(done=done)
+
+
+# the flusher whose lock is held while forking
+_forking_flusher = None
+
+
+def _flusher_before_fork():
+    # so the background thread is not flushing at the moment of the fork
+    global _forking_flusher
+    flusher = OutputFlusher.current
+    if flusher is not None:
+        flusher._lock.acquire()
+        _forking_flusher = flusher
+
+
+def _flusher_after_fork_in_parent():
+    global _forking_flusher
+    if _forking_flusher is not None:
+        _forking_flusher._lock.release()
+        _forking_flusher = None
+
+
+def _flusher_after_fork_in_child():
+    """
+    The background thread of the flusher does not exist in a forked child,
+    so the child must neither wait for it nor for locks it might have held;
+    its output streams flush themselves instead.
+    """
+    global _forking_flusher
+    flusher = OutputFlusher.current
+    OutputFlusher.current = _forking_flusher = None
+    if flusher is not None:
+        flusher._thread = None
+        flusher._lock = threading.RLock()
+        for stream in (flusher._stdout, flusher._stderr):
+            stream._lock = threading.Lock()
+            stream._flusher = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_flusher_before_fork,
+                        after_in_parent=_flusher_after_fork_in_parent,
+                        after_in_child=_flusher_after_fork_in_child)
+
+
 class Namespace(dict):
+    """
+    The namespace that worksheet code runs in, which can call functions
+    when variables change or are deleted (see on).
+
+    As long as nobody listens, this is a dict subclass that does not
+    override item assignment, so assignments in worksheet code run at full
+    dict speed.  While there are listeners, the instance's class is swapped
+    to WatchedNamespace, which calls them.
+    """
 
     def __init__(self, x):
         self._on_change = {}
         self._on_del = {}
         dict.__init__(self, x)
 
-    def on(self, event, x, f):
+    def _listeners(self, event):
         if event == 'change':
-            if x not in self._on_change:
-                self._on_change[x] = []
-            self._on_change[x].append(f)
+            return self._on_change
         elif event == 'del':
-            if x not in self._on_del:
-                self._on_del[x] = []
-            self._on_del[x].append(f)
+            return self._on_del
+
+    def on(self, event, x, f):
+        """
+        Call f when x is assigned or deleted, according to event, which is
+        'change' or 'del'.  If x is None, f is called for all variables,
+        and gets the variable name too.
+        """
+        listeners = self._listeners(event)
+        if listeners is None:
+            return
+        if x not in listeners:
+            listeners[x] = []
+        listeners[x].append(f)
+        self.__class__ = WatchedNamespace
 
     def remove(self, event, x, f):
-        if event == 'change' and x in self._on_change:
-            v = self._on_change[x]
-            i = v.find(f)
-            if i != -1:
-                del v[i]
-            if len(v) == 0:
-                del self._on_change[x]
-        elif event == 'del' and x in self._on_del:
-            v = self._on_del[x]
-            i = v.find(f)
-            if i != -1:
-                del v[i]
-            if len(v) == 0:
-                del self._on_del[x]
+        listeners = self._listeners(event)
+        if listeners is None or x not in listeners:
+            return
+        v = listeners[x]
+        if f in v:
+            v.remove(f)
+        if len(v) == 0:
+            del listeners[x]
+        if not self._on_change and not self._on_del:
+            self.__class__ = Namespace
+
+    def set(self, x, y, do_not_trigger=None):
+        dict.__setitem__(self, x, y)
+        if x in self._on_change:
+            if do_not_trigger is None:
+                do_not_trigger = []
+            for f in self._on_change[x]:
+                if f not in do_not_trigger:
+                    f(y)
+        if None in self._on_change:
+            for f in self._on_change[None]:
+                f(x, y)
+
+
+class WatchedNamespace(Namespace):
+    """
+    A Namespace with listeners; see Namespace.
+    """
 
     def __setitem__(self, x, y):
         dict.__setitem__(self, x, y)
@@ -582,17 +1117,30 @@ class Namespace(dict):
             print(mesg)
         dict.__delitem__(self, x)
 
-    def set(self, x, y, do_not_trigger=None):
-        dict.__setitem__(self, x, y)
-        if x in self._on_change:
-            if do_not_trigger is None:
-                do_not_trigger = []
-            for f in self._on_change[x]:
-                if f not in do_not_trigger:
-                    f(y)
-        if None in self._on_change:
-            for f in self._on_change[None]:
-                f(x, y)
+
+# The blobs the hub has acknowledged saving in this session, mapping the
+# uuidsha1 to the time when the hub may discard it and the ttl from the
+# save_blob message.  Saving the same content again while it is still there
+# only needs the output message pointing to it.
+saved_blobs = sage_parsing.LRUCache(10000)
+
+
+def blob_ttl(sha1):
+    """
+    Return how many more seconds the blob with the given uuidsha1 is known
+    to be kept by the hub (0 for forever), or None if it should be sent
+    again.  Blobs are resent once half of their ttl has passed, so that a
+    new output message never points to a blob that is about to expire.
+    """
+    expires = saved_blobs.get(sha1)
+    if expires is None:
+        return None
+    if expires[1] == 0:
+        return 0
+    remaining = expires[0] - time.time()
+    if remaining < expires[1] / 2.0:
+        return None
+    return int(remaining)
 
 
 class TemporaryURL:
@@ -641,14 +1189,22 @@ class Salvus(object):
     _postfix = ''
     _default_mode = 'sage'
     _py_features = {}
+    # compiled blocks, keyed by the (preparsed) block and the compile flags
+    _compile_cache = sage_parsing.LRUCache(1024)
 
     def _flush_stdio(self):
         """
         Flush the standard output streams.  This should be called before sending any message
         that produces output.
         """
-        sys.stdout.flush()
-        sys.stderr.flush()
+        if self._pending_files:
+            self._send_files()
+        flusher = getattr(sys.stdout, '_flusher', None)
+        if flusher is not None:
+            flusher.flush()
+        else:
+            sys.stdout.flush()
+            sys.stderr.flush()
 
     def __repr__(self):
         return ''
@@ -665,6 +1221,17 @@ class Salvus(object):
         self.namespace = namespace
         self.message_queue = message_queue
         self.code_decorators = []  # gets reset if there are code decorators
+        # file output messages waiting for the hub to save their blob, as
+        # (uuidsha1, output message args, whether an ack is expected), and
+        # the save_blob acks received
+        self._pending_files = collections.deque()
+        self._blob_acks = {}
+        self._sending_files = False
+        # files are also sent from the OutputFlusher thread
+        self._files_lock = threading.RLock()
+        # lists that get the (args, kwds) of every output message appended,
+        # e.g., so %cache can replay the output of a cell
+        self._output_recorders = []
         # Alias: someday remove all references to "salvus" and instead use smc.
         # For now this alias is easier to think of and use.
         namespace['smc'] = namespace[
@@ -676,8 +1243,13 @@ class Salvus(object):
         sage.all.salvus = self
 
     def _send_output(self, *args, **kwds):
+        if self._pending_files and not self._sending_files:
+            # file output whose blob is saved goes first
+            self._send_files()
         if self._output_warning_sent:
             raise KeyboardInterrupt
+        for recorder in self._output_recorders:
+            recorder.append((args, dict(kwds)))
         mesg = message.output(*args, **kwds)
         if not mesg.get('once', False):
             self._num_output_messages += 1
@@ -817,9 +1389,13 @@ class Salvus(object):
             frame_aspect_ratio=None,  # synonym for aspect_ratio
             done=False,
             renderer=None,  # None, 'webgl', or 'canvas'
+            binary=True,  # False: send the scene as JSON text, for old clients
+            compress=True,  # zlib compress the buffers of a binary scene
+            max_faces=None,  # if given, decimate surfaces to about this many triangles
     ):
 
-        from .graphics import graphics3d_to_jsonable, json_float as f
+        from .graphics import (graphics3d_to_jsonable, sage3d_container,
+                               json_float as f)
 
         # process options, combining ones set explicitly above with ones inherited from 3d scene
         opts = {
@@ -897,14 +1473,22 @@ class Salvus(object):
         elif isinstance(frame, bool):
             fr['draw'] = frame
 
-        # convert the Sage graphics object to a JSON object that can be rendered
-        scene = {'opts': opts, 'obj': graphics3d_to_jsonable(g)}
+        # convert the Sage graphics object to a JSON object that can be rendered;
+        # in binary mode the vertex and face arrays go into separate buffers.
+        buffers = [] if binary else None
+        scene = {
+            'opts': opts,
+            'obj': graphics3d_to_jsonable(g, buffers, max_faces=max_faces)
+        }
 
         # Store that object in the database, rather than sending it directly as an output message.
         # We do this since obj can easily be quite large/complicated, and managing it as part of the
         # document is too slow and doesn't scale.
-        blob = json.dumps(scene, separators=(',', ':'))
-        uuid = self._conn.send_blob(blob)
+        if binary:
+            blob = sage3d_container(scene, buffers, compress=compress)
+        else:
+            blob = json.dumps(scene, separators=(',', ':'))
+        uuid = self._send_blob(blob)[0]
 
         # flush output (so any text appears before 3d graphics, in case they are interleaved)
         self._flush_stdio()
@@ -1011,39 +1595,162 @@ class Salvus(object):
             else:
                 return TemporaryURL(url=url, ttl=0)
 
-        file_uuid = self._conn.send_file(filename)
-
-        mesg = None
-        while mesg is None:
-            self.message_queue.recv()
-            for i, (typ, m) in enumerate(self.message_queue.queue):
-                if typ == 'json' and m.get('event') == 'save_blob' and m.get(
-                        'sha1') == file_uuid:
-                    mesg = m
-                    del self.message_queue[i]
-                    break
-
-        if 'error' in mesg:
-            raise RuntimeError("error saving blob -- %s" % mesg['error'])
+        file_uuid, ack = self._send_blob(filename=filename)
 
         self._flush_stdio()
-        self._send_output(id=self._id,
-                          once=once,
-                          file={
-                              'filename': filename,
-                              'uuid': file_uuid,
-                              'show': show,
-                              'text': text
-                          },
-                          events=events,
-                          done=done)
-        if not show:
+        output = dict(id=self._id,
+                      once=once,
+                      file={
+                          'filename': filename,
+                          'uuid': file_uuid,
+                          'show': show,
+                          'text': text
+                      },
+                      events=events,
+                      done=done)
+        # The output message is only sent once the hub has saved the blob,
+        # but there is no need to wait for that here: it is sent as soon as
+        # the ack arrives, with the next output or flush, and the end of the
+        # cell waits for it.
+        self._pending_files.append((file_uuid, output, ack))
+        if show:
+            self._send_files()
+        else:
+            self._send_files(block=True)
             info = self.project_info()
             url = "%s/blobs/%s?uuid=%s" % (info['base_url'], filename,
                                            file_uuid)
             if download:
                 url += '?download'
-            return TemporaryURL(url=url, ttl=mesg.get('ttl', 0))
+            return TemporaryURL(url=url, ttl=blob_ttl(file_uuid) or 0)
+
+    def _send_blob(self, blob=None, filename=None):
+        """
+        Send blob, or the content of filename, to be saved by the hub,
+        unless it has already saved it or is about to.  Returns its
+        uuidsha1 and whether a save_blob ack for it is on the way.
+        """
+        if filename is not None:
+            sha1 = uuidsha1_file(filename)
+        else:
+            if six.PY3 and type(blob) == str:
+                blob = blob.encode('utf8')
+            sha1 = uuidsha1(blob)
+        if any(sha1 == s and ack for s, _, ack in self._pending_files):
+            return sha1, True
+        if blob_ttl(sha1) is not None:
+            return sha1, False
+        if filename is not None:
+            self._conn.send_file(filename, sha1)
+        else:
+            self._conn.send_blob(blob, sha1)
+        return sha1, True
+
+    def _blob_saved(self, mesg):
+        """
+        Record the save_blob ack mesg.
+        """
+        self._blob_acks[mesg.get('sha1')] = mesg
+        if 'error' not in mesg:
+            ttl = mesg.get('ttl', 0)
+            saved_blobs[mesg.get('sha1')] = (time.time() + ttl, ttl)
+
+    def _send_files(self, block=False):
+        """
+        Send the pending file output messages, in order, once the hub has
+        saved their blobs.  Only send those whose blob is known to be saved
+        by now, unless block is True, in which case wait for all of them.
+        A blob that could not be saved is reported on stderr.
+        """
+        if not self._files_lock.acquire(block):
+            return  # another thread is sending them
+        try:
+            if self._sending_files:
+                return
+            self._sending_files = True
+            if not block:
+                self.message_queue.receive_available(0)
+            for typ, mesg in self.message_queue.take_all('save_blob'):
+                self._blob_saved(mesg)
+            while self._pending_files:
+                sha1, output, ack = self._pending_files[0]
+                if ack and sha1 not in self._blob_acks:
+                    if not block:
+                        break
+                    typ, mesg = self.message_queue.wait_for('save_blob', sha1)
+                    self._blob_saved(mesg)
+                mesg = self._blob_acks.get(sha1, {})
+                self._pending_files.popleft()
+                if 'error' in mesg:
+                    self._send_output(stderr="Error saving '%s' -- %s\n" %
+                                      (output['file']['filename'],
+                                       mesg['error']),
+                                      id=self._id,
+                                      done=False)
+                else:
+                    self._send_output(**output)
+        finally:
+            self._sending_files = False
+            if not self._pending_files:
+                self._blob_acks.clear()
+            self._files_lock.release()
+
+    def cache_stats(self):
+        """
+        Return the number of hits, misses and entries of the caches used
+        when executing code: 'blocks' (cells divided into blocks),
+        'preparse' (preparsed blocks) and 'compile' (compiled blocks).
+        """
+        return {
+            'blocks': sage_parsing.divide_cache.stats(),
+            'preparse': sage_parsing.preparse_cache.stats(),
+            'compile': Salvus._compile_cache.stats()
+        }
+
+    def checkpoint(self, filename=None, idle=None):
+        """
+        Save all picklable worksheet variables (except those from the
+        default namespace) to a compressed file, so that after a restart
+        smc.restore() brings them back in one step, instead of evaluating
+        all cells again.  Variables that can't be pickled are skipped and
+        listed.
+
+        INPUT:
+
+        - ``filename`` -- (default: a file under $SMC/checkpoints specific
+          to this worksheet)
+        - ``idle`` -- if given, also make a checkpoint automatically
+          whenever the worksheet has been idle for this many seconds after
+          executing code; 0 turns that off.
+
+        To resume automatically, put smc.restore() in a %auto cell.
+        """
+        if idle is not None:
+            checkpointer.idle = idle if idle > 0 else None
+        filename, saved, skipped = checkpointer.save(filename)
+        print("Saved %s variables to '%s'" % (len(saved), filename))
+        if skipped:
+            print("Skipped variables that can't be pickled: %s" %
+                  ', '.join(skipped))
+
+    def restore(self, filename=None):
+        """
+        Restore the worksheet variables saved by smc.checkpoint().
+        """
+        if filename is None and not os.path.exists(
+                checkpointer.default_filename()):
+            print("No checkpoint of this worksheet")
+            return
+        filename, restored = checkpointer.load(filename)
+        print("Restored %s variables from '%s'" % (len(restored), filename))
+
+    def pmap(self, f, inputs, **kwds):
+        """
+        Return [f(x) for x in inputs], computed in parallel by a pool of
+        processes forked from this session.  See sage_salvus.pmap.
+        """
+        from .sage_salvus import pmap
+        return pmap(f, inputs, **kwds)
 
     def python_future_feature(self, feature=None, enable=None):
         """
@@ -1174,7 +1881,6 @@ class Salvus(object):
                                0)
 
         #code   = sage_parsing.strip_leading_prompts(code)  # broken -- wrong on "def foo(x):\n   print(x)"
-        blocks = sage_parsing.divide_into_blocks(code)
 
         try:
             import sage.repl
@@ -1188,48 +1894,50 @@ class Salvus(object):
             pass  # expected behavior usually, since sage.repl.interpreter usually not imported (only used by command line...)
 
         import sage.misc.session
-        for start, stop, block in blocks:
-            # if import sage.repl.interpreter fails, sag_repl_interpreter is unreferenced
-            try:
-                do_pp = getattr(sage_repl_interpreter, '_do_preparse', True)
-            except:
-                do_pp = True
-            if preparse and do_pp:
-                block = sage_parsing.preparse_code(block)
-            sys.stdout.reset()
-            sys.stderr.reset()
-            try:
-                b = block.rstrip()
-                # get rid of comments at the end of the line -- issue #1835
-                #from ushlex import shlex
-                #s = shlex(b)
-                #s.commenters = '#'
-                #s.quotes = '"\''
-                #b = ''.join(s)
-                # e.g. now a line like 'x = test?   # bar' becomes 'x=test?'
-                if b.endswith('??'):
-                    p = sage_parsing.introspect(b,
-                                                namespace=namespace,
-                                                preparse=False)
-                    self.code(source=p['result'], mode="python")
-                elif b.endswith('?'):
-                    p = sage_parsing.introspect(b,
-                                                namespace=namespace,
-                                                preparse=False)
-                    self.code(source=p['result'], mode="text/x-rst")
-                else:
-                    reload_attached_files_if_mod_smc()
-                    if execute.count < 2:
-                        execute.count += 1
-                        if execute.count == 2:
-                            # this fixup has to happen after first block has executed (os.chdir etc)
-                            # but before user assigns any variable in worksheet
-                            # sage.misc.session.init() is not called until first call of show_identifiers
-                            # BUGFIX: be careful to *NOT* assign to _!!  see https://github.com/sagemathinc/cocalc/issues/1107
-                            block2 = "sage.misc.session.state_at_init = dict(globals());sage.misc.session._dummy=sage.misc.session.show_identifiers();\n"
-                            exec(compile(block2, '', 'single'), namespace,
-                                 locals)
-                            b2a = """
+        blocks, dec_keys = sage_parsing.hold_blocks(code)
+        try:
+            for start, stop, block in blocks:
+                # if import sage.repl.interpreter fails, sag_repl_interpreter is unreferenced
+                try:
+                    do_pp = getattr(sage_repl_interpreter, '_do_preparse', True)
+                except:
+                    do_pp = True
+                if preparse and do_pp:
+                    block = sage_parsing.preparse_code(block)
+                sys.stdout.reset()
+                sys.stderr.reset()
+                try:
+                    b = block.rstrip()
+                    # get rid of comments at the end of the line -- issue #1835
+                    #from ushlex import shlex
+                    #s = shlex(b)
+                    #s.commenters = '#'
+                    #s.quotes = '"\''
+                    #b = ''.join(s)
+                    # e.g. now a line like 'x = test?   # bar' becomes 'x=test?'
+                    if b.endswith('??'):
+                        p = sage_parsing.introspect(b,
+                                                    namespace=namespace,
+                                                    preparse=False)
+                        self.code(source=p['result'], mode="python")
+                    elif b.endswith('?'):
+                        p = sage_parsing.introspect(b,
+                                                    namespace=namespace,
+                                                    preparse=False)
+                        self.code(source=p['result'], mode="text/x-rst")
+                    else:
+                        reload_attached_files_if_mod_smc()
+                        if execute.count < 2:
+                            execute.count += 1
+                            if execute.count == 2:
+                                # this fixup has to happen after first block has executed (os.chdir etc)
+                                # but before user assigns any variable in worksheet
+                                # sage.misc.session.init() is not called until first call of show_identifiers
+                                # BUGFIX: be careful to *NOT* assign to _!!  see https://github.com/sagemathinc/cocalc/issues/1107
+                                block2 = "sage.misc.session.state_at_init = dict(globals());sage.misc.session._dummy=sage.misc.session.show_identifiers();\n"
+                                exec(compile(block2, '', 'single'), namespace,
+                                     locals)
+                                b2a = """
 if 'SAGE_STARTUP_FILE' in os.environ and os.path.isfile(os.environ['SAGE_STARTUP_FILE']):
     try:
         load(os.environ['SAGE_STARTUP_FILE'])
@@ -1239,64 +1947,70 @@ if 'SAGE_STARTUP_FILE' in os.environ and os.path.isfile(os.environ['SAGE_STARTUP
         sys.stderr.flush()
         raise
 """
-                            exec(compile(b2a, '', 'exec'), namespace, locals)
-                    features = sage_parsing.get_future_features(
-                        block, 'single')
-                    if features:
-                        compile_flags = reduce(
-                            operator.or_, (feature.compiler_flag
-                                           for feature in features.values()),
-                            compile_flags)
-                    exec(
-                        compile(block + '\n',
-                                '',
-                                'single',
-                                flags=compile_flags), namespace, locals)
-                    if features:
-                        Salvus._py_features.update(features)
-                sys.stdout.flush()
-                sys.stderr.flush()
-            except:
-                if ascii_warn:
-                    sys.stderr.write(
-                        '\n\n*** WARNING: Code contains non-ascii characters    ***\n'
-                    )
-                    for c in '\u201c\u201d':
-                        if c in code:
-                            sys.stderr.write(
-                                '*** Maybe the character < %s > should be replaced by < " > ? ***\n'
-                                % c)
-                            break
-                    sys.stderr.write('\n\n')
-
-                if six.PY2:
-                    from exceptions import SyntaxError, TypeError
-                # py3: all standard errors are available by default via "builtin", not available here for some reason ...
-                if six.PY3:
-                    from builtins import SyntaxError, TypeError
-
-                exc_type, _, _ = sys.exc_info()
-                if exc_type in [SyntaxError, TypeError]:
-                    from .sage_parsing import strip_string_literals
-                    code0, _, _ = strip_string_literals(code)
-                    implicit_mul = RE_POSSIBLE_IMPLICIT_MUL.findall(code0)
-                    if len(implicit_mul) > 0:
-                        implicit_mul_list = ', '.join(
-                            str(_) for _ in implicit_mul)
-                        # we know there is a SyntaxError and there could be an implicit multiplication
+                                exec(compile(b2a, '', 'exec'), namespace, locals)
+                        features = sage_parsing.get_future_features(
+                            block, 'single')
+                        if features:
+                            compile_flags = reduce(
+                                operator.or_, (feature.compiler_flag
+                                               for feature in features.values()),
+                                compile_flags)
+                        key = (block, compile_flags)
+                        code_obj = Salvus._compile_cache.get(key)
+                        if code_obj is None:
+                            code_obj = compile(block + '\n',
+                                               '',
+                                               'single',
+                                               flags=compile_flags)
+                            Salvus._compile_cache[key] = code_obj
+                        exec(code_obj, namespace, locals)
+                        if features:
+                            Salvus._py_features.update(features)
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                except:
+                    if ascii_warn:
                         sys.stderr.write(
-                            '\n\n*** WARNING: Code contains possible implicit multiplication    ***\n'
+                            '\n\n*** WARNING: Code contains non-ascii characters    ***\n'
                         )
-                        sys.stderr.write(
-                            '*** Check if any of [ %s ] need a "*" sign for multiplication, e.g. 5x should be 5*x ! ***\n\n'
-                            % implicit_mul_list)
-
-                sys.stdout.flush()
-                sys.stderr.write('Error in lines %s-%s\n' %
-                                 (start + 1, stop + 1))
-                traceback.print_exc()
-                sys.stderr.flush()
-                break
+                        for c in '\u201c\u201d':
+                            if c in code:
+                                sys.stderr.write(
+                                    '*** Maybe the character < %s > should be replaced by < " > ? ***\n'
+                                    % c)
+                                break
+                        sys.stderr.write('\n\n')
+
+                    if six.PY2:
+                        from exceptions import SyntaxError, TypeError
+                    # py3: all standard errors are available by default via "builtin", not available here for some reason ...
+                    if six.PY3:
+                        from builtins import SyntaxError, TypeError
+
+                    exc_type, _, _ = sys.exc_info()
+                    if exc_type in [SyntaxError, TypeError]:
+                        from .sage_parsing import strip_string_literals
+                        code0, _, _ = strip_string_literals(code)
+                        implicit_mul = RE_POSSIBLE_IMPLICIT_MUL.findall(code0)
+                        if len(implicit_mul) > 0:
+                            implicit_mul_list = ', '.join(
+                                str(_) for _ in implicit_mul)
+                            # we know there is a SyntaxError and there could be an implicit multiplication
+                            sys.stderr.write(
+                                '\n\n*** WARNING: Code contains possible implicit multiplication    ***\n'
+                            )
+                            sys.stderr.write(
+                                '*** Check if any of [ %s ] need a "*" sign for multiplication, e.g. 5x should be 5*x ! ***\n\n'
+                                % implicit_mul_list)
+
+                    sys.stdout.flush()
+                    sys.stderr.write('Error in lines %s-%s\n' %
+                                     (start + 1, stop + 1))
+                    traceback.print_exc()
+                    sys.stderr.flush()
+                    break
+        finally:
+            sage_parsing.dec_args.release(dec_keys)
 
     def execute_with_code_decorators(self,
                                      code_decorators,
@@ -1555,7 +2269,10 @@ if 'SAGE_STARTUP_FILE' in os.environ and os.path.isfile(os.environ['SAGE_STARTUP
             m['placeholder'] = unicode8(placeholder)
         self._send_output(raw_input=m, id=self._id)
         typ, mesg = self.message_queue.next_mesg()
-        log("handling raw input message ", truncate_text(unicode8(mesg), 400))
+        if _log.enabled(DEBUG):
+            log("handling raw input message ",
+                truncate_text(unicode8(mesg), 400),
+                level=DEBUG)
         if typ == 'json' and mesg['event'] == 'sage_raw_input':
             # everything worked out perfectly
             self.delete_last_output()
@@ -1748,6 +2465,131 @@ else:
     Salvus.delete_last_output.__doc__ = sage_salvus.delete_last_output.__doc__
 
 
+class Checkpointer(object):
+    """
+    Save the worksheet variables to a compressed file and restore them
+    from it, so a restarted session does not have to evaluate every cell
+    again.  Only picklable variables that differ from the default
+    namespace are saved; the others are reported as skipped.
+
+    If ``idle`` is set, a checkpoint is also made automatically once the
+    session has been idle for that many seconds after executing code.
+    """
+    def __init__(self):
+        self.idle = None
+        self.data = None  # data of the last execute message
+        self._timer = None
+        self._dirty = False
+        # held while executing code and while making a checkpoint
+        self._lock = threading.Lock()
+
+    def default_filename(self):
+        """
+        Return the checkpoint file of the current worksheet.
+        """
+        name = 'default'
+        if self.data and self.data.get('file'):
+            name = uuidsha1(
+                os.path.abspath(self.data['file']).encode('utf8'))
+        return os.path.join(os.environ.get('SMC', '.'), 'checkpoints',
+                            name + '.pickle.z')
+
+    def variables(self):
+        """
+        Return the worksheet variables that should be saved.
+        """
+        import types
+        from .sage_salvus import default_namespace
+        v = {}
+        for name, val in list(namespace.items()):
+            if name.startswith('_') or name in ('salvus', 'smc', 'require'):
+                continue
+            if isinstance(val, types.ModuleType):
+                continue
+            if default_namespace.get(name, None) is val:
+                continue
+            v[name] = val
+        return v
+
+    def save(self, filename=None):
+        """
+        Save the picklable worksheet variables to filename.  Returns the
+        filename, the names of the saved and of the skipped variables.
+        """
+        import pickle, zlib
+        from .sage_salvus import _picklable
+        if filename is None:
+            filename = self.default_filename()
+        values = self.variables()
+        skipped = []
+        if not _picklable(values):
+            skipped = sorted(k for k in values if not _picklable(values[k]))
+            for k in skipped:
+                del values[k]
+        data = zlib.compress(
+            pickle.dumps({
+                'version': 1,
+                'values': values
+            },
+                         protocol=pickle.HIGHEST_PROTOCOL), 1)
+        path = os.path.dirname(filename)
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+        tmp = '%s.%s.tmp' % (filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, filename)
+        self._dirty = False
+        return filename, sorted(values), skipped
+
+    def load(self, filename=None):
+        """
+        Set the worksheet variables saved in filename.  Returns the
+        filename and the names of the restored variables.
+        """
+        import pickle, zlib
+        if filename is None:
+            filename = self.default_filename()
+        with open(filename, 'rb') as f:
+            values = pickle.loads(zlib.decompress(f.read()))['values']
+        for name, val in values.items():
+            namespace[name] = val
+        return filename, sorted(values)
+
+    def start_execute(self, data):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # wait for an automatic checkpoint that is being made right now
+        self._lock.acquire()
+        if data is not None:
+            self.data = data
+
+    def end_execute(self):
+        self._dirty = True
+        self._lock.release()
+        if self.idle:
+            self._timer = threading.Timer(self.idle, self._auto_save)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _auto_save(self):
+        if not self._lock.acquire(False):
+            return  # executing code again
+        try:
+            if self._dirty:
+                filename, saved, skipped = self.save()
+                log("automatic checkpoint of %s variables to %s (skipped %s)"
+                    % (len(saved), filename, skipped))
+        except Exception as err:
+            log("automatic checkpoint failed: %s" % err)
+        finally:
+            self._lock.release()
+
+
+checkpointer = Checkpointer()
+
+
 def execute(conn, id, code, data, cell_id, preparse, message_queue):
 
     salvus = Salvus(conn=conn,
@@ -1758,11 +2600,14 @@ def execute(conn, id, code, data, cell_id, preparse, message_queue):
 
     #salvus.start_executing()  # with our new mainly client-side execution this isn't needed; not doing this makes evaluation roundtrip around 100ms instead of 200ms too, which is a major win.
 
+    checkpointer.start_execute(data)
     try:
         # initialize the salvus output streams
         streams = (sys.stdout, sys.stderr)
         sys.stdout = BufferedOutputStream(salvus.stdout)
         sys.stderr = BufferedOutputStream(salvus.stderr)
+        flusher = OutputFlusher(salvus, sys.stdout, sys.stderr)
+        flusher.start()
         try:
             # initialize more salvus functionality
             sage_salvus.set_salvus(salvus)
@@ -1780,14 +2625,18 @@ def execute(conn, id, code, data, cell_id, preparse, message_queue):
         salvus.execute(code, namespace=namespace, preparse=preparse)
 
     finally:
-        # there must be exactly one done message, unless salvus._done is False.
-        if sys.stderr._buf:
-            if sys.stdout._buf:
-                sys.stdout.flush()
-            sys.stderr.flush(done=salvus._done)
-        else:
-            sys.stdout.flush(done=salvus._done)
-        (sys.stdout, sys.stderr) = streams
+        try:
+            try:
+                # there must be exactly one done message, unless salvus._done is False.
+                flusher.stop()
+                salvus._send_files(block=True)
+                flusher.flush(done=salvus._done)
+            finally:
+                (sys.stdout, sys.stderr) = streams
+        finally:
+            # even if flushing fails (e.g., the output limit was hit), or
+            # the next cell waits forever for the checkpoint lock
+            checkpointer.end_execute()
 
 
 # execute.count goes from 0 to 2
@@ -1819,43 +2668,232 @@ def drop_privileges(id, home, transient, username):
     sage.misc.misc.DOT_SAGE = home + '/.sage/'
 
 
-class MessageQueue(list):
+class MessageQueue(object):
+    """
+    The messages received on conn that are waiting to be handled, oldest
+    first.
+
+    JSON messages are also indexed by event and by (event, key), where the
+    key is the sha1 of a save_blob ack or else the id of the message, so
+    that take and wait_for find a message without scanning the queue.
+    Messages are kept in OrderedDicts by sequence number, so that removing
+    one from the middle is O(1) too.
+
+    Several threads may wait for messages at once; one of them reads from
+    conn at a time, while the others wait on a condition variable.
+    """
 
     def __init__(self, conn):
-        self.queue = []
         self.conn = conn
+        self._queue = collections.OrderedDict()  # seq -> (typ, mesg)
+        self._index = {}  # event or (event, key) -> OrderedDict of seqs
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._receiving = False
 
     def __repr__(self):
         return "Sage Server Message Queue"
 
-    def __getitem__(self, i):
-        return self.queue[i]
-
-    def __delitem__(self, i):
-        del self.queue[i]
+    def __len__(self):
+        return len(self._queue)
+
+    def _index_keys(self, typ, mesg):
+        if typ != 'json':
+            return ()
+        event = mesg.get('event')
+        key = mesg.get('sha1', mesg.get('id'))
+        return (event, ) if key is None else (event, (event, key))
+
+    def _add(self, typ, mesg):
+        seq = self._seq
+        self._seq += 1
+        self._queue[seq] = (typ, mesg)
+        for k in self._index_keys(typ, mesg):
+            if k not in self._index:
+                self._index[k] = collections.OrderedDict()
+            self._index[k][seq] = None
+
+    def _remove(self, seq):
+        typ, mesg = self._queue.pop(seq)
+        for k in self._index_keys(typ, mesg):
+            seqs = self._index[k]
+            del seqs[seq]
+            if not seqs:
+                del self._index[k]
+        return typ, mesg
+
+    def _receive(self):
+        """
+        Receive one message and enqueue it.  Must be called with self._cond
+        held, which is released while waiting for the message.
+        """
+        while self._receiving:
+            self._cond.wait()
+        self._receiving = True
+        self._cond.release()
+        try:
+            typ, mesg = self.conn.recv()
+        finally:
+            self._cond.acquire()
+            self._receiving = False
+            self._cond.notify_all()
+        self._add(typ, mesg)
+        return typ, mesg
 
     def next_mesg(self):
         """
         Remove oldest message from the queue and return it.
         If the queue is empty, wait for a message to arrive
-        and return it (does not place it in the queue).
+        and return it.
         """
-        if self.queue:
-            return self.queue.pop()
-        else:
-            return self.conn.recv()
+        with self._cond:
+            while not self._queue:
+                self._receive()
+            return self._remove(next(iter(self._queue)))
 
     def recv(self):
         """
         Wait until one message is received and enqueue it.
         Also returns the mesg.
         """
-        mesg = self.conn.recv()
-        self.queue.insert(0, mesg)
+        with self._cond:
+            return self._receive()
+
+    def take(self, event, key=None):
+        """
+        Remove and return the oldest queued (typ, mesg) with the given
+        event, and key if given, or return None if there is none.
+        """
+        with self._cond:
+            seqs = self._index.get(event if key is None else (event, key))
+            if not seqs:
+                return None
+            return self._remove(next(iter(seqs)))
+
+    def receive_available(self, timeout=0):
+        """
+        Enqueue the messages that can be received within timeout seconds,
+        without blocking any longer than that.  Returns True if any
+        messages were received.
+        """
+        with self._cond:
+            if self._receiving:
+                # another thread is already reading from conn
+                self._cond.wait(timeout)
+                return False
+            received = False
+            while self.conn.poll(0 if received else timeout):
+                self._receive()
+                received = True
+            return received
+
+    def find(self, event, pred):
+        """
+        Return the newest queued (typ, mesg) with the given event for which
+        pred(mesg) is true, or None if there is none.
+        """
+        with self._cond:
+            for seq in reversed(list(self._index.get(event, ()))):
+                typ, mesg = self._queue[seq]
+                if pred(mesg):
+                    return typ, mesg
+            return None
+
+    def take_if(self, event, pred):
+        """
+        Remove and return all queued (typ, mesg) with the given event for
+        which pred(mesg) is true, oldest first.
+        """
+        with self._cond:
+            seqs = self._index.get(event)
+            if not seqs:
+                return []
+            return [
+                self._remove(seq) for seq in list(seqs)
+                if pred(self._queue[seq][1])
+            ]
+
+    def take_all(self, event):
+        """
+        Remove and return all queued (typ, mesg) with the given event.
+        """
+        with self._cond:
+            seqs = self._index.get(event)
+            if not seqs:
+                return []
+            return [self._remove(seq) for seq in list(seqs)]
+
+    def wait_for(self, event, key=None):
+        """
+        Remove and return the oldest (typ, mesg) with the given event, and
+        key if given, receiving messages until there is one.  Messages
+        received in the meantime stay in the queue.
+        """
+        with self._cond:
+            while True:
+                m = self.take(event, key)
+                if m is not None:
+                    return m
+                if self._receiving:
+                    self._cond.wait()
+                else:
+                    self._receive()
+
+
+def coalesce_interact(conn, mq, mesg):
+    """
+    If mesg asks to update an interact, merge into it all newer queued
+    updates of the same interact, and wait as long as the interact's
+    debounce and max_rate options require, merging whatever arrives in
+    the meantime.  Each superseded message is marked done, so the client
+    does not wait for its output.  Returns the message to execute.
+    """
+    id = sage_salvus.interact_update_id(mesg)
+    if id is None:
         return mesg
+    I = sage_salvus.interacts.get(id)
+    debounce = getattr(I, '_debounce', None)
+    min_interval = getattr(I, '_min_interval', None)
+    same = lambda m: sage_salvus.interact_update_id(m) == id
+    vals = dict(mesg['data']['vals'])
+    last = time.time()
+    mq.receive_available(0)
+    while True:
+        newer = mq.take_if('execute_code', same)
+        if newer:
+            for _, m in newer:
+                conn.send_json(message.output(id=mesg['id'], done=True))
+                vals.update(m['data']['vals'])
+                mesg = m
+            last = time.time()
+        deadline = last + debounce if debounce else 0
+        if min_interval:
+            deadline = max(deadline, I._last_call + min_interval)
+        wait = deadline - time.time()
+        if wait <= 0:
+            break
+        mq.receive_available(wait)
+    mesg = dict(mesg)
+    mesg['data'] = dict(mesg['data'], vals=vals)
+    return mesg
+
+
+def warm_session():
+    """
+    The part of setting up a compute session that does not depend on the
+    connection.  This is done either right after forking off a child for a
+    new connection, or ahead of time in a pre-forked pool worker.
+    """
+    # seed the random number generator(s)
+    import sage.all
+    sage.all.set_random_seed()
+    import random
+    random.seed(sage.all.initial_seed())
+    # imported by Salvus.execute on the first evaluation
+    import sage.misc.session
 
 
-def session(conn):
+def session(conn, warm=False):
     """
     This is run by the child process that is forked off on each new
     connection.  It drops privileges, then handles the complete
@@ -1864,16 +2902,15 @@ def session(conn):
     INPUT:
 
     - ``conn`` -- the TCP connection
+    - ``warm`` -- (default: False) if True, warm_session() was already
+      called in this process (e.g., by a pool worker)
     """
     mq = MessageQueue(conn)
 
     pid = os.getpid()
 
-    # seed the random number generator(s)
-    import sage.all
-    sage.all.set_random_seed()
-    import random
-    random.seed(sage.all.initial_seed())
+    if not warm:
+        warm_session()
 
     cnt = 0
     while True:
@@ -1881,12 +2918,16 @@ def session(conn):
             typ, mesg = mq.next_mesg()
 
             #print('INFO:child%s: received message "%s"'%(pid, mesg))
-            log("handling message ", truncate_text(unicode8(mesg), 400))
+            if _log.enabled(DEBUG):
+                log("handling message ",
+                    truncate_text(unicode8(mesg), 400),
+                    level=DEBUG)
             event = mesg['event']
             if event == 'terminate_session':
                 return
             elif event == 'execute_code':
                 try:
+                    mesg = coalesce_interact(conn, mq, mesg)
                     execute(conn=conn,
                             id=mesg['id'],
                             code=mesg['code'],
@@ -2074,7 +3115,7 @@ def unlock_conn(conn):
         return True
 
 
-def serve_connection(conn):
+def serve_connection(conn, warm=False):
     global PID
     PID = os.getpid()
     # First the client *must* send the secret shared token. If they
@@ -2103,26 +3144,433 @@ def serve_connection(conn):
             log("Sending a signal")
             os.kill(mesg['pid'], mesg['signal'])
         return
-    if mesg['event'] != 'start_session':
+    if mesg['event'] not in ['start_session', 'status']:
         log("Received an unknown message event = %s; terminating session." %
             mesg['event'])
         return
-
+    if mesg['event'] == 'status':
+        log("Sending server status")
+        conn.send_json(server_status())
+        return
     log("Starting a session")
-    desc = message.session_description(os.getpid())
+    encoding = negotiate_encoding(mesg.get('encoding'))
+    desc = message.session_description(os.getpid(), encoding=encoding)
     log("child sending session description back: %s" % desc)
     conn.send_json(desc)
-    session(conn=conn)
+    if encoding is not None:
+        conn.set_encoding(**encoding)
+    session(conn=conn, warm=warm)
+
+
+def _send_fd(sock, fd):
+    """
+    Pass the file descriptor fd to the process at the other end of the
+    unix domain socket sock (using SCM_RIGHTS).
+    """
+    sock.sendmsg(
+        [b'c'],
+        [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))])
+
+
+def _recv_fd(sock):
+    """
+    Wait for a file descriptor sent using _send_fd and return it.  Raises
+    EOFError if the other end closed the socket instead.
+    """
+    fds = array.array('i')
+    msg, ancdata, flags, addr = sock.recvmsg(
+        1, socket.CMSG_LEN(fds.itemsize))
+    for level, typ, data in ancdata:
+        if level == socket.SOL_SOCKET and typ == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    if not msg or len(fds) == 0:
+        raise EOFError
+    return fds[0]
+
+
+def serve_worker(sock):
+    """
+    This is run by a pre-forked pool worker.  It does the connection
+    independent session setup right away, then waits for the parent to hand
+    it an accepted connection over sock, and serves that connection.  After
+    that, sock is the control connection to the parent.
+    """
+    global PID
+    PID = os.getpid()
+    log("pool worker warming up")
+    warm_session()
+    log("pool worker waiting for a connection")
+    try:
+        fd = _recv_fd(sock)
+    except EOFError:
+        log("pool worker retired without serving a connection")
+        sys.exit(0)
+    set_control(sock)
+    serve_connection(socket.socket(fileno=fd), warm=True)
+    sys.exit(0)
+
+
+class WorkerPool(object):
+    """
+    A pool of pre-forked and pre-warmed session workers.
+
+    Each idle worker is parked on one end of a socketpair; when the server
+    accepts a connection, it passes the connection's file descriptor to the
+    oldest idle worker, which then serves it exactly like a child forked
+    off on accept would.
+
+    INPUT:
+
+    - ``size`` -- number of idle workers to keep around
+    - ``refill_rate`` -- at most this many new workers are forked per second
+    - ``max_lifetime`` -- idle workers older than this many seconds are
+      retired (and eventually replaced by fresh ones)
+    """
+    def __init__(self, size, refill_rate=1.0, max_lifetime=3600):
+        self.size = size
+        self.refill_rate = refill_rate
+        self.max_lifetime = max_lifetime
+        self._idle = collections.deque()  # (pid, sock, time started)
+        self._tokens = float(size)
+        self._last_refill = time.time()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def close_in_child(self):
+        """
+        Close the parent's ends of the worker sockets in a freshly forked
+        child; otherwise idle workers would not notice being retired.
+        """
+        for pid, sock, started in self._idle:
+            sock.close()
+        self._idle.clear()
+
+    def discard(self, pid):
+        """
+        Forget about the worker with the given pid, e.g., because it died.
+        """
+        for x in self._idle:
+            if x[0] == pid:
+                x[1].close()
+                self._idle.remove(x)
+                return
+
+    def refill(self, s, supervisor):
+        """
+        Retire expired idle workers and fork new ones, as allowed by the
+        refill rate.
+        """
+        now = time.time()
+        while self._idle and now - self._idle[0][2] > self.max_lifetime:
+            pid, sock, started = self._idle.popleft()
+            log("retiring idle pool worker %s" % pid)
+            sock.close()  # the worker exits when it sees EOF
+        self._tokens = min(
+            self.size,
+            self._tokens + (now - self._last_refill) * self.refill_rate)
+        self._last_refill = now
+        while len(self._idle) < self.size and self._tokens >= 1:
+            self._tokens -= 1
+            self._spawn(s, supervisor)
+
+    def _spawn(self, s, supervisor):
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid:  # parent
+            child_sock.close()
+            log("forked off pool worker %s" % pid)
+            self._idle.append((pid, parent_sock, time.time()))
+            supervisor.add(pid, kind='worker')
+        else:
+            # child
+            parent_sock.close()
+            self.close_in_child()
+            supervisor.close_in_child()
+            s.close()
+            serve_worker(child_sock)
+
+    def handoff(self, conn):
+        """
+        Pass conn to an idle worker.  Return (pid, sock), where sock is the
+        control connection to that worker, or None if there is no idle
+        worker able to take it.
+        """
+        while self._idle:
+            pid, sock, started = self._idle.popleft()
+            try:
+                _send_fd(sock, conn.fileno())
+                return pid, sock
+            except (OSError, socket.error) as err:
+                log("unable to hand connection to pool worker %s -- %s" %
+                    (pid, err))
+                sock.close()
+        return None
+
+
+# In a child of the server process: the control connection to the server,
+# which is used, e.g., to ask it about the status of all children.
+_control = None
+
+
+def set_control(sock):
+    global _control
+    _control = ConnectionJSON(sock)
+    sage_jupyter.take_spare_kernel = take_spare_kernel
+
+
+def server_status():
+    """
+    Return a status message describing all children of the server process.
+    """
+    if _control is None:
+        return message.status(error="no control connection to the server")
+    _control.send_json({'event': 'status'})
+    typ, mesg = _control.recv()
+    return mesg
+
 
+def take_spare_kernel(kernel_name):
+    """
+    Ask the server process for one of its spare Jupyter kernels with the
+    given kernelspec.  Return its connection info, or None if there is
+    none.  See sage_jupyter.KernelBroker.
+    """
+    if _control is None:
+        return None
+    _control.send_json({
+        'event': 'take_kernel',
+        'kernel_name': kernel_name,
+        'cwd': os.getcwd()
+    })
+    typ, mesg = _control.recv()
+    return mesg.get('connection_info')
+
+
+def _exit_status(status):
+    # the exit code, or minus the signal that killed the process
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _proc_usage(pid):
+    """
+    Return (cpu seconds, max rss in kilobytes) used so far by the running
+    process with given pid, or (None, None) if /proc is not available.
+    """
+    try:
+        with open('/proc/%s/stat' % pid) as f:
+            # the process name (field 2) can contain spaces and parens
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / float(
+            os.sysconf('SC_CLK_TCK'))
+        max_rss = None
+        with open('/proc/%s/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    max_rss = int(line.split()[1])
+                    break
+        return cpu, max_rss
+    except (IOError, OSError, IndexError, ValueError):
+        return None, None
+
+
+class ChildSupervisor(object):
+    """
+    Keep track of the children of the server process, and wait for new
+    connections and for children to exit at the same time.
 
-def serve(port, host, extra_imports=False):
+    When os.pidfd_open is available (Linux >= 5.3, Python >= 3.9), each child
+    gets a pidfd in the selector, so it is reaped (and its connection closed)
+    as soon as it exits.  Otherwise, children are polled whenever select
+    times out.  We do not use a SIGCHLD handler, since the children would
+    inherit it, which breaks pexpect.
+
+    Each child also has a control socket, over which it can ask for the
+    status of all children; see server_status.
+    """
+    MAX_FINISHED = 100
+
+    def __init__(self, on_exit=None, kernel_broker=None):
+        self.on_exit = on_exit
+        self.kernel_broker = kernel_broker
+        self.pidfd = hasattr(os, 'pidfd_open')
+        self._sel = selectors.DefaultSelector()
+        self._children = {}
+        # stats of the most recently finished children
+        self._finished = collections.deque(maxlen=self.MAX_FINISHED)
+
+    def __len__(self):
+        return len(self._children)
+
+    def listen(self, s):
+        self._sel.register(s, selectors.EVENT_READ, ('accept', None))
+
+    def add(self, pid, conn=None, ctrl=None, kind='session'):
+        child = {
+            'pid': pid,
+            'kind': kind,
+            'start': time.time(),
+            '_conn': None,
+            '_ctrl': None,
+            '_pidfd': None
+        }
+        self._children[pid] = child
+        if self.pidfd:
+            try:
+                child['_pidfd'] = os.pidfd_open(pid)
+                self._sel.register(child['_pidfd'], selectors.EVENT_READ,
+                                   ('exit', pid))
+            except OSError as err:
+                # e.g., kernel too old
+                log("pidfd_open failed, falling back to polling -- %s" % err)
+                self.pidfd = False
+        self.attach(pid, conn, ctrl)
+
+    def attach(self, pid, conn, ctrl):
+        """
+        Record that the child with given pid is serving conn, and talks to
+        us over ctrl.
+        """
+        child = self._children[pid]
+        if conn is not None:
+            child['_conn'] = conn
+            child['kind'] = 'session'
+            child['connected'] = time.time()
+        if ctrl is not None:
+            child['_ctrl'] = ctrl
+            self._sel.register(ctrl, selectors.EVENT_READ, ('control', pid))
+
+    def _close(self, child):
+        if child['_pidfd'] is not None:
+            self._sel.unregister(child['_pidfd'])
+            os.close(child['_pidfd'])
+        if child['_ctrl'] is not None:
+            self._sel.unregister(child['_ctrl'])
+            child['_ctrl'].close()
+        if child['_conn'] is not None:
+            child['_conn'].close()
+
+    def close_in_child(self):
+        """
+        Release everything the server process holds for its children, in a
+        freshly forked child.  In particular, sessions must not keep each
+        other's connections open.
+        """
+        for child in self._children.values():
+            for k in ['_pidfd', '_ctrl', '_conn']:
+                if child[k] is not None:
+                    if k == '_pidfd':
+                        os.close(child[k])
+                    else:
+                        child[k].close()
+        self._children.clear()
+        self._sel.close()
+        if self.kernel_broker is not None:
+            self.kernel_broker.close_in_child()
+
+    def reap(self, pid):
+        """
+        Reap the child with the given pid, if it has exited.  Return True if
+        it was reaped.
+        """
+        try:
+            p, status, rusage = os.wait4(pid, os.WNOHANG)
+        except ChildProcessError:
+            p, status, rusage = pid, None, None
+        if not p:
+            return False
+        child = self._children.pop(pid)
+        self._close(child)
+        info = self._info(child)
+        info['end'] = time.time()
+        if status is not None:
+            info['exit_status'] = _exit_status(status)
+            info['cpu'] = rusage.ru_utime + rusage.ru_stime
+            info['max_rss'] = rusage.ru_maxrss
+        self._finished.append(info)
+        log("subprocess %s terminated (exit status %s), closing connection" %
+            (pid, info.get('exit_status')))
+        if self.on_exit is not None:
+            self.on_exit(pid)
+        if self.kernel_broker is not None:
+            self.kernel_broker.session_exited(pid)
+        return True
+
+    def poll(self):
+        for pid in list(self._children.keys()):
+            self.reap(pid)
+
+    def _info(self, child):
+        return dict((k, v) for k, v in child.items() if not k.startswith('_'))
+
+    def status(self):
+        children = []
+        for child in self._children.values():
+            info = self._info(child)
+            info['cpu'], info['max_rss'] = _proc_usage(child['pid'])
+            children.append(info)
+        return message.status(pid=os.getpid(),
+                              children=children,
+                              finished=list(self._finished))
+
+    def _handle_control(self, pid):
+        conn = ConnectionJSON(self._children[pid]['_ctrl'])
+        try:
+            typ, mesg = conn.recv()
+        except (EOFError, ValueError, socket.error):
+            # the child closed its end, most likely since it is exiting
+            self._sel.unregister(self._children[pid]['_ctrl'])
+            self._children[pid]['_ctrl'].close()
+            self._children[pid]['_ctrl'] = None
+            if not self.pidfd:
+                self.reap(pid)
+            return
+        if mesg.get('event') == 'status':
+            conn.send_json(self.status())
+        elif mesg.get('event') == 'take_kernel':
+            info = None
+            if self.kernel_broker is not None:
+                info = self.kernel_broker.take(mesg.get('kernel_name'), pid,
+                                               mesg.get('cwd'))
+            conn.send_json({'event': 'kernel', 'connection_info': info})
+        else:
+            log("invalid control message from %s: %s" % (pid, mesg))
+
+    def select(self, timeout=None):
+        """
+        Wait up to timeout seconds, handling children that exit or send
+        control messages.  Return True if there is a connection to accept.
+        """
+        accept = False
+        for key, mask in self._sel.select(timeout):
+            event, pid = key.data
+            if event == 'accept':
+                accept = True
+            elif pid in self._children:
+                if event == 'exit':
+                    self.reap(pid)
+                elif event == 'control':
+                    self._handle_control(pid)
+        if not self.pidfd:
+            self.poll()
+        return accept
+
+
+def serve(port,
+          host,
+          extra_imports=False,
+          pool_size=0,
+          pool_refill_rate=1.0,
+          pool_max_lifetime=3600,
+          kernel_spares=0):
     #log.info('opening connection on port %s', port)
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-    # check for children that have finished every few seconds, so
-    # we don't end up with zombies.
-    s.settimeout(5)
+    # the ChildSupervisor below waits for connections
+    s.setblocking(False)
 
     s.bind((host, port))
     log('Sage server %s:%s' % (host, port))
@@ -2207,15 +3655,15 @@ def serve(port, host, extra_imports=False):
         namespace['_salvus_parsing'] = sage_parsing
 
         for name in [
-                'anaconda', 'asy', 'attach', 'auto', 'capture', 'cell',
-                'clear', 'coffeescript', 'cython', 'default_mode',
+                'anaconda', 'asy', 'attach', 'auto', 'cache', 'capture',
+                'cell', 'clear', 'coffeescript', 'cython', 'default_mode',
                 'delete_last_output', 'dynamic', 'exercise', 'fork', 'fortran',
                 'go', 'help', 'hide', 'hideall', 'input', 'java', 'javascript',
                 'julia', 'jupyter', 'license', 'load', 'md', 'mediawiki',
                 'modes', 'octave', 'pandoc', 'perl', 'plot3d_using_matplotlib',
-                'prun', 'python_future_feature', 'py3print_mode', 'python',
-                'python3', 'r', 'raw_input', 'reset', 'restore', 'ruby',
-                'runfile', 'sage_eval', 'scala', 'scala211', 'script',
+                'pmap', 'prun', 'python_future_feature', 'py3print_mode',
+                'python', 'python3', 'r', 'raw_input', 'reset', 'restore',
+                'ruby', 'runfile', 'sage_eval', 'scala', 'scala211', 'script',
                 'search_doc', 'search_src', 'sh', 'show', 'show_identifiers',
                 'singular_kernel', 'time', 'timeit', 'typeset_mode', 'var',
                 'wiki'
@@ -2241,6 +3689,11 @@ def serve(port, host, extra_imports=False):
         # this way client code can tell it is running as a Sage Worksheet.
         namespace['__SAGEWS__'] = True
 
+        # so that %python3, %r, etc., don't have to import Jupyter in each
+        # worksheet session
+        if sage_jupyter.preload():
+            log("imported jupyter_client")
+
     log("Initialize sage library.")
     init_library()
 
@@ -2248,59 +3701,124 @@ def serve(port, host, extra_imports=False):
     s.listen(128)
     i = 0
 
-    children = {}
+    supervisor = ChildSupervisor()
+    supervisor.listen(s)
+    kernel_broker = None
+    if kernel_spares:
+        kernel_broker = sage_jupyter.KernelBroker(spares=kernel_spares,
+                                                  log=log)
+        supervisor.kernel_broker = kernel_broker
+    pool = None
+    if pool_size:
+        if pool_refill_rate <= 0:
+            raise ValueError("pool_refill_rate must be positive")
+        log("using a pool of %s pre-forked workers" % pool_size)
+        pool = WorkerPool(pool_size,
+                          refill_rate=pool_refill_rate,
+                          max_lifetime=pool_max_lifetime)
+        supervisor.on_exit = pool.discard
+
+    # Wake up now and then to keep the pool of pre-forked workers topped up,
+    # and to start spare kernels soon after one was taken.
+    wakeup = None
+    if pool is not None:
+        wakeup = min(5, 1.0 / pool_refill_rate)
+    if kernel_broker is not None:
+        wakeup = min(wakeup or 5, 1.0)
+
     log("Starting server listening for connections")
     try:
         while True:
             i += 1
             #print i, time.time()-t, 'cps: ', int(i/(time.time()-t))
             # do not use log.info(...) in the server loop; threads = race conditions that hang server every so often!!
+            if pool is not None:
+                pool.refill(s, supervisor)
+            if kernel_broker is not None:
+                kernel_broker.refill()
+            # Without pidfd support, check for children that have finished
+            # every few seconds, so we don't end up with zombies.  This is
+            # checked each time, since add() turns pidfd off if it fails.
+            timeout = wakeup if supervisor.pidfd else min(wakeup or 5, 5)
+            if not supervisor.select(timeout):
+                continue
             try:
-                if children:
-                    for pid in list(children.keys()):
-                        if os.waitpid(pid, os.WNOHANG) != (0, 0):
-                            log("subprocess %s terminated, closing connection"
-                                % pid)
-                            conn.close()
-                            del children[pid]
-
-                try:
-                    conn, addr = s.accept()
-                    log("Accepted a connection from", addr)
-                except:
-                    # this will happen periodically since we did s.settimeout above, so
-                    # that we wait for children above periodically.
-                    continue
+                conn, addr = s.accept()
             except socket.error:
+                # e.g., the client already went away
                 continue
+            conn.setblocking(True)
+            log("Accepted a connection from", addr)
+            if pool is not None:
+                worker = pool.handoff(conn)
+                if worker is not None:
+                    log("handed this connection to pool worker %s" %
+                        worker[0])
+                    supervisor.attach(worker[0], conn, worker[1])
+                    continue
+            ctrl, child_ctrl = socket.socketpair()
             child_pid = os.fork()
             if child_pid:  # parent
                 log("forked off child with pid %s to handle this connection" %
                     child_pid)
-                children[child_pid] = conn
+                child_ctrl.close()
+                supervisor.add(child_pid, conn=conn, ctrl=ctrl)
             else:
                 # child
                 global PID
                 PID = os.getpid()
+                ctrl.close()
+                supervisor.close_in_child()
+                if pool is not None:
+                    pool.close_in_child()
+                set_control(child_ctrl)
                 log("child process, will now serve this new connection")
                 serve_connection(conn)
+                sys.exit(0)
 
         # end while
     except Exception as err:
-        log("Error taking connection: ", err)
-        traceback.print_exc(file=open(LOGFILE, 'a'))
+        log("Error taking connection: ", err, traceback.format_exc(),
+            level=ERROR)
         #log.error("error: %s %s", type(err), str(err))
 
     finally:
         log("closing socket")
         #s.shutdown(0)
         s.close()
+        if kernel_broker is not None:
+            # a no-op in children, which forget about the kernels
+            kernel_broker.close()
+
+
+def run_server(port,
+               host,
+               pidfile,
+               logfile=None,
+               pool_size=0,
+               pool_refill_rate=1.0,
+               pool_max_lifetime=3600,
+               kernel_spares=0):
+    """
+    Run the Sage server on the given port and host.
 
+    INPUT:
 
-def run_server(port, host, pidfile, logfile=None):
-    global LOGFILE
+    - ``pool_size`` -- (default: 0) number of pre-forked, pre-warmed session
+      workers to keep ready; 0 means fork a new child on each connection
+    - ``pool_refill_rate`` -- (default: 1.0) maximum number of pool workers
+      forked per second
+    - ``pool_max_lifetime`` -- (default: 3600) idle pool workers are replaced
+      after this many seconds
+    - ``kernel_spares`` -- (default: 0) number of warm spare Jupyter kernels
+      to keep for each recently used kernelspec; 0 means start a new kernel
+      each time a worksheet asks for one.  Each spare kernel is a process
+      that uses memory even if no worksheet ever takes it, so this is only
+      worth turning on where sessions often start Jupyter kernels
+    """
     if logfile:
-        LOGFILE = logfile
+        set_logfile(logfile)
+    server_pid = os.getpid()
     if pidfile:
         pid = str(os.getpid())
         print("os.getpid() = %s" % pid)
@@ -2308,12 +3826,32 @@ def run_server(port, host, pidfile, logfile=None):
     log("run_server: port=%s, host=%s, pidfile='%s', logfile='%s'" %
         (port, host, pidfile, LOGFILE))
     try:
-        serve(port, host)
+        serve(port,
+              host,
+              pool_size=pool_size,
+              pool_refill_rate=pool_refill_rate,
+              pool_max_lifetime=pool_max_lifetime,
+              kernel_spares=kernel_spares)
     finally:
-        if pidfile:
+        # children that exit end up here too; only the server owns the pidfile
+        if pidfile and os.getpid() == server_pid:
             os.unlink(pidfile)
 
 
+def positive_float(s):
+    """
+    Parse a command line argument that must be a positive number.
+    """
+    import argparse
+    try:
+        x = float(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid number: '%s'" % s)
+    if not x > 0:
+        raise argparse.ArgumentTypeError("must be positive: '%s'" % s)
+    return x
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="Run Sage server")
@@ -2329,9 +3867,10 @@ if __name__ == "__main__":
         "-l",
         dest='log_level',
         type=str,
-        default='INFO',
+        default='DEBUG',
         help=
-        "log level (default: INFO) useful options include WARNING and DEBUG")
+        "log level (default: DEBUG, which logs every message sent and received); useful options include INFO and WARNING"
+    )
     parser.add_argument("-d",
                         dest="daemon",
                         default=False,
@@ -2371,6 +3910,34 @@ if __name__ == "__main__":
                         type=str,
                         default='',
                         help="write port to this file")
+    parser.add_argument(
+        "--pool-size",
+        dest="pool_size",
+        type=int,
+        default=0,
+        help=
+        "number of pre-forked session workers to keep ready (default: 0 = fork on each connection)"
+    )
+    parser.add_argument(
+        "--pool-refill-rate",
+        dest="pool_refill_rate",
+        type=positive_float,
+        default=1.0,
+        help="maximum number of pool workers forked per second (default: 1)")
+    parser.add_argument(
+        "--pool-max-lifetime",
+        dest="pool_max_lifetime",
+        type=float,
+        default=3600,
+        help="replace idle pool workers after this many seconds (default: 3600)")
+    parser.add_argument(
+        "--kernel-spares",
+        dest="kernel_spares",
+        type=int,
+        default=0,
+        help=
+        "number of warm spare Jupyter kernels to keep for each recently used kernelspec; each one is an idle process using memory (default: 0)"
+    )
 
     args = parser.parse_args()
 
@@ -2379,9 +3946,7 @@ if __name__ == "__main__":
         sys.exit(1)
 
     if args.log_level:
-        pass
-        #level = getattr(logging, args.log_level.upper())
-        #log.setLevel(level)
+        set_log_level(args.log_level)
 
     if args.client:
         client1(
@@ -2401,11 +3966,17 @@ if __name__ == "__main__":
     pidfile = os.path.abspath(args.pidfile) if args.pidfile else ''
     logfile = os.path.abspath(args.logfile) if args.logfile else ''
     if logfile:
-        LOGFILE = logfile
-        open(LOGFILE, 'w')  # for now we clear it on restart...
+        set_logfile(logfile,
+                    truncate=True)  # for now we clear it on restart...
         log("setting logfile to %s" % LOGFILE)
 
-    main = lambda: run_server(port=args.port, host=args.host, pidfile=pidfile)
+    main = lambda: run_server(port=args.port,
+                              host=args.host,
+                              pidfile=pidfile,
+                              pool_size=args.pool_size,
+                              pool_refill_rate=args.pool_refill_rate,
+                              pool_max_lifetime=args.pool_max_lifetime,
+                              kernel_spares=args.kernel_spares)
     if args.daemon and args.pidfile:
         from . import daemon
         daemon.daemonize(args.pidfile)
@@ -650,6 +650,90 @@ def execinteract(request, sagews, test_id):
     return execfn
 
 
+@pytest.fixture()
+def execinteractupdates(request, sagews, test_id):
+    r"""
+    Fixture for tests of what an interact does when its controls change.
+
+    INPUT:
+
+    - ``code`` -- code that creates an interact
+
+    - ``updates`` -- list of dicts of new values of the controls, which are
+      sent like the client does when they change
+
+    - ``delay`` -- seconds to wait between sending two updates
+
+    - ``sequential`` -- if True, wait for the output of each update before
+      sending the next one, so they can't be merged
+
+    OUTPUT:
+
+    - a list with the stdout and the list of file uuids output in reply to
+      each update; the blobs of the files are acknowledged like the hub does
+
+    EXAMPLES:
+
+    ::
+
+        def test_interact(execinteractupdates):
+            outputs = execinteractupdates("@interact\ndef f(x=1): print(x)",
+                                          [{'x': '2'}])
+            assert outputs == [("2\n", [])]
+
+    """
+    import uuid
+
+    def recv_outputs(ids):
+        outputs = dict((id, ('', [])) for id in ids)
+        todo = set(ids)
+        while todo:
+            typ, mesg = sagews.recv()
+            if typ == 'blob':
+                sagews.send_json(message.save_blob(sha1=mesg[:36].decode()))
+                continue
+            assert typ == 'json'
+            assert mesg['id'] in outputs
+            stdout, files = outputs[mesg['id']]
+            if 'file' in mesg:
+                files.append(mesg['file']['uuid'])
+            outputs[mesg['id']] = (stdout + mesg.get('stdout', ''), files)
+            if mesg.get('done'):
+                todo.discard(mesg['id'])
+        return [outputs[id] for id in ids]
+
+    def execfn(code, updates, delay=0, sequential=False):
+        m = message.execute_code(code=code, id=test_id)
+        m['preparse'] = True
+        sagews.send_json(m)
+        typ, mesg = sagews.recv()
+        assert typ == 'json'
+        assert mesg['id'] == test_id
+        assert 'interact' in mesg
+        interact_id = mesg['interact']['id']
+        recv_til_done(sagews, test_id)
+
+        ids = []
+        outputs = []
+        for i, vals in enumerate(updates):
+            if i and delay:
+                time.sleep(delay)
+            id = str(uuid.uuid4())
+            m = message.execute_code(
+                code=
+                'salvus._execute_interact(salvus.data["id"], salvus.data["vals"])',
+                id=id)
+            m['data'] = {'id': interact_id, 'vals': vals}
+            sagews.send_json(m)
+            if sequential:
+                outputs += recv_outputs([id])
+            else:
+                ids.append(id)
+        return outputs + recv_outputs(ids)
+
+    return execfn
+
+
 @pytest.fixture()
 def execblob(request, sagews, test_id):
     def execblobfn(code,
@@ -668,6 +752,10 @@ def execblob(request, sagews, test_id):
 
         SHA_LEN = 36
 
+        # sage_server does not send a blob again once it has been saved in this session
+        if not hasattr(sagews, 'saved_blobs'):
+            sagews.saved_blobs = set()
+
         # format and send the plot command
         m = message.execute_code(code=code, id=test_id)
         sagews.send_json(m)
@@ -688,6 +776,7 @@ def execblob(request, sagews, test_id):
                 # sage_server expects an ack with the right uuid
                 m = message.save_blob(sha1=file_uuid)
                 sagews.send_json(m)
+                sagews.saved_blobs.add(file_uuid)
             else:
                 assert typ == 'json'
                 if 'html' in mesg:
@@ -705,6 +794,8 @@ def execblob(request, sagews, test_id):
                     want_name = False
                     assert 'file' in mesg
                     print('got file name')
+                    if mesg['file'].get('uuid') in sagews.saved_blobs:
+                        want_blob = False
                     if isinstance(file_type, str):
                         assert file_type in mesg['file']['filename']
                     elif isinstance(file_type, list):
@@ -51,11 +51,53 @@ class TestThreeJS:
             ignore_stdout=True,
             file_type='sage3d')
 
+    def test_binary_scene(self, execblob):
+        execblob(
+            "show(plot3d(x*y, (x,-1,1), (y,-1,1)))",
+            want_html=False,
+            file_type='sage3d')
+
+    def test_json_scene(self, execblob):
+        execblob(
+            "show(plot3d(x*y, (x,-1,1), (y,-1,1)), binary=False)",
+            want_html=False,
+            file_type='sage3d')
+
+    def test_json_scene_format(self, exec2):
+        # the JSON text format has the same vertices and 1-based faces as
+        # the Wavefront obj representation, like it always had
+        code = dedent(r"""
+        from smc_sagews.graphics import graphics3d_to_jsonable
+        p = plot3d(x*y, (x,-1,1), (y,-1,1), plot_points=4)
+        o = graphics3d_to_jsonable(p)[0]
+        lines = [l.split() for l in p.obj().splitlines()]
+        faces = [[int(a) for a in l[1:]] for l in lines if l and l[0] == 'f']
+        v = [float(a) for l in lines if l and l[0] == 'v' for a in l[1:]]
+        print(o['face_geometry'][0]['faces'] == faces,
+              len(o['vertex_geometry']) == len(v),
+              max(abs(a - b) for a, b in zip(o['vertex_geometry'], v)) < 1e-6)""")
+        exec2(code, "True True True\n")
+
+    def test_max_faces(self, execblob):
+        execblob(
+            "show(plot3d(sin(x*y), (x,-3,3), (y,-3,3), plot_points=300), max_faces=5000)",
+            want_html=False,
+            file_type='sage3d')
+
+    def test_max_faces_keeps_small_surfaces(self, exec2):
+        exec2(
+            "from smc_sagews.graphics import face_budgets\n"
+            "print(face_budgets([4, 90000, 50], 1000))", "[4, 946, 50]\n")
+
 
 class TestGraphics:
     def test_plot(self, execblob):
         execblob("plot(cos(x),x,0,pi)", want_html=False, file_type='svg')
 
+    def test_plot_again(self, execblob):
+        # the blob was saved by test_plot, so only the file message is sent
+        execblob("plot(cos(x),x,0,pi)", want_html=False, file_type='svg')
+
 
 class TestOctavePlot:
     def test_octave_plot(self, execblob):
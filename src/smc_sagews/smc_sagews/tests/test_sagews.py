@@ -4,6 +4,7 @@ from __future__ import absolute_import
 import conftest
 import os
 import re
+import time
 
 from textwrap import dedent
 
@@ -307,6 +308,177 @@ class TestBlockParser:
         else:
             z"""), "3\n[1, 2]\n'a'\n'b'\n'b'\n")
 
+    def test_block_parser_rerun(self, exec2):
+        # the second run uses the cached blocks, which must still work
+        exec2("def twice(code): return code + '\\n' + code")
+        code = "n = 0\n%twice n += 1\nn"
+        exec2(code, "2\n")
+        exec2(code, "2\n")
+
+    def test_dec_args_bounded(self, exec2):
+        # rerunning a cell must not leave more decorator arguments behind
+        code = "n = 0\n%twice n += 1"
+        exec2(code)
+        exec2("k = len(_salvus_parsing.dec_args)")
+        exec2(code)
+        exec2("len(_salvus_parsing.dec_args) == k", "True\n")
+
+
+class TestExecuteCaches:
+    def test_cache_stats(self, exec2):
+        exec2("a = 2^3")
+        exec2("s0 = salvus.cache_stats()")
+        exec2("a = 2^3")
+        exec2(
+            "s1 = salvus.cache_stats(); all(s1[c]['hits'] > s0[c]['hits'] for c in s1)",
+            "True\n")
+
+
+class TestConnectionJSON:
+    def test_connection_setup(self, exec2):
+        code = dedent(r"""
+        import json, socket, struct, threading, zlib
+        import time as time_module
+        # sage_server is the running server module, in the worksheet namespace
+        ConnectionJSON = sage_server.ConnectionJSON
+        COMPRESSORS, SERIALIZERS = sage_server.COMPRESSORS, sage_server.SERIALIZERS
+        cj_a, cj_b = socket.socketpair()
+        cj_send, cj_recv = ConnectionJSON(cj_a), ConnectionJSON(cj_b)
+
+        def cj_in_thread(f, *args):
+            # the other end reads while this one writes, so big frames can't block
+            t = threading.Thread(target=f, args=args)
+            t.start()
+            return t
+
+        def cj_roundtrip(m):
+            t = cj_in_thread(cj_send.send_json, m)
+            r = cj_recv.recv()
+            t.join()
+            return r
+
+        def cj_raw_frame():
+            def read(n):
+                s = b''
+                while len(s) < n:
+                    s += cj_b.recv(n - len(s))
+                return s
+            return read(struct.unpack('>L', read(4))[0])
+
+        def cj_send_slowly(frame):
+            # in pieces, so the receiver needs several recv_into calls per frame
+            for i in range(0, len(frame), 4096):
+                cj_a.sendall(frame[i:i + 4096])
+                time_module.sleep(0.001)
+
+        cj_small = {'event': 'output', 'stdout': 'x' * int(10000)}
+        cj_big = {'event': 'output', 'stdout': 'y' * int(100000), 'n': [int(1), None, 'z']}""")
+        exec2(code)
+
+    def test_encodings_roundtrip(self, exec2):
+        # plain and orjson, uncompressed and with each codec, small and big
+        code = dedent(r"""
+        ok = []
+        for ser in SERIALIZERS:
+            for comp in [None] + sorted(COMPRESSORS):
+                cj_send.set_encoding(serializer=ser, compression=comp, threshold=int(16))
+                ok += [cj_roundtrip(m) == ('json', m) for m in [cj_small, cj_big, {'a': int(1)}]]
+        print(all(ok), len(ok) == 3 * len(SERIALIZERS) * (len(COMPRESSORS) + 1))""")
+        exec2(code, "True True\n")
+
+    def test_compressed_frame(self, exec2):
+        # only messages at least threshold bytes long are compressed
+        code = dedent(r"""
+        cj_send.set_encoding(compression='zlib', threshold=int(16))
+        t = cj_in_thread(cj_send.send_json, cj_big)
+        frame = cj_raw_frame()
+        t.join()
+        t = cj_in_thread(cj_send.send_json, {'a': int(1)})
+        small = cj_raw_frame()
+        t.join()
+        print(frame[:2], len(frame) < 1000, small[:1])""")
+        exec2(code, "b'zz' True b'j'\n")
+
+    def test_frames_in_pieces(self, exec2):
+        # plain and compressed frames, in the receive buffer and bigger
+        code = dedent(r"""
+        ok = []
+        for m in [cj_small, cj_big]:
+            data = json.dumps(m).encode('utf8')
+            z = zlib.compress(data)
+            for frame in [b'j' + data, b'zz' + z]:
+                t = cj_in_thread(cj_send_slowly, struct.pack('>L', len(frame)) + frame)
+                ok.append(cj_recv.recv() == ('json', m))
+                t.join()
+        print(ok)""")
+        exec2(code, "[True, True, True, True]\n")
+
+    def test_negotiate_encoding(self, exec2):
+        code = dedent(r"""
+        negotiate_encoding = sage_server.negotiate_encoding
+        print(negotiate_encoding(None))
+        print(negotiate_encoding({'serializer': ['nope', 'json'], 'compression': ['nope', 'zlib'], 'threshold': int(100)}))
+        print(negotiate_encoding({'compression': 'nope'}))""")
+        exec2(
+            code, "None\n"
+            "{'serializer': 'json', 'compression': 'zlib', 'threshold': 100}\n"
+            "{'serializer': 'json', 'compression': None, 'threshold': 4096}\n")
+
+
+class TestCacheDecorator:
+    def test_cache_setup(self, exec2):
+        exec2("cache_dir = tmp_dir(); m = 2^64 - 1")
+
+    def test_cache_miss(self, exec2):
+        exec2("%cache(path=cache_dir)\nf = factor(m); print(f)",
+              "3 * 5 * 17 * 257 * 641 * 65537 * 6700417\n")
+
+    def test_cache_hit(self, exec2):
+        exec2("f = 0")
+        exec2("%cache(path=cache_dir)\nf = factor(m); print(f)",
+              "3 * 5 * 17 * 257 * 641 * 65537 * 6700417\n")
+        exec2("f == factor(m)", "True\n")
+
+    def test_cache_key_depends_on_inputs(self, exec2):
+        exec2("m = 2^32 - 1")
+        exec2("%cache(path=cache_dir)\nf = factor(m); print(f)",
+              "3 * 5 * 17 * 257 * 65537\n")
+        exec2("cache(path=cache_dir).stats()['entries']", "2\n")
+
+    def test_cache_skips_files(self, execblob, exec2):
+        # the hub only keeps the blob of the plot for a while
+        execblob("%cache(path=cache_dir)\nplot(sin(x), 0, 1)",
+                 want_html=False,
+                 file_type='svg')
+        exec2("cache(path=cache_dir).stats()['entries']", "2\n")
+
+
+class TestPmap:
+    def test_pmap(self, exec2):
+        exec2("pmap(lambda n: n^2, [1..5], ncpus=2, progress=False)",
+              "[1, 4, 9, 16, 25]\n")
+
+    def test_pmap_sees_worksheet_variables(self, exec2):
+        exec2("c = 10; smc.pmap(lambda n: n + c, [1, 2], progress=False)",
+              "[11, 12]\n")
+        exec2("c = 20; smc.pmap(lambda n: n + c, [1, 2], progress=False)",
+              "[21, 22]\n")
+
+    def test_pmap_error(self, exec2):
+        exec2("pmap(lambda n: 1/n, [1, 0], progress=False)",
+              errout="ZeroDivisionError")
+
+
+class TestCheckpoint:
+    def test_checkpoint(self, exec2):
+        exec2("cp_file = tmp_filename(); cp_a = 17; cp_f = lambda: 1")
+        exec2("smc.checkpoint(cp_file)",
+              pattern=r"Saved \d+ variables[\s\S]*can't be pickled: .*cp_f")
+
+    def test_restore(self, exec2):
+        exec2("cp_a = 0; smc.restore(cp_file); print(cp_a)",
+              pattern=r"Restored \d+ variables[\s\S]*17")
+
 
 class TestIntrospect:
     # test names end with SMC issue number
@@ -423,6 +595,62 @@ class TestAttach:
         exec2("paf()", "attached files: 0\n\n")
 
 
+class TestInteractOptions:
+    def test_debounce(self, execinteract):
+        execinteract("@interact(debounce=0.2)\ndef f(x=1): print(x)")
+
+    def test_coalesce(self, execinteractupdates):
+        code = dedent(r"""
+        @interact
+        def f(x=1):
+            sleep(1)
+            print(x)""")
+        outputs = execinteractupdates(code, [{'x': str(x)} for x in [2, 3, 4, 5]])
+        # the values queued while f was busy are merged into the last one
+        assert outputs[-1] == ("5\n", [])
+        assert outputs[1:-1] == [('', []), ('', [])]
+
+    def test_debounce_waits(self, execinteractupdates):
+        code = "@interact(debounce=1)\ndef f(x=1): print(x)"
+        outputs = execinteractupdates(code, [{'x': '2'}, {'x': '3'}], delay=0.3)
+        assert outputs == [('', []), ("3\n", [])]
+
+    def test_cancel(self, execinteractupdates):
+        code = dedent(r"""
+        @interact(cancel=True)
+        def f(x=1):
+            print(x)
+            if x == 2:
+                sleep(10)
+                print("not cancelled")""")
+        start = time.time()
+        outputs = execinteractupdates(code, [{'x': '2'}, {'x': '3'}], delay=0.5)
+        assert outputs == [("2\n", []), ("3\n", [])]
+        assert time.time() - start < 10
+
+    def test_max_rate_no_cancel(self, execinteract):
+        execinteract(
+            "@interact(max_rate=5, cancel=False)\ndef f(x=1): print(x)")
+
+    def test_cache(self, execinteract):
+        execinteract("@interact(cache=16)\ndef f(n=[1..5]): print(factor(n))")
+
+    def test_cache_replay(self, execinteractupdates):
+        code = dedent(r"""
+        @interact(cache=True)
+        def f(n=1):
+            print(n)
+            show(plot(x^n, (x, 0, 1)))""")
+        outputs = execinteractupdates(code, [{'n': n} for n in ['1', '2', '1']],
+                                      sequential=True)
+        stdout, files = outputs[0]
+        assert stdout == "1\n"
+        assert len(files) == 1
+        assert outputs[1][0] == "2\n"
+        # the plot is replayed along with the printed value
+        assert outputs[2] == outputs[0]
+
+
 class TestSearchSrc:
     def test_search_src_simple(self, execinteract):
         execinteract('search_src("convolution")')
@@ -431,6 +659,45 @@ class TestSearchSrc:
         execinteract('search_src("full cremonadatabase", max_chars = 1000)')
 
 
+class TestNamespace:
+    def test_watchers_swap_class(self, exec2):
+        # the namespace only uses the slow __setitem__ while it is watched
+        code = dedent(r"""
+        N = sage_server.Namespace({})
+        seen = []
+        f = lambda y: seen.append(y)
+        g = lambda x, y: seen.append((x, y))
+        h = lambda: seen.append('del')
+        out = [type(N).__name__]
+        N.on('change', 'a', f)
+        N.on('change', None, g)
+        N.on('del', 'a', h)
+        N['a'] = 1
+        N['b'] = 2
+        del N['a']
+        out.append('%s %s' % (type(N).__name__, seen))
+        N.remove('change', 'a', f)
+        N.remove('change', 'nope', f)
+        N.remove('del', 'a', h)
+        out.append(type(N).__name__)
+        N.remove('change', None, g)
+        N['a'] = 3
+        del N['b']
+        out.append('%s %s %s' % (type(N).__name__, seen, sorted(N.items())))
+        out.append('%s %s' % (type(N).__setitem__ is dict.__setitem__,
+                              type(N).__delitem__ is dict.__delitem__))
+        # one print, so the output is one message
+        print('\n'.join(out))""")
+        output = dedent("""\
+        Namespace
+        WatchedNamespace [1, ('a', 1), ('b', 2), 'del']
+        WatchedNamespace
+        Namespace [1, ('a', 1), ('b', 2), 'del'] [('a', 3)]
+        True True
+        """)
+        exec2(code, output)
+
+
 class TestIdentifiers:
     """
     see SMC issue #63
@@ -477,3 +744,25 @@ class TestIdentifiers:
         sage=1
         show_identifiers()""")
         exec2(code, "['sage']\n")
+
+
+class TestServerStatus:
+    def test_status(self, sagews):
+        import socket
+        host, port = conftest.get_sage_server_info()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((host, port))
+        sock.settimeout(conftest.default_timeout)
+        conftest.client_unlock_connection(sock)
+        conn = conftest.ConnectionJSON(sock)
+        assert conn._recv(1).decode() == 'y'
+        conn.send_json({'event': 'status'})
+        typ, mesg = conn.recv()
+        conn.close()
+        assert typ == 'json'
+        assert mesg['event'] == 'status'
+        # at least the session of the sagews fixture is running
+        sessions = [c for c in mesg['children'] if c['kind'] == 'session']
+        assert len(sessions) >= 1
+        for c in sessions:
+            assert 'start' in c and 'cpu' in c and 'max_rss' in c
@@ -24,6 +24,72 @@ class TestP3Mode:
     def test_p3b(self, exec2):
         exec2("%p3\nimport sys\nprint(sys.version)", pattern=r"^3\.[56]\.\d+ ")
 
+    def test_p3_many_lines(self, exec2):
+        # stream output is merged into a few output messages
+        exec2("%p3\nfor i in range(5000):\n    print(i, flush=True)",
+              pattern=r"^0\n1\n[\s\S]*\n4999\n$")
+
+    def test_p3_many_lines_messages(self, sagews, test_id):
+        # each colored chunk of stream output would be sent in an html
+        # message of its own if they weren't merged
+        code = "%p3\nfor i in range(2000):\n    print('\\x1b[31m%s\\x1b[0m' % i, flush=True)"
+        m = conftest.message.execute_code(code=code, id=test_id)
+        sagews.send_json(m)
+        html = []
+        while True:
+            typ, mesg = sagews.recv()
+            assert typ == 'json'
+            assert mesg['id'] == test_id
+            if 'html' in mesg:
+                html.append(mesg['html'])
+            if mesg.get('done'):
+                break
+        assert 0 < len(html) < 100
+        assert '>1999<' in ''.join(html)
+
+
+class TestSpareKernel:
+    # the server only keeps spare kernels with --kernel-spares, so the
+    # worksheet gets them from a broker of its own here
+    def test_spare_kernel_setup(self, exec2):
+        code = dedent(r"""
+        broker = sage_server.sage_jupyter.KernelBroker(spares=1)
+        print(broker.take('python3', os.getpid(), os.getcwd()))
+        broker.refill()
+        sage_server.sage_jupyter.take_spare_kernel = \
+            lambda name: broker.take(name, os.getpid(), os.getcwd())""")
+        exec2(code, "None\n")
+
+    def test_spare_kernel_wd(self, exec2, data_path):
+        dp = data_path.strpath
+        exec2("os.chdir('%s'); p3b = jupyter('python3')" % dp)
+        exec2("print(type(p3b(get_kernel_manager=True)).__name__)",
+              "_SpareKernel\n")
+        exec2("%p3b\nimport os\nprint(os.getcwd())", dp + "\n")
+
+    def test_close(self, exec2):
+        code = dedent(r"""
+        def gone(pid):
+            try:
+                os.killpg(pid, 0)
+            except OSError:
+                return True
+            return False
+        km = broker._taken[os.getpid()][0]
+        pid, cf = km.pid, km.connection_file
+        broker.close()
+        print(gone(pid), os.path.exists(cf), broker._taken)""")
+        exec2(code, "True False {}\n")
+
+    def test_session_exited(self, exec2):
+        code = dedent(r"""
+        broker.refill()
+        info = broker.take('python3', 1, os.getcwd())
+        cf = broker._taken[1][0].connection_file
+        broker.session_exited(1)
+        print(gone(info['pid']), os.path.exists(cf), broker._taken)""")
+        exec2(code, "True False {}\n")
+
 
 class TestSingularMode:
     def test_singular_version(self, exec2):